@@ -5,6 +5,10 @@
 Description: Render worker agent
 '''
 
+import time
+import threading
+from subprocess import TimeoutExpired
+
 from .AgentTask import AgentTask
 from . import providers
 from .TaskExecutorBase import TaskExecutorConfig, TaskExecutorBase
@@ -22,6 +26,17 @@ class AgentConfig(TaskExecutorConfig):
             'type': str,
             'default': lambda cfg: providers.getAgentSizeDefault(),
         }
+        self._defs['render_worker'] = {
+            'description': '''Keep blender process with loaded project to render the next workloads of the same task''',
+            'type': bool,
+            'default': True,
+        }
+        self._defs['render_worker_idle'] = {
+            'description': '''How long in seconds to keep the render worker waiting for the next workload''',
+            'type': int,
+            'min': 0,
+            'default': 60,
+        }
 
         super().__init__(parent, init)
 
@@ -30,4 +45,59 @@ class Agent(TaskExecutorBase, providers.Agent):
         print('DEBUG: Creating Agent instance')
         TaskExecutorBase.__init__(self, AgentTask, AgentConfig(self, conf))
 
+        # Blender process waiting for the next workload with the loaded project
+        self._render_worker_lock = threading.Lock()
+        self._render_worker = None
+        self._render_worker_watcher = threading.Thread(target=self._renderWorkerWatcher)
+        self._render_worker_watcher.start()
+
         providers.Agent.__init__(self)
+
+    def renderWorkerTake(self, key):
+        '''Returns the loaded render worker if it's able to render the task with the key'''
+        with self._render_worker_lock:
+            worker, self._render_worker = self._render_worker, None
+        if worker and worker['key'] == key and worker['process'].poll() is None:
+            return worker
+        # The project or its files are changed - worker is not needed anymore
+        self.renderWorkerStop(worker)
+        return None
+
+    def renderWorkerPut(self, worker):
+        '''Keeps the render worker to use it for the next workloads'''
+        worker['idle_since'] = time.time()
+        with self._render_worker_lock:
+            old_worker, self._render_worker = self._render_worker, worker
+        self.renderWorkerStop(old_worker)
+
+    def _renderWorkerWatcher(self):
+        '''Stops the render worker when no workload came for it in time to free the memory'''
+        print('DEBUG: Starting render worker watcher')
+        while self._enabled:
+            worker = None
+            with self._render_worker_lock:
+                if self._render_worker and time.time() > self._render_worker['idle_since'] + self._cfg.render_worker_idle:
+                    worker, self._render_worker = self._render_worker, None
+            if worker:
+                print('DEBUG: The render worker "%s" is idle for too long' % worker['name'])
+                self.renderWorkerStop(worker)
+            time.sleep(1.0)
+        print('DEBUG: Stopped render worker watcher')
+
+    def renderWorkerStop(self, worker):
+        '''Ends the render worker process and cleans its workspace'''
+        if not worker:
+            return
+        print('DEBUG: Stopping the render worker "%s"' % worker['name'])
+        process = worker['process']
+        try:
+            if process.poll() is None:
+                process.stdin.write(b'end\n')
+                process.stdin.flush()
+            process.communicate(timeout=15)
+        except (OSError, ValueError, TimeoutExpired) as e:
+            print('WARN: Killing the render worker process: %s' % e)
+            process.kill()
+            process.communicate()
+        worker['ws'].cleanup()
+        self._fc.workspaceClean(worker['name'])
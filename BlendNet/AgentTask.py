@@ -7,6 +7,7 @@ Description: Task used by Agent to control jobs
 
 import os
 import time
+import json # Used to send the workload to the render worker
 import signal
 import threading # To run stderr reading thread
 from subprocess import TimeoutExpired
@@ -24,9 +25,13 @@ class AgentTask(TaskBase):
             self._status['result']['statistics'] = None
             self._status['result']['prepare_time'] = None
             self._status['result']['render_time'] = None
+            self._status['result']['frames'] = {} # Renders of the frames range {frame: {'render': blob_id}}
 
         self._stop_task = False
 
+        # Workspace created ahead while the previous task is running
+        self._prepared_ws = None
+
         # Special thread to watch for stderr stream messages
         self._execution_stderr_watcher = None
         print('DEBUG: Created Agent task', name)
@@ -43,24 +48,92 @@ class AgentTask(TaskBase):
         with self._status_lock:
             self._status['result']['render_time'] = time_sec
 
+    def prepare(self):
+        '''Creates the task workspace while the previous task is rendering'''
+        with self._execution_lock:
+            if self._prepared_ws is not None or self._execution_watcher:
+                return
+            try:
+                self._prepared_ws = self.prepareWorkspace(self.filesGet())
+                print('DEBUG: Prepared workspace of task "%s" ahead' % self.name())
+            except Exception as e:
+                self._prepared_ws = False # Will be created on start
+                print('WARN: Unable to prepare workspace of task "%s" ahead: %s' % (self.name(), e))
+
+    def stop(self):
+        '''Stops the task and cleans the prepared workspace'''
+        super().stop()
+        with self._execution_lock:
+            ws, self._prepared_ws = self._prepared_ws, None
+        if ws:
+            ws.cleanup()
+            self._parent._fc.workspaceClean(self.name())
+
+    def statusFrameSet(self, frame, blob_id):
+        with self._status_lock:
+            self._status['result']['frames'][str(frame)] = {'render': blob_id}
+
+    def renderWorkerKey(self):
+        '''Returns id of the render worker able to render the task or None if worker can't be used'''
+        if not self._parent._cfg.render_worker or self._cfg.frame_end is not None:
+            return None
+        # Workloads of the same task are different only by samples, seed and image region
+        cfg = self.configsGet()
+        for name in ('samples', 'seed', 'region_start', 'region_end'):
+            cfg.pop(name, None)
+        return json.dumps({'files': self.filesGet(), 'config': cfg}, sort_keys=True)
+
     def _executionWatcher(self):
         '''Preparing workspace, running execution and watch on it'''
         print('DEBUG: Execution watcher of task "%s" is started' % self.name())
 
+        worker = None
         try:
             files_map = self.filesGet()
             print('DEBUG: Files to use in workspace:')
             for path in sorted(files_map):
                 print('DEBUG:  ', files_map[path], path)
-            with self.prepareWorkspace(files_map) as ws_path:
-                process = self.runBlenderScriptProcessor(ws_path, 'render', self.configsGet(), blendfile=self._cfg.project)
-                self._execution_stderr_watcher = threading.Thread(target=self._executionStderrWatcher, args=(process, ws_path))
-                self._execution_stderr_watcher.start()
-                self._watchBlenderScriptProcessor(process, ws_path)
-            print('DEBUG: Destroyed the workspace')
+            key = self.renderWorkerKey()
+            with self._execution_lock:
+                ws, self._prepared_ws = self._prepared_ws, None
+            worker = self._parent.renderWorkerTake(key) if key else None
+            if worker:
+                if ws:
+                    ws.cleanup() # Not needed - the worker already has the project loaded
+                print('DEBUG: Using render worker "%s" with the loaded project' % worker['name'])
+                worker['process'].stdin.write(('render %s\n' % json.dumps({
+                    'samples': self._cfg.samples,
+                    'seed': self._cfg.seed,
+                    'region_start': self._cfg.region_start,
+                    'region_end': self._cfg.region_end,
+                })).encode('utf-8'))
+                worker['process'].stdin.flush()
+            else:
+                ws = ws or self.prepareWorkspace(files_map)
+                cfg = self.configsGet()
+                cfg['worker'] = bool(key)
+                worker = {
+                    'key': key,
+                    'name': None, # Set when the worker is kept
+                    'ws': ws,
+                    'process': self.runBlenderScriptProcessor(ws.name, 'render', cfg, blendfile=self._cfg.project),
+                }
+            process, ws_path = worker['process'], worker['ws'].name
+            self._execution_stderr_watcher = threading.Thread(target=self._executionStderrWatcher, args=(process, ws_path))
+            self._execution_stderr_watcher.start()
+            if self._watchBlenderScriptProcessor(process, ws_path, bool(key)):
+                if not worker['name']:
+                    # Workspace blobs are used by the worker now
+                    worker['name'] = 'render-worker-' + self.name()
+                    self._parent._fc.workspaceMove(self.name(), worker['name'])
+                self._parent.renderWorkerPut(worker)
+                worker = None
         except Exception as e:
             print('ERROR: Exception occurred during task "%s" execution: %s: %s' % (self.name(), type(e), e))
         finally:
+            if worker:
+                self._parent.renderWorkerStop(worker)
+                print('DEBUG: Destroyed the workspace')
             self._parent._fc.workspaceClean(self.name())
 
         print('INFO: Execution of the task "%s" is ended' % (self.name(),))
@@ -96,10 +169,18 @@ class AgentTask(TaskBase):
                 if blob:
                     print('DEBUG: got the render blob', blob['id'], blob['size'])
                 self.statusRenderSet(blob['id'] if blob else None)
+            elif l.startswith('INFO: Frame ') and l.endswith(' render saved'):
+                frame = int(l.split(' ')[2])
+                blob = self._parent._fc.blobStoreFile(os.path.join(workspace, 'render-%d.exr' % frame), True)
+                if blob:
+                    print('DEBUG: got the frame %d render blob' % frame, blob['id'], blob['size'])
+                    self.statusFrameSet(frame, blob['id'])
+            elif l.startswith('INFO: Render worker is waiting'):
+                break # The process is kept for the next workloads
         self._execution_stderr_watcher = None
 
-    def _watchBlenderScriptProcessor(self, process, workspace):
-        '''Watching blender stdout and sending commands to the process'''
+    def _watchBlenderScriptProcessor(self, process, workspace, worker = False):
+        '''Watching blender stdout and sending commands to the process, returns True if the worker process is kept'''
         print('INFO: Starting process stdout read')
 
         prepare_time = None
@@ -112,6 +193,9 @@ class AgentTask(TaskBase):
         sample_preview_save_time = 0
         # Used to contain the current rendering sample
         curr_sample = 0
+        # Frames of the range rendered by the process and their render time
+        frames_done = 0
+        frames_time = 0.0
         # The blender crashed, so the path contains trace
         crash_path = None
         for line in iter(process.stdout.readline, b''):
@@ -123,6 +207,9 @@ class AgentTask(TaskBase):
                 l = line.decode('iso-8859-1').rstrip()
             print(">std>> %s" % l)
 
+            if worker and l == 'BlendNet: Render worker is waiting':
+                break # Render is done and the process is ready for the next workload
+
             if l.startswith('Fra:'):
                 status = l.split(' | ')
                 frame = None
@@ -169,7 +256,7 @@ class AgentTask(TaskBase):
                     if 'Sample ' in operation:
                         operation, curr_sample = operation.split('Sample ')
                         curr_sample = int(curr_sample.split('/')[0])
-                        self.statusSamplesDoneSet(curr_sample-1)
+                        self.statusSamplesDoneSet(frames_done*self._cfg.samples + curr_sample-1)
                 self.executionDetailsAdd({
                     'time': time_sec,
                     'remaining': rem,
@@ -185,7 +272,7 @@ class AgentTask(TaskBase):
                     },
                 })
 
-                if curr_sample == 1:
+                if curr_sample == 1 and prepare_time is None:
                     prepare_time = time_sec
                     self.statusPrepareTimeSet(prepare_time)
 
@@ -198,13 +285,21 @@ class AgentTask(TaskBase):
                     except Exception as e:
                         print('ERROR: Unable to send "savePreview" command due to exception: %s' % e)
 
-                if operation in ('Finished', 'Cancel | Cancelled', 'Cancelled'):
+                if (operation == 'Finished' and self._cfg.frame_end is not None
+                    and frame is not None and frame < self._cfg.frame_end):
+                    # The process continues with the next frame of the range
+                    frames_done += 1
+                    frames_time += time_sec
+                    curr_sample = 0
+                    self.statusSamplesDoneSet(frames_done*self._cfg.samples)
+                elif operation in ('Finished', 'Cancel | Cancelled', 'Cancelled'):
                     finished = operation == 'Finished'
-                    process.stdin.write(b'end\n')
-                    process.stdin.flush()
+                    if not (worker and finished):
+                        process.stdin.write(b'end\n')
+                        process.stdin.flush()
                     if curr_sample > 1:
-                        self.statusRenderTimeSet(time_sec - prepare_time)
-                        self.statusSamplesDoneSet(curr_sample if finished else curr_sample-1)
+                        self.statusRenderTimeSet(frames_time + time_sec - prepare_time)
+                        self.statusSamplesDoneSet(frames_done*self._cfg.samples + (curr_sample if finished else curr_sample-1))
 
             # In case the crash happened
             elif l.startswith('Writing:') and l.endswith('.crash.txt'):
@@ -276,6 +371,14 @@ class AgentTask(TaskBase):
                     break
 
         print('INFO: Read of process stdout completed')
+        if worker and finished and not interrupted and process.poll() is None:
+            # Results are stored by stderr watcher, so waiting for it
+            watcher = self._execution_stderr_watcher
+            if watcher:
+                watcher.join(15)
+            if not (watcher and watcher.is_alive()):
+                self.stateComplete()
+                return True
         try:
             process.communicate(timeout=15)
         except TimeoutExpired:
@@ -10,16 +10,34 @@ import time
 import ssl
 import json # Used to parse response
 import urllib # To request API
-import hashlib
-from io import StringIO
+from io import StringIO, BytesIO
 
 from . import providers
+from .FileCache import (
+    streamChunks,
+    hashAlgorithm,
+    hashNew,
+    hashId,
+)
+
+# Streams from this size are uploaded in parts to be able to resume
+UPLOAD_SESSION_MIN_SIZE = 16*1024*1024
+UPLOAD_PART_SIZE = 8*1024*1024
 
 class Client:
     def info(self):
         '''Get information about the environment'''
         return self._engine.get('info')
 
+    def blobHash(self):
+        '''Returns the content hash algorithm preferred by the server, old servers are using sha1'''
+        if not self._engine._blob_hash:
+            info = self.info()
+            if not isinstance(info, dict):
+                return 'sha1'
+            self._engine._blob_hash = info.get('blob_hash', 'sha1')
+        return self._engine._blob_hash
+
     def status(self):
         '''Get information about the current status'''
         return self._engine.get('status')
@@ -34,9 +52,106 @@ class Client:
 
     def taskFileStreamPut(self, task, rel_path, stream, size, checksum):
         '''Send stream to the task file'''
+        if size >= UPLOAD_SESSION_MIN_SIZE and stream.seekable():
+            if not self.blobUpload(stream, size, checksum):
+                return None
+            # Blob is already on the server, so just adding it to the task
+            stream = BytesIO()
+            size = 0
         path = 'task/%s/file/%s' % (task, urllib.parse.quote(rel_path))
         return self._engine.put(path, stream, size, checksum)
 
+    def blobUpload(self, stream, size, checksum):
+        '''Send seekable stream as blob by parts, resumes from the last received offset'''
+        path = 'upload/%s' % checksum
+        acked = 0
+        fails = 0
+        while fails < 10:
+            state = self._engine.get(path)
+            if not isinstance(state, dict):
+                fails += 1
+                time.sleep(min(fails, 5))
+                continue
+            if state.get('complete'):
+                return True
+            offset = state.get('offset', 0)
+            if offset < acked:
+                print('WARN: Upload of "%s" was discarded by the server' % checksum)
+                return None
+            if offset > acked:
+                acked = offset
+                fails = 0
+            else:
+                fails += 1
+
+            length = min(UPLOAD_PART_SIZE, size - offset)
+            stream.seek(offset)
+            # Bytes are used instead of stream to send the same data on repeat
+            state = self._engine.putPart(path, stream.read(length), offset, size)
+            if not isinstance(state, dict):
+                # Backing off to not waste the attempts on the fast failures like "already in progress"
+                time.sleep(min(fails + 1, 5))
+            elif state.get('complete'):
+                return True
+
+        print('WARN: Unable to upload "%s", no progress during %i attempts' % (checksum, fails))
+        return None
+
+    def taskFilesRefPut(self, task, files_map):
+        '''Add the blobs already stored on the server to the task, returns not added paths'''
+        path = 'task/%s/files' % task
+        data = json.dumps(files_map)
+        return self._engine.put(path, StringIO(data), len(data))
+
+    def taskManifestPut(self, task, manifest):
+        '''Add the known files {path: {sha1, size}} to the task, returns the missing entries'''
+        path = 'task/%s/manifest' % task
+        data = json.dumps(manifest)
+        return self._engine.put(path, StringIO(data), len(data))
+
+    def blobsMissing(self, sha1s):
+        '''Returns which of the blobs are not stored on the server'''
+        data = json.dumps(list(sha1s))
+        return self._engine.post('blob/missing', StringIO(data), len(data))
+
+    def blobsFetch(self, storage_url, blobs, peers = {}):
+        '''Asks server to download the blobs {id: size} from the peers {id: [peer, ...]} or storage'''
+        data = json.dumps({'storage_url': storage_url, 'blobs': blobs, 'peers': peers})
+        return self._engine.post('blob/fetch', StringIO(data), len(data))
+
+    def blobDownload(self, sha1, out_path):
+        '''Downloads the stored blob into the file, the content is verified by the receiver'''
+        def writeFile(res, size, checksum):
+            if checksum != sha1:
+                return print('ERROR: Received blob "%s" instead of "%s"' % (checksum, sha1))
+            with open(out_path, 'wb') as f:
+                for chunk in streamChunks(res, size):
+                    f.write(chunk)
+            return True
+        return self._engine.download('blob/%s' % sha1, writeFile)
+
+    def taskFileChunksPut(self, task, rel_path, stream, manifest, checksum):
+        '''Send only the missing chunks of the seekable stream and assemble the task file'''
+        data = json.dumps([ chunk[0] for chunk in manifest ])
+        missing = self._engine.post('chunk/missing', StringIO(data), len(data))
+        if not isinstance(missing, list):
+            return None
+
+        missing = set(missing)
+        print('DEBUG: Uploading %d of %d chunks for "%s"' % (len(missing), len(manifest), rel_path))
+        offset = 0
+        for chunk_id, size in manifest:
+            if chunk_id in missing:
+                stream.seek(offset)
+                if not self._engine.put('chunk/%s' % chunk_id, BytesIO(stream.read(size)), size, chunk_id):
+                    return None
+                missing.discard(chunk_id)
+            offset += size
+
+        path = 'task/%s/chunked/%s' % (task, urllib.parse.quote(rel_path))
+        data = json.dumps({'checksum': checksum, 'chunks': manifest})
+        return self._engine.put(path, StringIO(data), len(data))
+
     def taskConfigPut(self, task, config_data):
         '''Send task configuration'''
         path = 'task/%s/config' % task
@@ -78,10 +193,15 @@ class Client:
         '''Will download result name (preview/render) into the function-processor of stream'''
         return self._engine.download('task/%s/status/result/%s' % (task, result), stream_func)
 
+    def taskFrameResultDownloadStream(self, task, frame, result, stream_func):
+        '''Will download result name (render/compose) of the task frame into the function-processor of stream'''
+        return self._engine.download('task/%s/status/frame/%s/%s' % (task, frame, result), stream_func)
+
 class ClientEngine:
     def __init__(self, address, cfg):
         self._address = address
         self._cfg = cfg
+        self._blob_hash = None # Negotiated with the server on the first use
         self._initSSL()
 
     def _initSSL(self):
@@ -109,10 +229,15 @@ class ClientEngine:
 
     def _request(self, path, data = None, method = 'GET'):
         '''Creates request to execute'''
-        if not self._getCA() or not self._address:
+        if not self._address:
             return None
+        scheme = 'http'
+        if not self._cfg.get('listen_plaintext'):
+            if not self._getCA():
+                return None
+            scheme = 'https'
 
-        url = 'https://%s:%d/api/v1/%s' % (self._address, self._cfg.get('listen_port'), path)
+        url = '%s://%s:%d/api/v1/%s' % (scheme, self._address, self._cfg.get('listen_port'), path)
         req = urllib.request.Request(url, data=data, method=method)
 
         creds = '%s:%s' % (self._cfg.get('auth_user'), self._cfg.get('auth_password'))
@@ -137,7 +262,7 @@ class ClientEngine:
                     if req.data and (isinstance(e.reason, BrokenPipeError) # Linux
                             or isinstance(e.reason, ConnectionAbortedError) # Windows
                             or isinstance(e.reason, ConnectionResetError)): # Windows
-                        # Ignore error "Broken pipe" for PUT requests - server checks sha1
+                        # Ignore error "Broken pipe" for PUT requests - server checks checksum
                         return True
                     print('WARN: Communication issue with request to "%s": %s' % (req.full_url, e.reason))
                     return None
@@ -164,28 +289,26 @@ class ClientEngine:
         '''Executes the download request, uses req._out_path to store file or req._out_func as processing function'''
         with urllib.request.urlopen(req, timeout=3, context=self._context) as res:
             length = res.headers['content-length']
-            sha1 = res.headers['x-checksum-sha1']
-            if not length or not sha1:
-                print('ERROR: Unable to download stream without Content-Length and X-Checksum-Sha1 headers')
+            checksum = res.headers['x-checksum'] or res.headers['x-checksum-sha1']
+            if not length or not checksum:
+                print('ERROR: Unable to download stream without Content-Length and X-Checksum headers')
                 return False
             size = int(length)
 
             if hasattr(req, '_out_func'):
-                return req._out_func(res, size, sha1)
+                return req._out_func(res, size, checksum)
 
             try:
-                sha1_calc = hashlib.sha1()
-                size_left = size
+                hash_calc = hashNew(hashAlgorithm(checksum))
                 # Create the required directory to store the file
                 os.makedirs(os.path.dirname(req._out_path), 0o750, True)
                 with open(req._out_path, 'wb') as f:
-                    for chunk in iter(lambda: res.read(min(1048576, size_left)), b''):
-                        sha1_calc.update(chunk)
+                    for chunk in streamChunks(res, size):
+                        hash_calc.update(chunk)
                         f.write(chunk)
-                        size_left -= len(chunk)
-                    if sha1 != sha1_calc.hexdigest():
-                        raise urllib.error.URLError('Incorrect sha1 signature')
-                    return sha1_calc.hexdigest(), req._out_path
+                    if checksum != hashId(hash_calc):
+                        raise urllib.error.URLError('Incorrect checksum signature')
+                    return checksum, req._out_path
             except:
                 try:
                     os.remove(req._out_path)
@@ -208,6 +331,16 @@ class ClientEngine:
 
         return self._requestExecute(req, self._requestExecuteRun)
 
+    def post(self, path, stream, size):
+        req = self._request(path, stream, 'POST')
+        if not req:
+            return None
+
+        req.add_header('Content-Length', str(size))
+        req.add_header('Content-Type', 'application/json')
+
+        return self._requestExecute(req, self._requestExecuteRun)
+
     def put(self, path, stream, size, checksum = None):
         req = self._request(path, stream, 'PUT')
         if not req:
@@ -216,7 +349,22 @@ class ClientEngine:
         req.add_header('Content-Length', str(size))
         req.add_header('Content-Type', 'application/octet-stream')
         if checksum:
-            req.add_header('X-Checksum-Sha1', checksum)
+            req.add_header('X-Checksum', checksum)
+            if hashAlgorithm(checksum) == 'sha1':
+                # Old servers are looking only for the sha1 header
+                req.add_header('X-Checksum-Sha1', checksum)
+
+        return self._requestExecute(req, self._requestExecuteRun)
+
+    def putPart(self, path, data, offset, total):
+        req = self._request(path, data, 'PUT')
+        if not req:
+            return None
+
+        req.add_header('Content-Length', str(len(data)))
+        req.add_header('Content-Type', 'application/octet-stream')
+        req.add_header('X-Upload-Offset', str(offset))
+        req.add_header('X-Upload-Size', str(total))
 
         return self._requestExecute(req, self._requestExecuteRun)
 
@@ -8,14 +8,345 @@ Description: Class to receive, store and clean data on the file system
 import os
 import tempfile # To get the temp directory
 import time # We need timestamps
+import heapq # Eviction index of the blobs ordered by access time
 import json # To read/save the blob metadata
-import hashlib # Confirm sha1 hash of the blob
+import hashlib # Confirm content hash of the blob
 import threading # Using locks for multi-threading streaming
 import shutil # Useful recursive dir remove feature
 import re # Used to clean bad symbols for tmp files
 
+from .Workers import Workers
+
+# Supported content hash algorithms of the blob ids, preferred goes first
+HASH_ALGORITHMS = ('blake2b', 'sha1')
+
+def hashAlgorithm(blob_id):
+    '''Returns hash algorithm of the blob id, ids without prefix are sha1'''
+    return blob_id.split(':', 1)[0] if ':' in blob_id else 'sha1'
+
+def hashNew(algorithm):
+    '''Creates hash object of the supported algorithm'''
+    if algorithm not in HASH_ALGORITHMS:
+        raise ValueError('Not supported hash algorithm "%s"' % algorithm)
+    if algorithm == 'blake2b':
+        return hashlib.blake2b(digest_size=32)
+    return hashlib.new(algorithm)
+
+def hashId(hash_calc):
+    '''Returns the blob id of the calculated hash, sha1 ids are kept without prefix'''
+    if hash_calc.name == 'sha1':
+        return hash_calc.hexdigest()
+    return '%s:%s' % (hash_calc.name, hash_calc.hexdigest())
+
+def calculateChecksum(stream, algorithm):
+    '''Returns the blob id of the stream content'''
+    hash_calc = hashNew(algorithm)
+    for chunk in streamChunks(stream):
+        hash_calc.update(chunk)
+    return hashId(hash_calc)
+
+def blobFileName(blob_id):
+    '''Returns the blob id digest usable as a file name, ':' is not allowed everywhere'''
+    return blob_id.rsplit(':', 1)[-1]
+
+def blobStoragePath(blob_id):
+    '''Returns the blob object path in the provider storage, ':' is not allowed everywhere'''
+    return blob_id.replace(':', '-')
+
+# Files from this size are transferred as content-defined chunks
+CHUNKED_MIN_SIZE = 16*1024*1024
+CHUNK_MIN_SIZE = 256*1024
+CHUNK_MAX_SIZE = 4*1024*1024
+# Chunk boundary is placed where these bits of the gear rolling hash are zero (~1MB average chunk)
+CHUNK_MASK = 0xfffff << 44
+# Random values of the gear rolling hash bytes, should be the same on all the nodes
+CHUNK_GEAR = [ int.from_bytes(hashlib.sha1(bytes([i])).digest()[:8], 'little') for i in range(256) ]
+# Not touched partial uploads are removed after this time in seconds
+UPLOAD_SESSION_TTL = 24*3600
+# Size of the reused buffer to move the data between the streams
+STREAM_BUFFER_SIZE = 4*1024*1024
+# Number of parallel background downloads from the cold tier
+COLD_FETCH_WORKERS = 4
+
+def streamChunks(stream, size = -1):
+    '''Reads the stream into the reused buffer and yields memoryview of the read data
+
+    The view is valid only until the next iteration, so it should be written
+    or hashed right away. Streams without `readinto` are read as usual.
+    '''
+    buf = memoryview(bytearray(STREAM_BUFFER_SIZE))
+    readinto = getattr(stream, 'readinto', None)
+    while size != 0:
+        to_read = STREAM_BUFFER_SIZE if size < 0 else min(STREAM_BUFFER_SIZE, size)
+        if readinto:
+            read = readinto(buf[:to_read])
+        else:
+            data = stream.read(to_read)
+            read = len(data)
+            buf[:read] = data
+        if not read:
+            break
+        if size > 0:
+            size -= read
+        yield buf[:read]
+
+def _chunkEnd(data, start, end):
+    '''Returns end of the chunk starting at `start` found by the gear rolling hash
+
+    Only the last 64 bytes are affecting the hash high bits, so the boundary
+    depends just on the content around it. Minimal chunk size is skipped.
+    '''
+    limit = min(end, start + CHUNK_MAX_SIZE)
+    h = 0
+    gear = CHUNK_GEAR
+    for pos in range(start + CHUNK_MIN_SIZE, limit):
+        h = ((h << 1) + gear[data[pos]]) & 0xffffffffffffffff
+        if not h & CHUNK_MASK:
+            return pos + 1
+    return limit
+
+def contentChunks(stream):
+    '''Splits the stream into content-defined chunks and yields memoryview of the chunks data
+
+    The same content produces the same chunks even if the data before it was
+    changed or shifted. The data is read into the reused buffer, so the view
+    is valid only until the next iteration.
+    '''
+    buf = bytearray(CHUNK_MAX_SIZE * 2)
+    view = memoryview(buf)
+    readinto = getattr(stream, 'readinto', None)
+    start = end = 0
+    eof = False
+    while True:
+        if not eof and end - start < CHUNK_MAX_SIZE:
+            # Moving the left data to the beginning to read more after it
+            view[0:end - start] = view[start:end]
+            end -= start
+            start = 0
+            while not eof and end < CHUNK_MAX_SIZE:
+                if readinto:
+                    read = readinto(view[end:])
+                else:
+                    data = stream.read(len(buf) - end)
+                    read = len(data)
+                    view[end:end + read] = data
+                if not read:
+                    eof = True
+                end += read or 0
+        if start >= end:
+            break
+        chunk_end = _chunkEnd(buf, start, end)
+        yield view[start:chunk_end]
+        start = chunk_end
+
+def calculateChunks(stream, algorithm = 'sha1'):
+    '''Returns blob id and chunks manifest [[id, size], ...] of the stream'''
+    hash_calc = hashNew(algorithm)
+    manifest = []
+    for chunk in contentChunks(stream):
+        hash_calc.update(chunk)
+        chunk_calc = hashNew(algorithm)
+        chunk_calc.update(chunk)
+        manifest.append([hashId(chunk_calc), len(chunk)])
+    return hashId(hash_calc), manifest
+
+class ChunksReader:
+    '''File-like object to read the sequence of (path, offset, size) file parts'''
+    def __init__(self, parts):
+        self._parts = list(parts)
+        self._f = None
+        self._left = 0
+
+    def read(self, size = -1):
+        while True:
+            if not self._f:
+                if not self._parts:
+                    return b''
+                path, offset, self._left = self._parts.pop(0)
+                self._f = open(path, 'rb')
+                self._f.seek(offset)
+            data = self._f.read(self._left if size < 0 else min(size, self._left))
+            self._left -= len(data)
+            if not data or self._left <= 0:
+                self.close()
+            if data:
+                return data
+
+    def close(self):
+        if self._f:
+            self._f.close()
+            self._f = None
+
+class BlobInfo:
+    '''Compact read-only view of the blob metadata with dict-like access'''
+    __slots__ = ('id', 'size', 'dnd', 'create_time', 'access_time')
+
+    def __init__(self, data):
+        for key in self.__slots__:
+            object.__setattr__(self, key, data.get(key))
+
+    def __setattr__(self, name, value):
+        raise AttributeError('BlobInfo is read-only')
+
+    def _set(self, data):
+        '''Used by FileCache to change the known fields'''
+        for key, value in data.items():
+            if key in self.__slots__:
+                object.__setattr__(self, key, value)
+
+    def __getitem__(self, key):
+        value = getattr(self, key, None) if key in self.__slots__ else None
+        if value is None:
+            raise KeyError(key)
+        return value
+
+    def __contains__(self, key):
+        return key in self.__slots__ and getattr(self, key) is not None
+
+    def get(self, key, default = None):
+        value = getattr(self, key, None) if key in self.__slots__ else None
+        return default if value is None else value
+
+    def keys(self):
+        return [ key for key in self.__slots__ if getattr(self, key) is not None ]
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __repr__(self):
+        return 'BlobInfo(%s)' % dict(self)
+
+class LocalBlobBackend:
+    '''Stores the blob files in the private cache directory'''
+
+    def __init__(self):
+        self._safe_pattern = re.compile('[\\W_]+', re.UNICODE)
+
+    def setup(self, blobs_dir, tmp_dir):
+        '''Called by FileCache to set the cache directories'''
+        self._blobs_dir = blobs_dir
+        self._tmp_dir = tmp_dir
+
+    def tmpDir(self):
+        '''Directory to receive the files, they are moved in by `store`'''
+        return self._tmp_dir
+
+    def diskUsage(self):
+        '''Returns disk usage of the blobs storage'''
+        return shutil.disk_usage(self._blobs_dir)
+
+    def _path(self, sha1):
+        '''Returns path of the blob file, algorithm prefix is not used for the subdir'''
+        digest = self._safe_pattern.sub('', sha1.rsplit(':', 1)[-1])
+        return os.path.join(self._blobs_dir, digest[0:2], self._safe_pattern.sub('', sha1))
+
+    def path(self, sha1):
+        '''Returns path of the existing blob file or None'''
+        blob_path = self._path(sha1)
+        return blob_path if os.path.exists(blob_path) else None
+
+    def find(self, sha1):
+        '''Returns size of the blob stored without the cache knowing it or None'''
+        return None
+
+    def open(self, sha1):
+        '''Returns stream of the blob or None'''
+        blob_path = self.path(sha1)
+        return open(blob_path, 'rb') if blob_path else None
+
+    def store(self, tmp_path, sha1):
+        '''Moves the received tmp file into the storage'''
+        blob_path = self._path(sha1)
+        os.makedirs(os.path.dirname(blob_path), 0o700, True)
+        # Windows will not just replace the file - so need to check if it's exist
+        if os.path.exists(blob_path):
+            os.remove(blob_path)
+        try:
+            os.rename(tmp_path, blob_path)
+        except OSError:
+            # The tmp file could be on another filesystem
+            shutil.move(tmp_path, blob_path)
+
+    def storeLink(self, path, sha1):
+        '''Links the local file into the storage, raises OSError if it's not possible'''
+        blob_path = self._path(sha1)
+        os.makedirs(os.path.dirname(blob_path), 0o700, True)
+        # Could be left without metadata after crash
+        if os.path.exists(blob_path):
+            os.remove(blob_path)
+        os.link(path, blob_path)
+
+    def link(self, sha1, dest_path):
+        '''Makes the blob available in the workspace'''
+        os.link(self._path(sha1), dest_path)
+
+    def isOwned(self, sha1):
+        '''Returns True if the blob file takes the space of this node and could be evicted by it'''
+        return True
+
+    def remove(self, sha1):
+        '''Evicts the blob file, returns True on success'''
+        blob_path = self._path(sha1)
+        try:
+            if os.path.exists(blob_path):
+                os.remove(blob_path)
+        except Exception as e:
+            # Could happen on Windows if file is used by some process
+            print('ERROR: Unable to remove blob file:', str(e))
+            return False
+        return True
+
+class SharedBlobBackend(LocalBlobBackend):
+    '''Stores the blobs on the filesystem shared between the nodes (NFS, CephFS...)
+
+    Only the owner (Manager) writes and evicts the shared blobs. The other
+    nodes read the shared blobs in place and store their own blobs (like
+    render results) in the private cache directory.
+    '''
+
+    def __init__(self, shared_dir, owner = False):
+        super().__init__()
+        self._shared_dir = os.path.abspath(shared_dir)
+        self._owner = owner
+        self._shared = LocalBlobBackend()
+        self._shared.setup(os.path.join(self._shared_dir, 'blobs'), os.path.join(self._shared_dir, 'tmp'))
+
+    def setup(self, blobs_dir, tmp_dir):
+        if self._owner:
+            # Received files should be on the same filesystem to move them in
+            tmp_dir = self._shared._tmp_dir
+            blobs_dir = self._shared._blobs_dir
+            os.makedirs(tmp_dir, 0o700, True)
+            os.makedirs(blobs_dir, 0o700, True)
+        super().setup(blobs_dir, tmp_dir)
+        print('INFO: using the shared blobs directory "%s"' % self._shared_dir)
+
+    def path(self, sha1):
+        return super().path(sha1) or self._shared.path(sha1)
+
+    def find(self, sha1):
+        blob_path = self._shared.path(sha1)
+        return os.path.getsize(blob_path) if blob_path else None
+
+    def isOwned(self, sha1):
+        # The shared blobs are evicted only by the owner
+        return self._owner or super().path(sha1) is not None
+
+    def link(self, sha1, dest_path):
+        blob_path = super().path(sha1)
+        if blob_path:
+            return os.link(blob_path, dest_path)
+        try:
+            os.symlink(self._shared.path(sha1), dest_path)
+        except OSError:
+            # Symlinks could be not allowed (Windows), so copying the blob
+            shutil.copyfile(self._shared.path(sha1), dest_path)
+
 class FileCache:
-    def __init__(self, path = None, name = None):
+    # Number of independent locks protecting the blobs map
+    _stripes_num = 16
+
+    def __init__(self, path = None, name = None, hash_algorithm = HASH_ALGORITHMS[0], backend = None):
         if not path:
             path = tempfile.gettempdir()
             print('WARN: using a temp dir to store cache "%s"' % path)
@@ -26,6 +357,12 @@ class FileCache:
         # Ensure tmp files will be ok
         self._safe_pattern = re.compile('[\\W_]+', re.UNICODE)
 
+        # Used to identify the blobs created from local files
+        if hash_algorithm not in HASH_ALGORITHMS:
+            print('WARN: Not supported hash algorithm "%s", using sha1' % hash_algorithm)
+            hash_algorithm = 'sha1'
+        self._hash_algorithm = hash_algorithm
+
         self._cache_dir = os.path.abspath(os.path.join(path, name))
         os.makedirs(self._cache_dir, 0o700, True)
         self._blobs_dir = os.path.join(self._cache_dir, 'blobs')
@@ -33,6 +370,23 @@ class FileCache:
         self._tmp_dir = os.path.join(self._cache_dir, 'tmp')
         os.makedirs(self._tmp_dir, 0o700, True)
 
+        # Backend stores the blob files, by default in the cache dir
+        self._backend = backend or LocalBlobBackend()
+        self._backend.setup(self._blobs_dir, self._tmp_dir)
+        self._tmp_dir = self._backend.tmpDir()
+
+        # Uploaded chunks are stored until the blob will be assembled from them
+        self._chunks_dir = os.path.join(self._cache_dir, 'chunks')
+        if os.path.exists(self._chunks_dir):
+            shutil.rmtree(self._chunks_dir)
+        os.makedirs(self._chunks_dir, 0o700, True)
+
+        # Partial uploads are kept across restarts to resume them later
+        self._uploads_dir = os.path.join(self._cache_dir, 'uploads')
+        os.makedirs(self._uploads_dir, 0o700, True)
+        self._uploads_lock = threading.Lock()
+        self._uploads = set() # Blobs receiving the data right now
+
         self._workspace_dir = os.path.join(self._cache_dir, 'ws')
         if os.path.exists(self._workspace_dir):
             shutil.rmtree(self._workspace_dir)
@@ -43,41 +397,195 @@ class FileCache:
 
         self._write_cache_timer_lock = threading.Lock()
         self._write_cache_timer = None
-        self._blobs_map_lock = threading.Lock()
+        self._journal_lock = threading.Lock()
+        self._journal_records = 0
+
+        # Blobs map is split to stripes (lock, {id: BlobInfo}) to not block parallel streams
+        self._blobs_stripes = [ (threading.Lock(), {}) for _ in range(self._stripes_num) ]
+        # Index lock protects eviction heap, pins and changes, it's acquired after stripe lock
+        self._blobs_index_lock = threading.Lock()
+        self._blobs_lru = [] # Heap of (access_time, id) with lazy invalidation
+        self._blobs_pins = {} # Refcount of blob users to protect it from eviction
+        self._blobs_changed = set() # Blobs to write to the journal
+        self._blobs_accessed = {} # Batched access time updates {id: time}
+
+        # Cold tier keeps the evicted blobs in the external storage
+        self._cold_lock = threading.Lock()
+        self._cold = {} # Archived blobs {id: size}
+        self._cold_fetching = {} # Blobs downloading from cold tier {id: (thread id, Event)}
+        self._cold_queued = set() # Blobs waiting for the background download from cold tier
+        self._cold_workers = Workers('Cold tier fetch', COLD_FETCH_WORKERS, self._coldFetchWorker)
+        self._cold_upload = None
+        self._cold_download = None
+        self.readColdIndex()
+
         self.readCache()
 
+        self._chunks_lock = threading.Lock()
+        self._chunks = {} # Chunks index {chunk id: (blob id, offset, size)}
+        self._blobs_chunks = {} # Chunks manifests of the blobs
+        self.readChunksIndex()
+
         # Uploading could be multithreaded - so we need to free space properly
         self._required_space = 0
         self._required_space_lock = threading.Lock()
 
+        # Disk usage is cached to not request it on every call
+        self._disk_usage_lock = threading.Lock()
+        self._disk_usage = None
+        self._disk_usage_time = 0
+
+        # Function returning ids of the blobs in use, like the files of active tasks
+        self._blobs_protected = None
+
+        # Background reclaimer keeps the free space between watermarks
+        self._reclaimer = None
+        self._reclaimer_event = threading.Event()
+        self._reclaimer_lock = threading.Lock()
+        self._reclaimer_status = {
+            'enabled': False,
+            'state': 'disabled',
+        }
+
+    def _stripe(self, sha1):
+        '''Returns (lock, map) stripe of the blob'''
+        return self._blobs_stripes[hash(sha1) % self._stripes_num]
+
+    def _blobsCount(self):
+        return sum([ len(blobs) for _, blobs in self._blobs_stripes ])
+
+    def _blobsList(self):
+        '''Returns list of all the stored blobs'''
+        out = []
+        for lock, blobs in self._blobs_stripes:
+            with lock:
+                out.extend([ blob for blob in blobs.values() if 'id' in blob ])
+        return out
+
     def readCache(self):
-        '''Fill the file map from the existing cache directory'''
-        self._last_save_time = int(time.time())
+        '''Fill the file map from the metadata journal or migrate the old per-blob metadata'''
+        self._journal_path = os.path.join(self._cache_dir, 'blobs.journal')
 
-        with self._blobs_map_lock:
-            self._blobs_map = {}
-        blobs_dirs = os.listdir(self._blobs_dir)
-        if not blobs_dirs:
+        if not os.path.exists(self._journal_path):
+            self._migrateCache()
             return
 
-        print('INFO: Reading blobs metadata from disk')
+        print('INFO: Reading blobs metadata journal')
+        blobs = {}
+        records = 0
+        with open(self._journal_path, 'r') as f:
+            for line in f:
+                records += 1
+                try:
+                    data = json.loads(line)
+                except ValueError:
+                    # Could happen if the last batch was not completely written
+                    print('WARN: Skipping broken record in blobs metadata journal')
+                    continue
+                if data.get('removed'):
+                    blobs.pop(data.get('id'), None)
+                elif 'id' in data:
+                    blobs[data['id']] = data
+
+        self._journal_records = records
+        self._setBlobs(blobs)
+
+        if self._isJournalCompactRequired():
+            self._compactJournal()
+
+    def _migrateCache(self):
+        '''Moves the old per-blob json metadata files into the journal'''
+        blobs_dirs = os.listdir(self._blobs_dir)
+        json_paths = []
+        blobs = {}
+        if blobs_dirs:
+            print('INFO: Migrating blobs metadata from disk into the journal')
         for d in blobs_dirs:
             bd = os.path.join(self._blobs_dir, d)
+            if not os.path.isdir(bd):
+                continue
             with os.scandir(bd) as it:
                 for entry in it:
                     if not (entry.is_file() and entry.name.endswith('.json')):
                         continue
                     info = entry.name.split('.')
                     json_path = os.path.join(bd, entry.name)
+                    json_paths.append(json_path)
                     try:
                         with open(json_path, 'r') as f:
-                            with self._blobs_map_lock:
-                                self._blobs_map[info[0]] = json.load(f)
+                            blobs[info[0]] = json.load(f)
                     except:
                         print('ERROR: Unable to parse metadata from disk: %s' % json_path)
 
-        with self._blobs_map_lock:
-            print('INFO: Found %i blobs in cache' % len(self._blobs_map))
+        self._setBlobs(blobs)
+
+        # Journal is the only source of truth now, so the old files could be removed
+        self._compactJournal()
+        for json_path in json_paths:
+            try:
+                os.remove(json_path)
+            except Exception as e:
+                # Could happen on Windows if file is used by some process
+                print('ERROR: Unable to remove old metadata file:', str(e))
+
+    def _setBlobs(self, blobs):
+        '''Replaces the blobs map with the loaded data and builds the index'''
+        for lock, stripe in self._blobs_stripes:
+            with lock:
+                stripe.clear()
+        for sha1, data in blobs.items():
+            lock, stripe = self._stripe(sha1)
+            with lock:
+                stripe[sha1] = BlobInfo(data)
+
+        with self._blobs_index_lock:
+            self._blobs_lru = [ (blob.access_time, blob.id) for blob in self._blobsList() ]
+            heapq.heapify(self._blobs_lru)
+            # Important (dnd - do not delete) blob holds one pin all the time
+            self._blobs_pins = { blob.id: 1 for blob in self._blobsList() if blob.dnd }
+            self._blobs_changed.clear()
+            self._blobs_accessed.clear()
+
+        print('INFO: Found %i blobs in cache' % self._blobsCount())
+
+    def _isJournalCompactRequired(self):
+        '''Journal contains too much outdated records'''
+        with self._journal_lock:
+            return self._journal_records > 1000 and self._journal_records > self._blobsCount() * 3
+
+    def _compactJournal(self):
+        '''Rewrites the journal to contain just the current blobs metadata'''
+        with self._journal_lock:
+            self._applyAccessed()
+            with self._blobs_index_lock:
+                self._blobs_changed.clear()
+            blobs = [ dict(blob) for blob in self._blobsList() ]
+
+            print('INFO: Compacting blobs metadata journal with %i blobs' % len(blobs))
+            tmp_path = self._journal_path + '.tmp'
+            with open(tmp_path, 'w') as f:
+                f.writelines([ json.dumps(blob) + '\n' for blob in blobs ])
+                f.flush()
+                os.fsync(f.fileno())
+            # Windows will not just replace the file with rename
+            os.replace(tmp_path, self._journal_path)
+
+            self._journal_records = len(blobs)
+
+    def _applyAccessed(self):
+        '''Moves the batched access time updates into the blobs'''
+        with self._blobs_index_lock:
+            accessed = self._blobs_accessed
+            self._blobs_accessed = {}
+        for sha1, t in accessed.items():
+            lock, stripe = self._stripe(sha1)
+            with lock:
+                blob = stripe.get(sha1)
+                if not blob or blob.access_time >= t:
+                    continue
+                blob._set({'access_time': t})
+                with self._blobs_index_lock:
+                    self._blobs_changed.add(sha1)
 
     def writeCache(self):
         with self._write_cache_timer_lock:
@@ -87,137 +595,468 @@ class FileCache:
             self._write_cache_timer.start()
 
     def _writeCache(self):
-        '''Save recently accessed blobs metadata'''
-        changed_blobs = None
-        with self._blobs_map_lock:
-            changed_blobs = [data.copy() for _, data in self._blobs_map.items() if data['access_time'] > self._last_save_time]
-        if not changed_blobs:
+        '''Append the changed blobs metadata to the journal in one batch'''
+        with self._write_cache_timer_lock:
+            self._write_cache_timer = None
+
+        self._applyAccessed()
+        with self._blobs_index_lock:
+            changed = self._blobs_changed
+            self._blobs_changed = set()
+
+        records = []
+        for sha1 in changed:
+            lock, stripe = self._stripe(sha1)
+            with lock:
+                blob = stripe.get(sha1)
+                if blob is None:
+                    records.append({'id': sha1, 'removed': True})
+                elif 'id' in blob:
+                    records.append(dict(blob))
+        if not records:
             return
 
-        print('INFO: Writing %i changed blobs metadata to disk' % len(changed_blobs))
+        print('INFO: Writing %i changed blobs metadata to journal' % len(records))
 
-        for blob in changed_blobs:
-            if 'id' not in blob:
-                continue
-            blob_dir = os.path.join(self._blobs_dir, blob['id'][0:2])
-            os.makedirs(blob_dir, 0o700, True)
-            with open(os.path.join(blob_dir, blob['id']+'.json'), 'w') as f:
-                json.dump(blob, f)
+        with self._journal_lock:
+            with open(self._journal_path, 'a') as f:
+                f.writelines([ json.dumps(record) + '\n' for record in records ])
+            self._journal_records += len(records)
 
-        self._last_save_time = int(time.time())
-        with self._write_cache_timer_lock:
-            self._write_cache_timer = None
+        if self._isJournalCompactRequired():
+            self._compactJournal()
 
     def blobGet(self, sha1):
-        '''Get blob and return info or return None'''
-        with self._blobs_map_lock:
-            if sha1 in self._blobs_map:
-                return self._blobs_map[sha1].copy()
-        return None
+        '''Get read-only blob info or return None'''
+        lock, stripe = self._stripe(sha1)
+        with lock:
+            blob = stripe.get(sha1)
+        if blob is None:
+            # Blob could be stored by another node in the shared backend
+            size = self._backend.find(sha1)
+            if size is not None:
+                return self.blobUpdate(sha1, {'id': sha1, 'size': size})
+            # Or evicted to the cold tier
+            return self._coldFetch(sha1)
+        return blob
 
     def blobGetStream(self, sha1):
         '''Return stream of the blob'''
-        sha1 = self._safe_pattern.sub('', sha1)
-        blob_path = os.path.join(self._blobs_dir, sha1[0:2], sha1)
-        if not os.path.exists(blob_path):
+        stream = self._backend.open(sha1)
+        if not stream:
             return print('ERROR: Unable to serve stream of not existing blob "%s"' % sha1)
-        return open(blob_path, 'rb')
+        return stream
+
+    def blobGetPath(self, sha1):
+        '''Return path of the stored blob file or None, the file should not be changed'''
+        if 'id' not in (self.blobGet(sha1) or {}):
+            return None
+        return self._backend.path(sha1)
+
+    def blobsMissing(self, sha1s):
+        '''Returns list of the blobs which are not stored, marks the stored ones as used
+
+        Blobs in the cold tier are not missing, they are fetched back in background.
+        '''
+        missing = []
+        for sha1 in sha1s:
+            lock, stripe = self._stripe(sha1)
+            with lock:
+                stored = 'id' in stripe.get(sha1, {})
+            if stored:
+                self.blobAccess(sha1)
+            elif self._coldHas(sha1):
+                self._coldFetchQueue(sha1)
+            elif 'id' not in (self.blobGet(sha1) or {}):
+                missing.append(sha1)
+        return missing
+
+    def blobAccess(self, sha1):
+        '''Marks the blob as recently used, the time is applied in batch later'''
+        with self._blobs_index_lock:
+            self._blobs_accessed[sha1] = int(time.time())
+        self.writeCache()
 
     def blobUpdate(self, sha1, data = dict()):
-        '''Set data in the blob'''
+        '''Set data in the blob and return read-only blob info'''
+        if not data:
+            # Just an access - no need to block the map
+            blob = self.blobGet(sha1)
+            if blob:
+                self.blobAccess(sha1)
+                return blob
+
         t = int(time.time())
-        with self._blobs_map_lock:
-            if sha1 not in self._blobs_map:
-                self._blobs_map[sha1] = {
-                    'create_time': t,
-                }
-            self._blobs_map[sha1].update(data)
-            self._blobs_map[sha1]['access_time'] = t
-            self.writeCache()
+        lock, stripe = self._stripe(sha1)
+        with lock:
+            blob = stripe.get(sha1)
+            if not blob:
+                blob = stripe[sha1] = BlobInfo({'create_time': t, 'access_time': t})
+            with self._blobs_index_lock:
+                if 'id' in data and 'id' not in blob:
+                    # Blob is stored - so it's the time to put it in the eviction index
+                    heapq.heappush(self._blobs_lru, (t, sha1))
+                if data.get('dnd') and not blob.dnd:
+                    self._blobs_pins[sha1] = self._blobs_pins.get(sha1, 0) + 1
+                self._blobs_changed.add(sha1)
+            blob._set(data)
+            blob._set({'access_time': t})
 
-            return self._blobs_map[sha1].copy()
+        self.writeCache()
 
-    def blobRemove(self, sha1):
-        '''Removes blob and metadata from disk and returns True on success'''
-        print('INFO: Removing blob "%s"' % sha1)
-        blob_dir = os.path.join(self._blobs_dir, sha1[0:2])
-        blob_path = os.path.join(blob_dir, sha1)
-        json_path = blob_path+'.json'
+        return blob
+
+    def blobPin(self, sha1):
+        '''Protects the existing blob from eviction, returns False if blob is not here'''
+        lock, stripe = self._stripe(sha1)
+        with lock:
+            if 'id' not in stripe.get(sha1, {}):
+                return False
+            with self._blobs_index_lock:
+                self._blobs_pins[sha1] = self._blobs_pins.get(sha1, 0) + 1
+        self.blobAccess(sha1)
+        return True
+
+    def blobUnpin(self, sha1):
+        '''Releases the blob pin acquired by blobPin'''
+        with self._blobs_index_lock:
+            count = self._blobs_pins.get(sha1, 0) - 1
+            if count > 0:
+                self._blobs_pins[sha1] = count
+            else:
+                self._blobs_pins.pop(sha1, None)
 
+    def blobsProtectedSet(self, func):
+        '''Sets function returning set of the blob ids which should not be evicted'''
+        self._blobs_protected = func
+
+    def _blobsProtected(self):
+        '''Returns set of the blob ids protected by the owner of the cache'''
+        if not self._blobs_protected:
+            return set()
         try:
-            if os.path.exists(blob_path):
-                os.remove(blob_path)
-            if os.path.exists(json_path):
-                os.remove(json_path)
+            return set(self._blobs_protected())
         except Exception as e:
-            # Could happen on Windows if file is used by some process
-            print('ERROR: Unable to remove blob file:', str(e))
+            print('ERROR: Unable to get the protected blobs: %s' % e)
+            return set()
+
+    def _evictableSize(self, protected):
+        '''Returns size of the stored blobs which could be evicted'''
+        with self._blobs_index_lock:
+            pinned = set(self._blobs_pins)
+        return sum([ blob.size for blob in self._blobsList()
+            if blob.id not in pinned and blob.id not in protected and self._backend.isOwned(blob.id) ])
+
+    def _blobFileRemove(self, sha1):
+        '''Removes blob file from disk and returns True on success'''
+        return self._backend.remove(sha1)
+
+    def blobRemove(self, sha1):
+        '''Removes blob and metadata from disk and returns True on success'''
+        print('INFO: Removing blob "%s"' % sha1)
+        if not self._blobFileRemove(sha1):
             return False
 
-        with self._blobs_map_lock:
-            if sha1 not in self._blobs_map:
+        lock, stripe = self._stripe(sha1)
+        with lock:
+            if sha1 not in stripe:
                 return
-            self._blobs_map.pop(sha1)
+            stripe.pop(sha1)
+            with self._blobs_index_lock:
+                self._blobs_pins.pop(sha1, None)
+                self._blobs_changed.add(sha1)
+        self.writeCache()
+        with self._chunks_lock:
+            self._blobs_chunks.pop(sha1, None)
+
+        # The removed blobs are leaving outdated records in the eviction index
+        with self._blobs_index_lock:
+            if len(self._blobs_lru) > self._blobsCount() * 2 + 1000:
+                # Checking presence without stripe lock is safe and keeps the locks order
+                self._blobs_lru = [ item for item in self._blobs_lru if item[1] in self._stripe(item[1])[1] ]
+                heapq.heapify(self._blobs_lru)
 
         return True
 
     def cleanOldCache(self, size = None):
         '''Clean old blobs to free `size` of cache space'''
         print('INFO: Cleaning %s bytes of cache' % size)
-        oldest_blobs = None
-        with self._blobs_map_lock:
-            oldest_blobs = sorted([d.copy() for _, d in self._blobs_map.items() if 'id' in d], key=lambda v: v['access_time'])
+        self._applyAccessed()
 
-        size_cleaned = 0
+        size_cleaned = self._uploadsClean() + self._chunksClean()
         removed_blobs = 0
-        for blob in oldest_blobs:
-            if size and size_cleaned >= size:
-                break
-            # Skip important (dnd - do not delete) and workspace blobs
-            used = self._workspace_blobs.copy()
-            if blob.get('dnd') or blob['id'] in { item for key in used for item in used[key] }:
+        pinned = []
+        protected = self._blobsProtected()
+        while not size or size_cleaned < size:
+            with self._blobs_index_lock:
+                if not self._blobs_lru:
+                    break
+                access_time, sha1 = heapq.heappop(self._blobs_lru)
+
+            lock, stripe = self._stripe(sha1)
+            with lock:
+                blob = stripe.get(sha1)
+                if not blob or 'id' not in blob:
+                    continue # Outdated record of the removed blob
+                with self._blobs_index_lock:
+                    if blob.access_time > access_time:
+                        # Blob was accessed after indexing - putting it back with the actual time
+                        heapq.heappush(self._blobs_lru, (blob.access_time, sha1))
+                        continue
+                    if self._blobs_pins.get(sha1) or sha1 in protected:
+                        # Skip important (dnd - do not delete), workspace and active tasks blobs
+                        pinned.append((access_time, sha1))
+                        continue
+                # Removing from the map under lock, so workspace will not be able to pin it
+                stripe.pop(sha1)
+
+            if not self._backend.isOwned(sha1):
+                # The shared blob record is just forgotten, it will be found again when needed
+                with self._blobs_index_lock:
+                    self._blobs_changed.add(sha1)
+                continue
+
+            if not self._coldArchive(sha1, blob.size) or not self._blobFileRemove(sha1):
+                with lock:
+                    stripe[sha1] = blob
+                pinned.append((access_time, sha1))
                 continue
-            size_cleaned += blob['size']
-            self.blobRemove(blob['id'])
+
+            size_cleaned += blob.size
             removed_blobs += 1
+            with self._blobs_index_lock:
+                self._blobs_changed.add(sha1)
+            with self._chunks_lock:
+                self._blobs_chunks.pop(sha1, None)
+
+        with self._blobs_index_lock:
+            for item in pinned:
+                heapq.heappush(self._blobs_lru, item)
+        if removed_blobs:
+            self.writeCache()
 
         print('INFO: Cleaned %i blobs and %i bytes' % (removed_blobs, size_cleaned))
 
+        return size_cleaned
+
+    def readColdIndex(self):
+        '''Loads the list of blobs archived in the cold tier'''
+        self._cold_path = os.path.join(self._cache_dir, 'cold.journal')
+        if not os.path.exists(self._cold_path):
+            return
+
+        with open(self._cold_path, 'r') as f:
+            for line in f:
+                try:
+                    data = json.loads(line)
+                except ValueError:
+                    print('WARN: Skipping broken record in cold tier journal')
+                    continue
+                self._cold[data['id']] = data['size']
+
+        print('INFO: Found %i blobs in cold tier' % len(self._cold))
+
+    def coldTierSet(self, upload_func, download_func):
+        '''Enables the cold tier to keep the evicted blobs
+
+        The upload function gets (path, id) and the download function gets
+        (id, out_path), both should return True on success.
+        '''
+        self._cold_upload = upload_func
+        self._cold_download = download_func
+
+    def _coldHas(self, sha1):
+        '''Returns True if the blob could be fetched from the cold tier'''
+        with self._cold_lock:
+            return bool(self._cold_download) and sha1 in self._cold
+
+    def _coldArchive(self, sha1, size):
+        '''Uploads blob to the cold tier before eviction, returns True if blob could be evicted'''
+        if not self._cold_upload:
+            return True
+        with self._cold_lock:
+            if sha1 in self._cold:
+                return True
+
+        blob_path = self._backend.path(sha1)
+        try:
+            if not blob_path or not self._cold_upload(blob_path, sha1):
+                raise Exception('upload function failed')
+        except Exception as e:
+            return print('WARN: Unable to archive blob "%s" to cold tier: %s' % (sha1, e))
+
+        with self._cold_lock:
+            self._cold[sha1] = size
+            with open(self._cold_path, 'a') as f:
+                f.write(json.dumps({'id': sha1, 'size': size}) + '\n')
+
+        return True
+
+    def _coldFetch(self, sha1):
+        '''Downloads the archived blob back to the cache, returns blob info or None'''
+        with self._cold_lock:
+            size = self._cold.get(sha1)
+            if size is None or not self._cold_download:
+                return None
+            fetching = self._cold_fetching.get(sha1)
+            if not fetching:
+                self._cold_fetching[sha1] = (threading.get_ident(), threading.Event())
+
+        if fetching:
+            if fetching[0] == threading.get_ident():
+                return None # Storing of the fetched blob is checking it
+            fetching[1].wait()
+            lock, stripe = self._stripe(sha1)
+            with lock:
+                return stripe.get(sha1)
+
+        try:
+            print('INFO: Fetching blob "%s" from cold tier' % sha1)
+            return self.blobStoreDownload(lambda path: self._cold_download(sha1, path), size, sha1)
+        finally:
+            with self._cold_lock:
+                self._cold_fetching.pop(sha1)[1].set()
+
+    def _coldFetchQueue(self, sha1):
+        '''Adds the blob to download from the cold tier in background if it's not there yet'''
+        with self._cold_lock:
+            queued = sha1 in self._cold_queued or sha1 in self._cold_fetching
+            if not queued:
+                self._cold_queued.add(sha1)
+        if queued:
+            # Just in case the workers were stopped before processing it
+            return self._cold_workers.start()
+        self._cold_workers.addSet([(sha1,)])
+
+    def _coldFetchWorker(self, sha1):
+        '''Background download of the blob from the cold tier'''
+        try:
+            self._coldFetch(sha1)
+        finally:
+            with self._cold_lock:
+                self._cold_queued.discard(sha1)
+
     def freeSpace(self, size):
         '''Ensure there is a free space on the disk to store the file of `size`'''
         cur_req_space = 0
         with self._required_space_lock:
             self._required_space += size
             cur_req_space = self._required_space - self.getAvailableSpace()
+            if cur_req_space > 0:
+                # Cached value could be outdated
+                cur_req_space = self._required_space - self._diskUsage(True)['free']
+
+        # Reclaimer will check the watermarks in background
+        self._reclaimer_event.set()
 
         if cur_req_space <= 0:
             return True
 
+        # Reclaimer was not able to prepare the space in time - so cleaning right now
         self.cleanOldCache(cur_req_space)
 
         with self._required_space_lock:
-            return self.getAvailableSpace() >= self._required_space
+            return self._diskUsage(True)['free'] >= self._required_space
 
-    def _receivedData(self, size):
+    def _receivedData(self, size, written = True):
         '''Will sub amount of received bytes from planned'''
         with self._required_space_lock:
             self._required_space -= size
+            if written:
+                with self._disk_usage_lock:
+                    if self._disk_usage:
+                        self._disk_usage['free'] -= size
+
+    def reclaimerStart(self, free_low, free_high, pass_budget):
+        '''Starts background cleaning of the cache to keep the free disk space between watermarks
+
+        When free space becomes lower than `free_low` percents of the disk - the
+        oldest blobs will be removed to get `free_high` percents, but no more
+        than `pass_budget` bytes per one pass (0 means no limit).
+        '''
+        with self._reclaimer_lock:
+            self._reclaimer_status.update({
+                'enabled': True,
+                'state': 'idle',
+                'free_low': free_low,
+                'free_high': max(free_low, free_high),
+                'pass_budget': pass_budget,
+                'passes': 0,
+                'cleaned': 0,
+                'last_pass_time': None,
+                'last_pass_cleaned': 0,
+            })
+            if not self._reclaimer:
+                self._reclaimer = threading.Thread(target=self._reclaimerWatcher)
+                self._reclaimer.daemon = True
+                self._reclaimer.start()
+
+    def reclaimerStatus(self):
+        '''Returns the current state of the background reclaimer'''
+        with self._reclaimer_lock:
+            return self._reclaimer_status.copy()
+
+    def _reclaimerWatcher(self):
+        '''Checks the free space periodically or on request and cleans the old blobs'''
+        print('DEBUG: Starting FileCache reclaimer')
+        while True:
+            self._reclaimer_event.wait(5.0)
+            self._reclaimer_event.clear()
+
+            with self._reclaimer_lock:
+                cfg = self._reclaimer_status.copy()
+            usage = self._diskUsage(True)
+            with self._required_space_lock:
+                free = usage['free'] - self._required_space
 
-    def _receiveStream(self, stream, size, tmp_name):
-        '''Unified function to receive stream and calculate sha1 id'''
+            if free >= usage['total'] * cfg['free_low'] / 100:
+                with self._reclaimer_lock:
+                    self._reclaimer_status['state'] = 'idle'
+                continue
+
+            # The disk space could be taken not by the cache, so draining it will not help
+            evictable = self._evictableSize(self._blobsProtected())
+            if usage['total'] * cfg['free_low'] / 100 - free > evictable:
+                with self._reclaimer_lock:
+                    if self._reclaimer_status['state'] != 'unreachable':
+                        print('WARN: Cleaning of the cache is not able to reach the free space low watermark')
+                    self._reclaimer_status['state'] = 'unreachable'
+                continue
+
+            to_free = min(int(usage['total'] * cfg['free_high'] / 100 - free), evictable)
+            budget_limited = cfg['pass_budget'] and to_free > cfg['pass_budget']
+            if budget_limited:
+                to_free = cfg['pass_budget']
+
+            with self._reclaimer_lock:
+                self._reclaimer_status['state'] = 'reclaiming'
+            cleaned = self.cleanOldCache(to_free)
+            with self._reclaimer_lock:
+                self._reclaimer_status['state'] = 'idle'
+                self._reclaimer_status['passes'] += 1
+                self._reclaimer_status['cleaned'] += cleaned
+                self._reclaimer_status['last_pass_time'] = int(time.time())
+                self._reclaimer_status['last_pass_cleaned'] = cleaned
+
+            if budget_limited and cleaned >= to_free:
+                # Budget was used completely, so the next pass is needed
+                self._reclaimer_event.set()
+
+    def _receiveStream(self, stream, size, tmp_name, algorithm = 'sha1'):
+        '''Unified function to receive stream and calculate the blob id'''
         tmp_path = os.path.join(self._tmp_dir, self._safe_pattern.sub('', tmp_name))
-        sha1_calc = hashlib.sha1()
+        sha1_calc = hashNew(algorithm)
         size_left = size
         try:
             with open(tmp_path, 'wb') as f:
-                for chunk in iter(lambda: stream.read(min(1048576, size_left)), b''):
+                for chunk in streamChunks(stream, size):
                     sha1_calc.update(chunk)
                     f.write(chunk)
                     self._receivedData(len(chunk))
                     size_left -= len(chunk)
-            return sha1_calc.hexdigest(), tmp_path
+            return hashId(sha1_calc), tmp_path
         except Exception as e:
-            self._receivedData(size_left)
+            self._receivedData(size_left, False)
             try:
                 os.remove(tmp_path)
             except Exception as e:
@@ -225,8 +1064,19 @@ class FileCache:
                 print('ERROR: Unable to remove temp file:', str(e))
             return print('ERROR: Unable to receive stream due to exception: %s' % e)
 
+    def _blobMoveIn(self, tmp_path, sha1):
+        '''Moves the received tmp file into the blobs directory'''
+        try:
+            self._backend.store(tmp_path, sha1)
+        except Exception as e:
+            # Could happen on Windows if file is used by some process
+            print('ERROR: Unable to move file:', str(e))
+
     def blobStoreStream(self, stream, size, sha1, important = False):
         '''Store stream as blob in the cache'''
+        if hashAlgorithm(sha1) not in HASH_ALGORITHMS:
+            return print('WARN: Not supported hash algorithm of blob "%s"' % sha1)
+
         blob = self.blobUpdate(sha1)
         if 'id' in blob:
             return blob
@@ -234,26 +1084,15 @@ class FileCache:
         if not self.freeSpace(size):
             return print('WARN: Unable to find the available space for the file')
 
-        received = self._receiveStream(stream, size, sha1)
+        received = self._receiveStream(stream, size, sha1, hashAlgorithm(sha1))
         if not received:
             self.blobRemove(sha1)
             return print('ERROR: Unable to read stream')
 
         if sha1 != received[0]:
-            return print('WARN: Wrong sha1 sum for received stream "%s"' % received[0])
+            return print('WARN: Wrong checksum for received stream "%s"' % received[0])
 
-        # Moving tmp file into the blobs directory
-        blob_dir = os.path.join(self._blobs_dir, sha1[0:2])
-        os.makedirs(blob_dir, 0o700, True)
-        blob_path = os.path.join(blob_dir, sha1)
-        try:
-            # Windows will not just replace the file - so need to check if it's exist
-            if os.path.exists(blob_path):
-                os.remove(blob_path)
-            os.rename(received[1], blob_path)
-        except Exception as e:
-            # Could happen on Windows if file is used by some process
-            print('ERROR: Unable to move file:', str(e))
+        self._blobMoveIn(received[1], sha1)
 
         return self.blobUpdate(sha1, {
             'id': sha1,
@@ -261,52 +1100,395 @@ class FileCache:
             'size': size,
         })
 
+    def _calculateFileChecksum(self, path, algorithm = None):
+        '''Reads the file in place and returns the blob id'''
+        with open(path, 'rb') as f:
+            return calculateChecksum(f, algorithm or self._hash_algorithm)
+
     def blobStoreFile(self, path, important = False):
-        '''Store local file as blob in the cache'''
+        '''Store local file as blob in the cache
+
+        The file is hashed in place and hardlinked into the blobs directory, so
+        the data is not written twice. The copy is used only if the file can't
+        be linked (different filesystem or no links support). The file should
+        not be changed in place after that - replace it with rename instead.
+        '''
 
         if not os.path.isfile(path):
             return print('ERROR: Unable to store not existing file as blob')
 
         size = os.stat(path).st_size
+        try:
+            sha1 = self._calculateFileChecksum(path)
+        except Exception as e:
+            return print('ERROR: Unable to read file "%s": %s' % (path, e))
+
+        blob = self.blobUpdate(sha1)
+        if 'id' in blob:
+            return blob
+
+        try:
+            self._backend.storeLink(path, sha1)
+        except OSError as e:
+            print('DEBUG: Unable to link file "%s" into cache, copying: %s' % (path, e))
+            if not self.freeSpace(size):
+                self.blobRemove(sha1)
+                return print('WARN: Unable to find the available space for the file')
+
+            received = None
+            with open(path, 'rb') as f:
+                received = self._receiveStream(f, size, sha1, self._hash_algorithm)
+            if not received:
+                self.blobRemove(sha1)
+                return print('ERROR: Unable to read stream')
+            if sha1 != received[0]:
+                self.blobRemove(sha1)
+                return print('ERROR: File "%s" was changed during storing' % path)
+
+            self._blobMoveIn(received[1], sha1)
+
+        return self.blobUpdate(sha1, {
+            'id': sha1,
+            'dnd': important,
+            'size': size,
+        })
+
+    def blobStoreDownload(self, download_func, size, sha1, important = False):
+        '''Store blob downloaded by the function which writes the file to the provided path'''
+        if hashAlgorithm(sha1) not in HASH_ALGORITHMS:
+            return print('WARN: Not supported hash algorithm of blob "%s"' % sha1)
+
+        blob = self.blobUpdate(sha1)
+        if 'id' in blob:
+            return blob
+
         if not self.freeSpace(size):
+            self.blobRemove(sha1)
             return print('WARN: Unable to find the available space for the file')
 
-        received = None
-        with open(path, 'rb') as f:
-            received = self._receiveStream(f, size, path)
+        tmp_path = os.path.join(self._tmp_dir, 'download' + self._safe_pattern.sub('', sha1))
+        try:
+            if not download_func(tmp_path) or os.path.getsize(tmp_path) != size:
+                raise Exception('download function failed')
+            received = self._calculateFileChecksum(tmp_path, hashAlgorithm(sha1))
+        except Exception as e:
+            self._receivedData(size, False)
+            self.blobRemove(sha1)
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            return print('ERROR: Unable to download blob "%s": %s' % (sha1, e))
+        self._receivedData(size)
+
+        if sha1 != received:
+            os.remove(tmp_path)
+            self.blobRemove(sha1)
+            return print('WARN: Wrong checksum for downloaded blob "%s"' % received)
+
+        self._blobMoveIn(tmp_path, sha1)
+
+        return self.blobUpdate(sha1, {
+            'id': sha1,
+            'dnd': important,
+            'size': size,
+        })
+
+    def readChunksIndex(self):
+        '''Loads the chunks manifests of the stored blobs'''
+        self._chunks_path = os.path.join(self._cache_dir, 'chunks.journal')
+        if not os.path.exists(self._chunks_path):
+            return
+
+        dropped = 0
+        with open(self._chunks_path, 'r') as f:
+            for line in f:
+                try:
+                    data = json.loads(line)
+                except ValueError:
+                    print('WARN: Skipping broken record in chunks journal')
+                    continue
+                if 'id' not in (self.blobGet(data.get('id')) or {}):
+                    dropped += 1
+                    continue
+                with self._chunks_lock:
+                    self._indexChunks(data['id'], data['chunks'])
+
+        if dropped:
+            # Some blobs are gone, so rewriting the journal without them
+            with self._chunks_lock:
+                tmp_path = self._chunks_path + '.tmp'
+                with open(tmp_path, 'w') as f:
+                    f.writelines([ json.dumps({'id': sha1, 'chunks': manifest}) + '\n'
+                        for sha1, manifest in self._blobs_chunks.items() ])
+                os.replace(tmp_path, self._chunks_path)
+
+        print('INFO: Found %i chunks of %i blobs in cache' % (len(self._chunks), len(self._blobs_chunks)))
+
+    def _indexChunks(self, sha1, manifest):
+        '''Adds blob chunks to the index, chunks lock should be acquired'''
+        self._blobs_chunks[sha1] = manifest
+        offset = 0
+        for chunk_id, size in manifest:
+            self._chunks[chunk_id] = (sha1, offset, size)
+            offset += size
+
+    def _addChunksIndex(self, sha1, manifest):
+        '''Stores the blob chunks manifest in the index'''
+        with self._chunks_lock:
+            self._indexChunks(sha1, manifest)
+            with open(self._chunks_path, 'a') as f:
+                f.write(json.dumps({'id': sha1, 'chunks': manifest}) + '\n')
+
+    def blobChunksGet(self, sha1):
+        '''Returns the blob content-defined chunks manifest, calculates it if needed'''
+        with self._chunks_lock:
+            if sha1 in self._blobs_chunks:
+                return self._blobs_chunks[sha1]
+
+        stream = self.blobGetStream(sha1)
+        if not stream:
+            return None
+        with stream:
+            checksum, manifest = calculateChunks(stream, hashAlgorithm(sha1))
+        if checksum != sha1:
+            return print('ERROR: Wrong checksum for the stored blob "%s"' % sha1)
+
+        self._addChunksIndex(sha1, manifest)
+        return manifest
+
+    def _chunkSource(self, chunk_id):
+        '''Returns (path, offset, size, blob id) to read the available chunk or None'''
+        path = os.path.join(self._chunks_dir, self._safe_pattern.sub('', chunk_id))
+        if os.path.exists(path):
+            return (path, 0, os.path.getsize(path), None)
+
+        with self._chunks_lock:
+            item = self._chunks.get(chunk_id)
+        if not item or 'id' not in (self.blobGet(item[0]) or {}):
+            return None
+        return (self._backend.path(item[0]), item[1], item[2], item[0])
+
+    def chunksMissing(self, chunk_ids):
+        '''Returns list of the chunk ids which are not available in the cache'''
+        return [ chunk_id for chunk_id in chunk_ids if not self._chunkSource(chunk_id) ]
+
+    def chunkStoreStream(self, stream, size, chunk_id):
+        '''Store uploaded chunk to assemble the blob from it later'''
+        if size > CHUNK_MAX_SIZE:
+            return print('WARN: Unable to store chunk bigger than %i bytes' % CHUNK_MAX_SIZE)
+        if hashAlgorithm(chunk_id) not in HASH_ALGORITHMS:
+            return print('WARN: Not supported hash algorithm of chunk "%s"' % chunk_id)
+        if self._chunkSource(chunk_id):
+            return True
+
+        if not self.freeSpace(size):
+            return print('WARN: Unable to find the available space for the chunk')
+
+        received = self._receiveStream(stream, size, 'chunk' + chunk_id, hashAlgorithm(chunk_id))
         if not received:
             return print('ERROR: Unable to read stream')
 
-        blob = self.blobUpdate(received[0])
+        if chunk_id != received[0]:
+            os.remove(received[1])
+            return print('WARN: Wrong checksum for received chunk "%s"' % received[0])
+
+        os.replace(received[1], os.path.join(self._chunks_dir, self._safe_pattern.sub('', chunk_id)))
+
+        return True
+
+    def _chunksClean(self):
+        '''Removes the uploaded chunks not assembled in time and returns the freed size'''
+        cleaned = 0
+        for name in os.listdir(self._chunks_dir):
+            path = os.path.join(self._chunks_dir, name)
+            try:
+                stat = os.stat(path)
+                if time.time() - stat.st_mtime < UPLOAD_SESSION_TTL:
+                    continue
+                os.remove(path)
+                cleaned += stat.st_size
+            except Exception as e:
+                print('WARN: Unable to remove old uploaded chunk "%s": %s' % (name, e))
+        return cleaned
+
+    def blobStoreChunks(self, manifest, sha1, important = False):
+        '''Assemble blob from the uploaded and already stored chunks'''
+        if hashAlgorithm(sha1) not in HASH_ALGORITHMS:
+            return print('WARN: Not supported hash algorithm of blob "%s"' % sha1)
+
+        blob = self.blobUpdate(sha1)
         if 'id' in blob:
             return blob
 
-        # Moving tmp file into the blobs directory
-        blob_dir = os.path.join(self._blobs_dir, received[0][0:2])
-        os.makedirs(blob_dir, 0o700, True)
-        blob_path = os.path.join(blob_dir, received[0])
+        parts = []
+        pinned = []
+        uploaded = []
         try:
-            # Windows will not just replace the file - so need to check if it's exist
-            if os.path.exists(blob_path):
-                os.remove(blob_path)
-            os.rename(received[1], blob_path)
-        except Exception as e:
-            # Could happen on Windows if file is used by some process
-            print('ERROR: Unable to move file:', str(e))
+            for chunk_id, chunk_size in manifest:
+                source = self._chunkSource(chunk_id)
+                if not source or source[2] != chunk_size:
+                    self.blobRemove(sha1)
+                    return print('ERROR: Unable to find chunk "%s" to assemble blob "%s"' % (chunk_id, sha1))
+                if not source[3]:
+                    uploaded.append(source[0])
+                elif self.blobPin(source[3]):
+                    # Source blob should not be evicted during assembling
+                    pinned.append(source[3])
+                parts.append(source[0:3])
+
+            size = sum([ part[2] for part in parts ])
+            if not self.freeSpace(size):
+                self.blobRemove(sha1)
+                return print('WARN: Unable to find the available space for the file')
 
-        return self.blobUpdate(received[0], {
-            'id': received[0],
+            stream = ChunksReader(parts)
+            received = self._receiveStream(stream, size, sha1, hashAlgorithm(sha1))
+            stream.close()
+        finally:
+            for blob_id in pinned:
+                self.blobUnpin(blob_id)
+
+        if not received:
+            self.blobRemove(sha1)
+            return print('ERROR: Unable to read chunks')
+
+        if sha1 != received[0]:
+            os.remove(received[1])
+            self.blobRemove(sha1)
+            return print('WARN: Wrong checksum for assembled chunks "%s"' % received[0])
+
+        self._blobMoveIn(received[1], sha1)
+        self._addChunksIndex(sha1, manifest)
+
+        # Uploaded chunks are available from the assembled blob now
+        for path in set(uploaded):
+            try:
+                os.remove(path)
+            except Exception as e:
+                print('WARN: Unable to remove uploaded chunk:', str(e))
+
+        return self.blobUpdate(sha1, {
+            'id': sha1,
             'dnd': important,
             'size': size,
         })
 
+    def _uploadPath(self, sha1):
+        return os.path.join(self._uploads_dir, self._safe_pattern.sub('', sha1))
+
+    def _uploadsClean(self):
+        '''Removes the abandoned partial uploads and returns the freed size'''
+        cleaned = 0
+        with self._uploads_lock:
+            for name in os.listdir(self._uploads_dir):
+                path = os.path.join(self._uploads_dir, name)
+                try:
+                    stat = os.stat(path)
+                    if name in self._uploads or time.time() - stat.st_mtime < UPLOAD_SESSION_TTL:
+                        continue
+                    os.remove(path)
+                    cleaned += stat.st_size
+                except Exception as e:
+                    print('WARN: Unable to remove old partial upload "%s": %s' % (name, e))
+        return cleaned
+
+    def uploadOffset(self, sha1):
+        '''Returns state {offset, complete} of the blob upload session'''
+        blob = self.blobGet(sha1) or {}
+        if 'id' in blob:
+            return {'offset': blob['size'], 'complete': True}
+
+        path = self._uploadPath(sha1)
+        return {'offset': os.path.getsize(path) if os.path.exists(path) else 0, 'complete': False}
+
+    def uploadStoreStream(self, stream, size, sha1, offset, total, important = False):
+        '''Store part of the blob to the partial upload, checks sha1 when it's complete
+
+        The received data is kept even if the stream was broken, so the upload
+        could be resumed from the returned offset. Returns the upload state
+        dict with the blob info when the blob is stored or None on error.
+        '''
+        if hashAlgorithm(sha1) not in HASH_ALGORITHMS:
+            return print('WARN: Not supported hash algorithm of blob "%s"' % sha1)
+
+        state = self.uploadOffset(sha1)
+        if state['complete']:
+            state['blob'] = self.blobUpdate(sha1)
+            return state
+
+        if offset > state['offset'] or offset + size > total:
+            return print('WARN: Unable to write the upload part %i:%i of %i bytes to %i' % (offset, size, total, state['offset']))
+
+        with self._uploads_lock:
+            if sha1 in self._uploads:
+                return print('WARN: Upload of "%s" is already in progress' % sha1)
+            self._uploads.add(sha1)
+
+        try:
+            if not self.freeSpace(size):
+                return print('WARN: Unable to find the available space for the upload')
+
+            path = self._uploadPath(sha1)
+            size_left = size
+            try:
+                with open(path, 'r+b' if os.path.exists(path) else 'wb') as f:
+                    f.truncate(offset)
+                    f.seek(offset)
+                    for chunk in streamChunks(stream, size):
+                        f.write(chunk)
+                        self._receivedData(len(chunk))
+                        size_left -= len(chunk)
+            except Exception as e:
+                print('WARN: Upload of "%s" was interrupted: %s' % (sha1, e))
+            self._receivedData(size_left, False)
+
+            state['offset'] = os.path.getsize(path)
+            if state['offset'] < total:
+                return state
+
+            received = self._calculateFileChecksum(path, hashAlgorithm(sha1))
+            if received != sha1:
+                os.remove(path)
+                return print('WARN: Wrong checksum for the uploaded blob "%s"' % received)
+
+            self._blobMoveIn(path, sha1)
+            state['complete'] = True
+            state['blob'] = self.blobUpdate(sha1, {
+                'id': sha1,
+                'dnd': important,
+                'size': total,
+            })
+            return state
+        finally:
+            with self._uploads_lock:
+                self._uploads.discard(sha1)
+
+    def _diskUsage(self, force = False):
+        '''Returns cached disk usage dict, updated once per second'''
+        with self._disk_usage_lock:
+            if force or not self._disk_usage or time.time() - self._disk_usage_time > 1.0:
+                usage = self._backend.diskUsage()
+                self._disk_usage = {'total': usage.total, 'free': usage.free}
+                self._disk_usage_time = time.time()
+            return self._disk_usage.copy()
+
+    def getHashAlgorithm(self):
+        '''Content hash algorithm used for the new blobs'''
+        return self._hash_algorithm
+
     def getTotalSpace(self):
         '''Total cache space in bytes'''
-        return shutil.disk_usage(self._cache_dir).total
+        return self._diskUsage()['total']
 
     def getAvailableSpace(self):
         '''Available cache space in bytes'''
-        return shutil.disk_usage(self._cache_dir).free
+        return self._diskUsage()['free']
+
+    def getStatus(self):
+        '''Returns the cache status information'''
+        return {
+            'blobs': self._blobsCount(),
+            'reclaimer': self.reclaimerStatus(),
+        }
 
     def workspaceCreate(self, name, files_map):
         '''Creating new workspace and link the provided files into'''
@@ -314,23 +1496,33 @@ class FileCache:
         if not ws_dir:
             return print('ERROR: Unable to create new workspace dir for "%s" in "%s"' % (name, self._workspace_dir) )
 
+        # Workspace with the same name replaces the previous one
+        self.workspaceClean(name)
         self._workspace_blobs[name] = []
 
         for f, blob in files_map.items():
-            if not self.blobGet(blob):
+            # Pin is acquired before linking, so eviction can't remove the blob file
+            if not self.blobPin(blob):
                 ws_dir.cleanup()
                 self.workspaceClean(name)
                 return print('ERROR: Unable to find the required blob "%s" for file "%s"' % (blob, f))
+            self._workspace_blobs[name].append(blob)
+
             filepath = os.path.join(ws_dir.name, f)
             dirpath = os.path.dirname(filepath)
             if not os.path.isdir(dirpath):
                 os.makedirs(dirpath, 0o700, True)
 
-            os.link(os.path.join(self._blobs_dir, blob[0:2], blob), filepath)
-            self._workspace_blobs[name].append(blob)
+            self._backend.link(blob, filepath)
 
         return ws_dir
 
     def workspaceClean(self, name):
         '''Cleans blobs locks used in the workspace'''
-        self._workspace_blobs.pop(name)
+        for blob in self._workspace_blobs.pop(name, []):
+            self.blobUnpin(blob)
+
+    def workspaceMove(self, name, new_name):
+        '''Moves blobs locks of the workspace to the other name to keep it after the name is cleaned'''
+        self.workspaceClean(new_name)
+        self._workspace_blobs[new_name] = self._workspace_blobs.pop(name, [])
@@ -5,12 +5,17 @@
 Description: Render manager for agent workers
 '''
 
+import os
+import json # Used in the results memo save/load
+import time # Prefetch watcher sleeps between checks
 import threading # Sync between threads needed
+import random # Spread the blob downloads between the peers
 
 from .ManagerTask import ManagerTask
 from . import providers
 from .TaskExecutorBase import TaskExecutorConfig, TaskExecutorBase
 from .ManagerAgentWorker import ManagerAgentWorker
+from .FileCache import blobStoragePath
 
 class ManagerConfig(TaskExecutorConfig):
     def __init__(self, parent, init = {}):
@@ -59,6 +64,11 @@ class ManagerConfig(TaskExecutorConfig):
             'max': 65535,
             'default': 9443,
         }
+        self._defs['agent_listen_plaintext'] = {
+            'description': '''Agents serve without TLS (only for the trusted private network)''',
+            'type': bool,
+            'default': False,
+        }
         self._defs['agent_auth_user'] = {
             'description': '''Agent auth user name''',
             'type': str,
@@ -81,14 +91,70 @@ class ManagerConfig(TaskExecutorConfig):
             'max': 32,
             'default': 4,
         }
+        self._defs['agent_upload_chunked'] = {
+            'description': '''Upload big files to Agent as content-defined chunks to skip the known ones''',
+            'type': bool,
+            'default': True,
+        }
+        self._defs['agent_blobs_storage_url'] = {
+            'description': '''Storage URL to publish task files for Agents to download them in parallel (empty - upload to each Agent)''',
+            'type': str,
+            'default': '',
+        }
+        self._defs['agent_blobs_peers'] = {
+            'description': '''Agents download task files from the other Agents which already have them''',
+            'type': bool,
+            'default': False,
+        }
+        self._defs['blobs_cold_tier'] = {
+            'description': '''Archive the evicted blobs in provider storage and fetch them back when needed''',
+            'type': bool,
+            'default': False,
+        }
+        self._defs['results_memoize'] = {
+            'description': '''Reuse the results of the tasks and workloads with the same inputs''',
+            'type': bool,
+            'default': True,
+        }
+        self._defs['agent_pipeline'] = {
+            'description': '''Send the next workload to Agent while the current one is rendering''',
+            'type': bool,
+            'default': True,
+        }
+        self._defs['agent_prefetch'] = {
+            'description': '''Send files of the next pending task to Agents in background''',
+            'type': bool,
+            'default': True,
+        }
 
         super().__init__(parent, init)
 
 class Manager(TaskExecutorBase, providers.Manager):
+    _blobs_shared_owner = True
+
     def __init__(self, conf):
         print('DEBUG: Creating Manager instance')
         TaskExecutorBase.__init__(self, ManagerTask, ManagerConfig(self, conf))
 
+        if self._cfg.blobs_cold_tier and self._cfg.storage_url:
+            self._fc.coldTierSet(
+                lambda path, sha1: providers.uploadFileToStorage(path, self._cfg.storage_url, 'blobs_cold/' + blobStoragePath(sha1)),
+                lambda sha1, path: providers.downloadFileFromStorage(self._cfg.storage_url, 'blobs_cold/' + blobStoragePath(sha1), path),
+            )
+
+        # Blobs uploaded to the agents blobs storage {id: True or Event if uploading}
+        self._blobs_published_lock = threading.Lock()
+        self._blobs_published = {}
+
+        # Tracker of the blobs available on the agents {id: set(agent_name)}
+        self._blobs_peers_lock = threading.Lock()
+        self._blobs_peers = {}
+        # Agents receiving the blobs from Manager to share them {id: agent_name}
+        self._blobs_seeding = {}
+
+        # Agents waiting for the workload to be taken by the agents with the task files {name: time}
+        self._workload_waits = {}
+
         self._agents_pool_lock = threading.Lock()
         self._agents_pool = []
         self._agentsPoolSetup()
@@ -101,6 +167,15 @@ class Manager(TaskExecutorBase, providers.Manager):
 
         providers.Manager.__init__(self)
 
+        # Index of the stored results by the task or workload inputs fingerprint
+        self._results_memo_lock = threading.Lock()
+        self._results_memo = {}
+        self.resultsMemoLoad()
+
+        self._prefetch_watcher = threading.Thread(target=self._prefetchWatcher)
+        self._prefetch_watcher.daemon = True
+        self._prefetch_watcher.start()
+
         self.tasksLoad()
         print('DEBUG: Created Manager instance')
 
@@ -139,10 +214,15 @@ class Manager(TaskExecutorBase, providers.Manager):
             'instance_max_price': self._cfg.agent_instance_max_price,
             'listen_host': self._cfg.agent_listen_host,
             'listen_port': self._cfg.agent_listen_port,
+            'listen_plaintext': self._cfg.agent_listen_plaintext,
             'auth_user': self._cfg.agent_auth_user,
             'auth_password': self._cfg.agent_auth_password,
             'instance_prefix': self._cfg.agent_instance_prefix,
             'upload_workers': self._cfg.agent_upload_workers,
+            'upload_chunked': self._cfg.agent_upload_chunked,
+            'blobs_storage_url': self._cfg.agent_blobs_storage_url,
+            'blobs_peers': self._cfg.agent_blobs_peers,
+            'pipeline': self._cfg.agent_pipeline,
         }
         with self._agents_pool_lock:
             if len(self._agents_pool) < self._cfg.agents_max:
@@ -151,6 +231,182 @@ class Manager(TaskExecutorBase, providers.Manager):
             elif len(self._agents_pool) > self._cfg.agents_max:
                 pass # TODO: it should not remove the active agents, but just mark them to remove later
 
+    def _prefetchWatcher(self):
+        '''Requests agents to receive the files of the next pending task in background'''
+        while self._enabled:
+            tasks = self.tasksPending()
+            if tasks and self._cfg.agent_prefetch:
+                task = tasks[0]
+                with self._agents_pool_lock:
+                    agents = [ agent for agent in self._agents_pool if agent.isActive() ]
+                # The idle agents will take the task first
+                agents.sort(key=lambda agent: agent.busy())
+                for agent in agents[:task._cfg.agents_num or len(agents)]:
+                    agent.prefetchFiles(task.filesGet().values())
+            time.sleep(5.0)
+
+    def resultsMemoLoad(self):
+        '''Load the results memo index from disk'''
+        path = os.path.join(self._tasks_dir, 'results_memo.index')
+        if not os.path.exists(path):
+            return
+        try:
+            with open(path, 'r') as f:
+                with self._results_memo_lock:
+                    self._results_memo = json.load(f)
+            print('INFO: Found %s stored results in memo index' % len(self._results_memo))
+        except Exception as e:
+            print('ERROR: Unable to load results memo index "%s": %s' % (path, e))
+
+    def _resultsMemoSave(self):
+        '''Save the results memo index to disk'''
+        os.makedirs(self._tasks_dir, 0o700, True)
+        path = os.path.join(self._tasks_dir, 'results_memo.index')
+        try:
+            with self._results_memo_lock:
+                with open(path + '.tmp', 'w') as f:
+                    json.dump(self._results_memo, f)
+                os.replace(path + '.tmp', path)
+        except Exception as e:
+            print('ERROR: Unable to save results memo index "%s": %s' % (path, e))
+
+    def resultsMemoGet(self, fingerprint):
+        '''Returns the stored results {name: blob_id} of the same inputs or None'''
+        with self._results_memo_lock:
+            results = self._results_memo.get(fingerprint)
+        if not results:
+            return None
+
+        if self._fc.blobsMissing(results.values()):
+            print('DEBUG: Stored results for "%s" are not available anymore' % fingerprint)
+            with self._results_memo_lock:
+                self._results_memo.pop(fingerprint, None)
+            self._resultsMemoSave()
+            return None
+
+        return results
+
+    def resultsMemoSet(self, fingerprint, results):
+        '''Stores the results {name: blob_id} of the inputs fingerprint'''
+        with self._results_memo_lock:
+            if self._results_memo.get(fingerprint) == results:
+                return
+            self._results_memo[fingerprint] = results
+        self._resultsMemoSave()
+
+    def agentsIdle(self, exclude = None):
+        '''Returns list of the active agents without work'''
+        with self._agents_pool_lock:
+            return [ agent for agent in self._agents_pool if agent is not exclude
+                and agent.isActive() and not agent.busy() and not agent.status().get('terminating') ]
+
+    def workloadAgentWait(self, agent, task, timeout = 30):
+        '''Returns True if the task workloads should be left to the idle agents with less files to upload'''
+        workloads_left = task.workloadsLeft()
+        if workloads_left < 1:
+            return False
+
+        agents = self.agentsIdle(agent)
+
+        wait = False
+        if len(agents) >= workloads_left:
+            files = task.filesGet().values()
+            cost = agent.missingSize(files)
+            wait = cost and len([ a for a in agents if a.missingSize(files) < cost ]) >= workloads_left
+
+        if not wait:
+            self._workload_waits.pop(agent.name(), None)
+            return False
+
+        # The other agents could not take the workload, so waiting is limited
+        since = self._workload_waits.setdefault(agent.name(), time.time())
+        if time.time() > since + timeout:
+            self._workload_waits.pop(agent.name(), None)
+            return False
+
+        return True
+
+    def blobPublish(self, sha1):
+        '''Uploads the blob to the agents blobs storage once, returns True if it's there'''
+        with self._blobs_published_lock:
+            state = self._blobs_published.get(sha1)
+            if state is None:
+                self._blobs_published[sha1] = threading.Event()
+        if state is True:
+            return True
+        if state is not None:
+            # Other agent worker is uploading the same blob
+            state.wait()
+            with self._blobs_published_lock:
+                return self._blobs_published.get(sha1) is True
+
+        result = None
+        if self._fc.blobPin(sha1):
+            try:
+                result = providers.uploadFileToStorage(self._fc.blobGetPath(sha1),
+                    self._cfg.agent_blobs_storage_url, blobStoragePath(sha1))
+            finally:
+                self._fc.blobUnpin(sha1)
+
+        with self._blobs_published_lock:
+            event = self._blobs_published.pop(sha1)
+            if result:
+                self._blobs_published[sha1] = True
+        event.set()
+
+        return bool(result)
+
+    def blobPeersAdd(self, sha1s, agent_name):
+        '''Marks the blobs as available for download from the agent'''
+        with self._blobs_peers_lock:
+            for sha1 in sha1s:
+                self._blobs_peers.setdefault(sha1, set()).add(agent_name)
+                if self._blobs_seeding.get(sha1) == agent_name:
+                    self._blobs_seeding.pop(sha1)
+
+    def blobPeersRemove(self, agent_name):
+        '''Forgets the blobs of the agent, it's storage could be wiped'''
+        with self._blobs_peers_lock:
+            for sha1, agents in list(self._blobs_peers.items()):
+                agents.discard(agent_name)
+                if not agents:
+                    self._blobs_peers.pop(sha1)
+            for sha1, seeder in list(self._blobs_seeding.items()):
+                if seeder == agent_name:
+                    self._blobs_seeding.pop(sha1)
+
+    def blobPeersGet(self, sha1, agent_name, limit = 4):
+        '''Returns connection info of random active agents having the blob'''
+        with self._blobs_peers_lock:
+            names = list(self._blobs_peers.get(sha1, set()) - {agent_name})
+        random.shuffle(names)
+
+        out = []
+        for name in names:
+            agent = self.agentGet(name)
+            if agent and agent.isActive():
+                out.append(agent.peerInfo())
+                if len(out) >= limit:
+                    break
+        return out
+
+    def blobSeed(self, sha1, agent_name):
+        '''Returns True if the agent should receive the blob from Manager to share it'''
+        with self._blobs_peers_lock:
+            seeder = self._blobs_seeding.get(sha1)
+            if seeder and seeder != agent_name:
+                agent = self.agentGet(seeder)
+                if agent and agent.isActive():
+                    return False
+            self._blobs_seeding[sha1] = agent_name
+            return True
+
+    def blobSeedRelease(self, sha1, agent_name):
+        '''Allows the other agents to seed the blob if the agent failed to receive it'''
+        with self._blobs_peers_lock:
+            if self._blobs_seeding.get(sha1) == agent_name:
+                self._blobs_seeding.pop(sha1)
+
     def agentGet(self, agent_name):
         '''Get agent worker object'''
         with self._agents_pool_lock:
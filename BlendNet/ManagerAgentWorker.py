@@ -14,6 +14,10 @@ from . import providers
 from .AgentClient import AgentClient
 from . import SimpleREST
 from .Workers import Workers
+from .FileCache import CHUNKED_MIN_SIZE
+
+# Agent could evict the blob at any time, so the known stored blobs are checked again after it
+BLOBS_HELD_TTL = 10*60
 
 class ManagerAgentState(Enum):
     UNKNOWN = 0
@@ -48,6 +52,11 @@ class ManagerAgentWorker(object):
 
         self._work_lock = threading.Lock()
         self._work = {}
+        self._work_task = None
+        # Workload waiting on the agent to be executed after the current one
+        self._work_next = {}
+        self._work_next_task = None
+        self._work_last_task = None # To continue the task with the next workload
 
         self._wait_agent_lock = threading.Lock()
 
@@ -55,9 +64,18 @@ class ManagerAgentWorker(object):
         self._download_render = {}
         self._download_preview_lock = threading.Lock()
         self._download_preview = {}
+        self._download_frames_lock = threading.Lock()
+        self._download_frames = {}
+
+        # Blobs to send to the agent in background before the task will need them
+        self._prefetch_lock = threading.Lock()
+        self._prefetch = {} # Ordered set {id: None}
+        self._blobs_held = {} # Blobs known to be stored on the agent {id: time of the check}
+        self._uploading = 0 # Prefetch is paused while workload files are uploading
 
         self._tasks_watcher = None
         self._download_watcher = None
+        self._prefetch_watcher = None
 
         self.start()
 
@@ -74,12 +92,16 @@ class ManagerAgentWorker(object):
         if not self._download_watcher:
             self._download_watcher = threading.Thread(target=self._downloadWatcher)
             self._download_watcher.start()
+        if not self._prefetch_watcher:
+            self._prefetch_watcher = threading.Thread(target=self._prefetchWatcher)
+            self._prefetch_watcher.start()
 
     def isStopped(self):
         '''To be sure the worker is completed'''
         return (not self._enabled
                 and not self._state_watcher
                 and not self._download_watcher
+                and not self._prefetch_watcher
                 and not self._tasks_watcher)
 
     def stop(self):
@@ -105,6 +127,21 @@ class ManagerAgentWorker(object):
             with self._download_render_lock:
                 to_download = getDownloadFrom(self._download_render, 'render')
 
+            if not to_download:
+                # Rendered frames of the range are the task results too
+                with self._download_frames_lock:
+                    for task_name, frame in self._download_frames:
+                        to_download = (task_name, frame, self._download_frames.pop((task_name, frame)))
+                        break
+                if to_download:
+                    self._waitAgent()
+                    ret = self._client.taskFrameResultDownloadStream(to_download[0], to_download[1], 'render', self._parent._fc.blobStoreStream)
+                    if not ret:
+                        print('ERROR: Requested download of frame %s was not retreived from the agent task "%s"' % (to_download[1], to_download[0]))
+                    else:
+                        to_download[2](to_download[0], to_download[1], ret['id'])
+                    continue
+
             if not to_download:
                 with self._download_preview_lock:
                     to_download = getDownloadFrom(self._download_preview, 'preview')
@@ -123,9 +160,69 @@ class ManagerAgentWorker(object):
         print('DEBUG: Stopped ManagerAgentWorker download watcher')
         self._download_watcher = None
 
+    def _prefetchWatcher(self):
+        '''Sends the requested blobs to the agent when it's not receiving the workload files'''
+        print('DEBUG: Starting ManagerAgentWorker "%s" prefetch watcher' % self._name)
+
+        while self._enabled:
+            to_send = []
+            if self.isActive() and not self._uploading:
+                with self._prefetch_lock:
+                    to_send = list(self._prefetch)
+                    self._prefetch.clear()
+
+            if not to_send:
+                time.sleep(1.0)
+                continue
+
+            missing = self._client.blobsMissing(to_send)
+            if not isinstance(missing, list):
+                self.prefetchFiles(to_send)
+                time.sleep(5.0)
+                continue
+            self.blobsHeldAdd(set(to_send) - set(missing))
+            self.blobsHeldRemove(missing)
+
+            print('DEBUG: Prefetching %d blobs to Agent "%s"' % (len(missing), self._name))
+            for i, sha1 in enumerate(missing):
+                if not self._enabled or self._uploading or not self.isActive():
+                    # The workload files are more important - continue later
+                    self.prefetchFiles(missing[i:])
+                    break
+                try:
+                    if self._prefetchBlob(sha1):
+                        self.blobsHeldAdd([sha1])
+                except Exception as e:
+                    # Prefetch is optional, the workload upload will send the blob anyway
+                    print('WARN: Unable to prefetch blob %s to Agent "%s": %s: %s' % (sha1, self._name, type(e), e))
+
+        print('DEBUG: Stopped ManagerAgentWorker prefetch watcher')
+        self._prefetch_watcher = None
+
+    def _prefetchBlob(self, sha1):
+        '''Sends one blob to the agent the same way as the workload files'''
+        if self._cfg.get('blobs_storage_url'):
+            self._fetchBlobs({sha1})
+        elif self._cfg.get('blobs_peers'):
+            self._fetchBlobsPeers({sha1})
+        else:
+            stream = self._parent.blobGetStream(sha1)
+            if not stream:
+                return False # The blob was removed from the Manager cache
+            with stream:
+                return self._client.blobUpload(stream, self._parent.blobGet(sha1).get('size'), sha1)
+        return self._client.blobsMissing([sha1]) == []
+
+    def prefetchFiles(self, sha1s):
+        '''Requests background sending of the blobs the agent will probably need soon'''
+        held = self._blobsHeld()
+        with self._prefetch_lock:
+            for sha1 in sha1s:
+                if sha1 not in held:
+                    self._prefetch[sha1] = None
+
     def _tasksWatcher(self):
         '''Watch on the manager's running tasks if the current task is completed'''
-        current_task = None
         last_time_had_task = None
 
         print('DEBUG: Starting ManagerAgentWorker "%s" tasks watcher' % self._name)
@@ -138,40 +235,32 @@ class ManagerAgentWorker(object):
                 continue
 
             if self.busy():
-                if not current_task.isRunning():
-                    print('WARN: Stopping the current task "%s" - manager task is not running anymore' % current_task.name())
-                    self.taskStop(self._work['task_name'])
-                    self.workEnded()
+                with self._work_lock:
+                    works = [(self._work_task, self._work), (self._work_next_task, self._work_next)]
+                for task, work in works:
+                    if work and not task.isRunning():
+                        print('WARN: Stopping the workload "%s" - manager task is not running anymore' % work['task_name'])
+                        self.taskStop(work['task_name'])
+                        self.workEnded(work['task_name'])
+
+                # Preparing the next workload on the agent while the current one is rendering
+                if self._cfg.get('pipeline') and self.busy() and not self._work_next:
+                    task, work = self._workAcquire(True)
+                    if work:
+                        with self._work_lock:
+                            self._work_next_task, self._work_next = task, work
+                        self._workStart(task, work)
+
                 time.sleep(1.0)
                 last_time_had_task = time.time()
                 continue
 
-            # Try to continue the current task
-            if current_task:
-                with self._work_lock:
-                    self._work = current_task.acquireWorkload(self)
-
-            if not self._work:
-                # Going through tasks from old to new to get some work
-                tasks = self._parent.tasksRunning()
-                for task in tasks:
-                    with self._work_lock:
-                        self._work = task.acquireWorkload(self)
-                    if self._work:
-                        current_task = task
-                        break
-
-            if self._work:
+            task, work = self._workAcquire()
+            if work:
                 last_time_had_task = time.time()
-                print('DEBUG: New workload for "%s": %s' % (self._name, self._work))
-                # Upload deps anyway - who knows, maybe agent was destroyed
-                # It will take not long time if files are already uploaded
-                if not self.uploadFiles(self._work['task_name'], current_task.filesGet()):
-                    current_task.stateError({self._work['task_name']: 'Unable to upload the required files'})
-                    self.workEnded()
-                    continue
-                self.sendWorkload(self._work['task_name'], self._work)
-                self.runWorkload(self._work['task_name'])
+                with self._work_lock:
+                    self._work_task, self._work = task, work
+                self._workStart(task, work)
             elif last_time_had_task and time.time() > last_time_had_task + 300:
                 print('WARN: Stopping the agent "%s" - there was no tasks for 5 mins' % self._name)
                 providers.stopInstance(self._id)
@@ -181,6 +270,44 @@ class ManagerAgentWorker(object):
         print('DEBUG: Stopped ManagerAgentWorker tasks watcher')
         self._tasks_watcher = None
 
+    def _workAcquire(self, ahead = False):
+        '''Looks for a workload in the running tasks, returns (task, workload)'''
+        with self._work_lock:
+            current_task = self._work_next_task or self._work_task or self._work_last_task
+
+        # Trying to continue the current task, next the ones with less files to upload
+        tasks = sorted(self._parent.tasksRunning(), key=lambda task: (
+            task is not current_task,
+            self.missingSize(task.filesGet().values()),
+            task._create_time,
+        ))
+        for task in tasks:
+            if ahead:
+                # The idle agents should get the workloads first
+                if task.workloadsLeft() <= len(self._parent.agentsIdle(self)):
+                    continue
+            elif self._parent.workloadAgentWait(self, task):
+                continue
+            work = task.acquireWorkload(self)
+            if work:
+                return task, work
+
+        return None, {}
+
+    def _workStart(self, task, work):
+        '''Sends the workload files and config to the agent and runs it'''
+        print('DEBUG: New workload for "%s": %s' % (self._name, work))
+        # Upload deps anyway - who knows, maybe agent was destroyed
+        # Only the blobs missing on the agent will be sent
+        if not self.uploadFiles(work['task_name'], task.filesGet()):
+            task.stateError({work['task_name']: 'Unable to upload the required files'})
+            self.workEnded(work['task_name'])
+            return False
+        self.sendWorkload(work['task_name'], work)
+        # Agent will start the workload right after the current one
+        self.runWorkload(work['task_name'])
+        return True
+
     def _activateStateWatcher(self):
         '''Will watch the agent state until it will be lower than STARTED'''
         with self._state_lock:
@@ -233,6 +360,9 @@ class ManagerAgentWorker(object):
             agent = self._parent.resourcesGet().get('agents', {}).get(self._name, {})
             if not agent or not agent.get('internal_ip'):
                 self._setState(ManagerAgentState.DESTROYED)
+                self._parent.blobPeersRemove(self._name)
+                with self._prefetch_lock:
+                    self._blobs_held.clear()
                 self._client = None
                 with self._status_lock:
                     self._status = {}
@@ -300,6 +430,42 @@ class ManagerAgentWorker(object):
         print('DEBUG: Uploading %d files to Agent "%s" task "%s"' % (len(files_map), self._name, task_name))
         self._waitAgent()
 
+        with self._prefetch_lock:
+            self._uploading += 1
+        try:
+            return self._uploadFiles(task_name, files_map)
+        finally:
+            with self._prefetch_lock:
+                self._uploading -= 1
+
+    def _uploadFiles(self, task_name, files_map):
+        '''Sends only the task files missing on the Agent'''
+
+        if self._cfg.get('blobs_storage_url'):
+            # Agent downloads the blobs from storage, the failed ones will be uploaded
+            self._fetchBlobs(set(files_map.values()))
+        elif self._cfg.get('blobs_peers'):
+            # Agent downloads the blobs from the other agents, the failed ones will be uploaded
+            self._fetchBlobsPeers(set(files_map.values()))
+
+        # Agent could already have the blobs from the previous workloads or tasks
+        missing = self._client.blobsMissing(set(files_map.values()))
+        if isinstance(missing, list):
+            missing = set(missing)
+            self.blobsHeldAdd(set(files_map.values()) - missing)
+            self.blobsHeldRemove(missing)
+            if self._cfg.get('blobs_peers'):
+                self._parent.blobPeersAdd(set(files_map.values()) - missing, self._name)
+            refs = { path: sha1 for path, sha1 in files_map.items() if sha1 not in missing }
+            failed = self._client.taskFilesRefPut(task_name, refs) if refs else []
+            if isinstance(failed, list):
+                files_map = { path: sha1 for path, sha1 in files_map.items() if sha1 in missing or path in failed }
+                print('DEBUG: Agent "%s" task "%s" files added by reference: %d, to upload: %d' % (
+                    self._name, task_name, len(refs) - len(failed), len(files_map)
+                ))
+                if not files_map:
+                    return True
+
         workers = Workers(
             'Uploading to Agent "%s" task "%s"' % (self._name, task_name),
             self._cfg['upload_workers'],
@@ -309,17 +475,151 @@ class ManagerAgentWorker(object):
         workers.addSet(set( (task_name, path, sha1) for path, sha1 in files_map.items() ))
         if workers.wait():
             print('DEBUG: Uploading files to Agent "%s" task "%s" completed' % (self._name, task_name))
+            self.blobsHeldAdd(files_map.values())
+            if self._cfg.get('blobs_peers'):
+                self._parent.blobPeersAdd(set(files_map.values()), self._name)
             return True
 
         print('ERROR: Unable to upload task "%s" files: %s' % (task_name, workers.tasksFailed()))
         return False
 
+    def _fetchBlobs(self, sha1s):
+        '''Publishes the blobs missing on the Agent to the storage and waits for Agent to fetch them'''
+        missing = self._client.blobsMissing(sha1s)
+        if not isinstance(missing, list) or not missing:
+            return
+
+        workers = Workers(
+            'Publishing blobs for Agent "%s"' % self._name,
+            self._cfg['upload_workers'],
+            lambda sha1: None if self._parent.blobPublish(sha1) else sha1,
+        )
+        workers.addSet(set( (sha1,) for sha1 in missing ))
+        workers.wait()
+
+        blobs = {}
+        for sha1 in set(missing) - set(workers.tasksFailed()):
+            blob = self._parent.blobGet(sha1)
+            if blob:
+                blobs[sha1] = blob.get('size')
+        print('DEBUG: Agent "%s" fetching %d blobs from storage' % (self._name, len(blobs)))
+        stalled_since = time.time()
+        left = len(blobs)
+        while self._enabled and blobs:
+            state = self._client.blobsFetch(self._cfg['blobs_storage_url'], blobs)
+            if isinstance(state, dict):
+                for sha1 in state.get('failed', []):
+                    print('WARN: Agent "%s" was unable to fetch blob "%s"' % (self._name, sha1))
+                    blobs.pop(sha1, None)
+                blobs = { sha1: blobs[sha1] for sha1 in state.get('missing', []) if sha1 in blobs }
+            if len(blobs) < left:
+                left = len(blobs)
+                stalled_since = time.time()
+            elif time.time() > stalled_since + 1800:
+                print('WARN: Agent "%s" fetching of %d blobs is stalled, uploading them' % (self._name, left))
+                return
+            if blobs:
+                time.sleep(1.0)
+
+    def _fetchBlobsPeers(self, sha1s):
+        '''Gets the blobs missing on the Agent from the other agents or seeds them from Manager'''
+        missing = self._client.blobsMissing(sha1s)
+        if not isinstance(missing, list):
+            return
+        self._parent.blobPeersAdd(set(sha1s) - set(missing), self._name)
+
+        fails = dict( (sha1, 0) for sha1 in missing )
+        stalled_since = time.time()
+        left = len(fails)
+        while self._enabled and fails:
+            blobs = {}
+            peers = {}
+            for sha1 in list(fails):
+                blob = self._parent.blobGet(sha1)
+                if not blob:
+                    fails.pop(sha1) # The blob was removed from the Manager cache
+                    continue
+                peers[sha1] = self._parent.blobPeersGet(sha1, self._name)
+                if peers[sha1]:
+                    blobs[sha1] = blob.get('size')
+                elif self._parent.blobSeed(sha1, self._name):
+                    # Nobody have the blob - so this agent will share it with others
+                    fails.pop(sha1)
+                    stream = self._parent.blobGetStream(sha1)
+                    if not stream:
+                        self._parent.blobSeedRelease(sha1, self._name)
+                        continue
+                    with stream:
+                        if self._client.blobUpload(stream, blob.get('size'), sha1):
+                            self._parent.blobPeersAdd([sha1], self._name)
+                        else:
+                            self._parent.blobSeedRelease(sha1, self._name)
+                # Otherwise waiting for the other agent to receive the blob
+
+            state = self._client.blobsFetch(None, blobs, { sha1: peers[sha1] for sha1 in blobs }) if blobs else None
+            if isinstance(state, dict):
+                missing = set(state.get('missing', []))
+                for sha1 in state.get('failed', []):
+                    fails[sha1] += 1
+                    if fails[sha1] >= 3:
+                        print('WARN: Agent "%s" was unable to fetch blob "%s" from peers' % (self._name, sha1))
+                        fails.pop(sha1)
+                for sha1 in set(blobs) - missing - set(state.get('failed', [])):
+                    self._parent.blobPeersAdd([sha1], self._name)
+                    fails.pop(sha1, None)
+            if len(fails) < left:
+                left = len(fails)
+                stalled_since = time.time()
+            elif time.time() > stalled_since + 1800:
+                print('WARN: Agent "%s" fetching of %d blobs from peers is stalled, uploading them' % (self._name, left))
+                return
+            if fails:
+                time.sleep(1.0)
+
+    def blobsHeldAdd(self, sha1s):
+        '''Marks the blobs as stored on the agent'''
+        now = time.time()
+        with self._prefetch_lock:
+            self._blobs_held.update([ (sha1, now) for sha1 in sha1s ])
+
+    def blobsHeldRemove(self, sha1s):
+        '''Marks the blobs as not stored on the agent, it could evict them'''
+        with self._prefetch_lock:
+            for sha1 in sha1s:
+                self._blobs_held.pop(sha1, None)
+
+    def _blobsHeld(self):
+        '''Returns set of the blobs stored on the agent, the outdated records are removed'''
+        outdated = time.time() - BLOBS_HELD_TTL
+        with self._prefetch_lock:
+            for sha1 in [ sha1 for sha1, checked in self._blobs_held.items() if checked < outdated ]:
+                self._blobs_held.pop(sha1)
+            return set(self._blobs_held)
+
+    def missingSize(self, sha1s):
+        '''Returns size of the blobs the agent will need to receive'''
+        missing = set(sha1s) - self._blobsHeld()
+        return sum([ (self._parent.blobGet(sha1) or {}).get('size', 0) for sha1 in missing ])
+
+    def peerInfo(self):
+        '''Returns address of the agent for the other agents to download blobs, the pool shares credentials'''
+        return {
+            'address': self._client._address if self._client else None,
+            'port': self._cfg.get('listen_port'),
+        }
+
     def _uploadFilesWorker(self, task, rel_path, sha1):
         '''Gets item and uploads using client'''
         while self._enabled:
             size = self._parent.blobGet(sha1).get('size')
+            manifest = None
+            if self._cfg.get('upload_chunked') and size >= CHUNKED_MIN_SIZE:
+                manifest = self._parent.blobChunksGet(sha1)
             with self._parent.blobGetStream(sha1) as stream:
-                ret = self._client.taskFileStreamPut(task, rel_path, stream, size, sha1)
+                if manifest:
+                    ret = self._client.taskFileChunksPut(task, rel_path, stream, manifest, sha1)
+                else:
+                    ret = self._client.taskFileStreamPut(task, rel_path, stream, size, sha1)
                 if ret:
                     break
                 print('WARN: Uploading of "%s" to task "%s" failed, repeating...' % (rel_path, task))
@@ -359,10 +659,17 @@ class ManagerAgentWorker(object):
         with self._work_lock:
             return self._work.copy()
 
-    def workEnded(self):
-        '''ManagerTask marking agent as available again'''
+    def workEnded(self, task_name = None):
+        '''ManagerTask marking agent workload as ended, the next workload becomes current'''
         with self._work_lock:
-            self._work = {}
+            if task_name and task_name == self._work_next.get('task_name'):
+                self._work_next_task, self._work_next = None, {}
+                return
+            if task_name and task_name != self._work.get('task_name'):
+                return # Already ended
+            self._work_last_task = self._work_task or self._work_last_task
+            self._work_task, self._work = self._work_next_task, self._work_next
+            self._work_next_task, self._work_next = None, {}
 
     def taskStatus(self, task_name):
         '''Requesting the task status from agent'''
@@ -397,3 +704,8 @@ class ManagerAgentWorker(object):
         '''Put new request to download a current render image from the agent task'''
         with self._download_render_lock:
             self._download_render[task_name] = callback
+
+    def requestFrameDownload(self, task_name, frame, callback):
+        '''Put new request to download a render image of the frame from the agent task'''
+        with self._download_frames_lock:
+            self._download_frames[(task_name, frame)] = callback
@@ -14,6 +14,11 @@ from .Client import (
     Client,
     ClientEngine,
 )
+from .FileCache import (
+    CHUNKED_MIN_SIZE,
+    calculateChecksum,
+    calculateChunks,
+)
 
 class ManagerClient(Client):
     _engine = None
@@ -22,6 +27,9 @@ class ManagerClient(Client):
         if not ManagerClient._engine:
             ManagerClient._engine = ClientEngine(address, cfg)
         else:
+            if ManagerClient._engine._address != address:
+                # Another Manager could prefer another hash algorithm
+                ManagerClient._engine._blob_hash = None
             ManagerClient._engine._address = address
             ManagerClient._engine._cfg = cfg
 
@@ -58,16 +66,13 @@ class ManagerClient(Client):
         return self._engine.get('agent/%s/log' % (urllib.parse.quote(agent_name),))
 
     def calculateChecksum(self, stream):
-        '''Will calculate and redurn checksum and reset stream'''
-        import hashlib
-        sha1_calc = hashlib.sha1()
-        for chunk in iter(lambda: stream.read(1048576), b''):
-            sha1_calc.update(chunk)
+        '''Will calculate and redurn checksum with the Manager hash algorithm and reset stream'''
+        checksum = calculateChecksum(stream, self.blobHash())
         stream.seek(0)
-        return sha1_calc.hexdigest()
+        return checksum
 
-    def taskFilePut(self, task, file_path, rel_path):
-        '''Send file to the task file'''
+    def taskFilePut(self, task, file_path, rel_path, checksum = None):
+        '''Send file to the task file, the checksum is calculated if it's not provided'''
         if not os.path.isfile(file_path):
             print('ERROR: Unable to send not existing file "%s"' % file_path)
             return None
@@ -75,8 +80,23 @@ class ManagerClient(Client):
         size = os.path.getsize(file_path)
 
         with open(file_path, 'rb') as f:
-            return self.taskFileStreamPut(task, rel_path, f, size, self.calculateChecksum(f))
+            if size >= CHUNKED_MIN_SIZE:
+                # Big files could be almost the same as already uploaded ones
+                checksum, manifest = calculateChunks(f, self.blobHash())
+                return self.taskFileChunksPut(task, rel_path, f, manifest, checksum)
+            return self.taskFileStreamPut(task, rel_path, f, size, checksum or self.calculateChecksum(f))
+
+    def taskExtend(self, task, source_task, samples):
+        '''Create the task continuing the completed source task with more samples'''
+        path = 'task/%s/extend' % task
+        data = json.dumps({'task': source_task, 'samples': samples})
+
+        return self._engine.put(path, StringIO(data), len(data))
 
     def taskResultDownload(self, task, result, out_path):
         '''Will download result name (preview/render) into the file'''
         return self._engine.download('task/%s/status/result/%s' % (task, result), out_path)
+
+    def taskFrameResultDownload(self, task, frame, result, out_path):
+        '''Will download result name (render/compose) of the task frame into the file'''
+        return self._engine.download('task/%s/status/frame/%s/%s' % (task, frame, result), out_path)
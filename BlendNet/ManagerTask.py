@@ -7,11 +7,14 @@ Description: Task used by Manager to control jobs
 
 import os
 import time
+import json # Used to serialize the task inputs
+import hashlib # Calculate the task inputs fingerprint
 import threading
 import subprocess
 import statistics # Calculate good remaining time
 
 from .TaskBase import TaskConfig, TaskState, TaskBase
+from .FileCache import blobFileName
 
 class ManagerTaskConfig(TaskConfig):
     def __init__(self, parent):
@@ -27,6 +30,30 @@ class ManagerTaskConfig(TaskConfig):
             'type': bool,
             'default': True,
         }
+        self._defs['workload_overhead'] = {
+            'description': '''Target percent of the agent workload time spent on preparation (0 - use fixed workload size, ignored with `results_memoize`)''',
+            'type': int,
+            'min': 0,
+            'max': 90,
+            'default': 10,
+        }
+        self._defs['speculation_threshold'] = {
+            'description': '''Percent of the median workload render time left on agent to run the duplicate (0 - disabled)''',
+            'type': int,
+            'min': 0,
+            'default': 200,
+        }
+        self._defs['split_mode'] = {
+            'description': '''How to split the task between agents: by "samples" or by image "regions"''',
+            'type': str,
+            'validation': lambda cfg, val: val in ('samples', 'regions'),
+            'default': 'samples',
+        }
+        self._defs['resolution_y'] = {
+            'description': '''Height of the rendered image in pixels, required to split by image regions''',
+            'type': int,
+            'min': 1,
+        }
         self._defs['compose_filepath'] = {
             'description': '''Where to place the task compose result on the Addon side''',
             'type': str,
@@ -47,8 +74,16 @@ class ManagerTask(TaskBase):
                 'workloads_taken': self._status.get('workloads_taken', 0), # How much agent tasks was taken
                 'results_processing': self._status.get('results_processing'), # While results still processing task can't be completed
                 'compose_filepath': self._status.get('compose_filepath'), # Composed image filepath to store the image on the Addon
+                'frames_todo': self._status.get('frames_todo'), # Frames of the range left to acquire by agents
+                'frames_acquired': self._status.get('frames_acquired', {}), # Frames of the range taken by agent tasks
+                'regions_todo': self._status.get('regions_todo'), # Rows ranges of the image left to acquire by agents
+                'regions_acquired': self._status.get('regions_acquired', {}), # Rows ranges taken by agent tasks
+                'speculative_todo': self._status.get('speculative_todo', []), # Straggling agent tasks waiting for duplicate
+                'speculations': self._status.get('speculations', {}), # Straggling agent tasks and their duplicates
+                'speculation_losers': self._status.get('speculation_losers', []), # Agent tasks with discarded results
             })
             self._status['result']['compose'] = self._status['result'].get('compose', None) # Blob ID of the composed image
+            self._status['result']['frames'] = self._status['result'].get('frames', {}) # Results of the range frames
 
         # Task executions by agents
         self._executions = {}
@@ -60,11 +95,18 @@ class ManagerTask(TaskBase):
         self._results_preview = data.get('results_preview', {})
         self._results_render_lock = threading.Lock()
         self._results_render = data.get('results_render', {})
+        self._results_frames_lock = threading.Lock()
+        self._results_frames = data.get('results_frames', {})
         self._results_watcher = None
 
         self._results_to_remove_lock = threading.Lock()
         self._results_to_remove = set()
 
+        # Workloads completed from the stored results, moved to statuses by execution watcher
+        self._executions_memoized = {}
+        # Workloads which renders are already stored in the results memo
+        self._workloads_memoized = set()
+
         self._stop_task = False # Used to stop the task
         print('DEBUG: Created Manager task', name)
 
@@ -75,9 +117,158 @@ class ManagerTask(TaskBase):
             'execution_status': self._execution_status.copy(),
             'results_preview': self._results_preview.copy(),
             'results_render': self._results_render.copy(),
+            'results_frames': self._results_frames.copy(),
         })
         return out
 
+    def isFramesTask(self):
+        '''The frames range task is split by frames instead of samples'''
+        return self._cfg.frame_end is not None
+
+    def isRegionsTask(self):
+        '''The regions task is split by image rows instead of samples'''
+        return self._cfg.split_mode == 'regions' and not self.isFramesTask()
+
+    def check(self):
+        if self.isRegionsTask() and not self._cfg.resolution_y:
+            self.stateError({self.name(): 'Split by image regions requires `resolution_y`'})
+        return super().check()
+
+    def samplesTotal(self):
+        '''Returns how much samples to render, the regions task counts the samples of each image row'''
+        if self.isRegionsTask():
+            return self._cfg.samples * self._cfg.resolution_y
+        return super().samplesTotal()
+
+    def fingerprint(self, configs = {}):
+        '''Returns deterministic id of the task inputs - files, configs and blender version'''
+        cfg = self.configsGet()
+        # Those are not changing the task result
+        cfg.pop('agents_num', None)
+        cfg.pop('workload_overhead', None)
+        cfg.pop('speculation_threshold', None)
+        cfg.pop('compose_filepath', None)
+        cfg.update(configs)
+        data = json.dumps({
+            'files': self.filesGet(),
+            'config': cfg,
+            'dist_checksum': self._parent._cfg.dist_checksum,
+        }, sort_keys=True)
+        return hashlib.sha1(data.encode('utf-8')).hexdigest()
+
+    def workloadFingerprint(self, seed, samples):
+        '''Returns deterministic id of the agent workload inputs'''
+        return self.fingerprint({'seed': seed, 'samples': samples, 'workload': True})
+
+    def _memoizedComplete(self):
+        '''Completes the task by the stored results of the same inputs task'''
+        if self._execution_status or self._status['result']['render']:
+            return False # Task was already executed - continue it regular way
+
+        results = self._parent.resultsMemoGet(self.fingerprint())
+        if not results:
+            return False
+
+        print('INFO: Task "%s" inputs were already rendered - using the stored results' % self.name())
+        with self._status_lock:
+            self._status['result'].update({
+                'preview': results['render'],
+                'render': results['render'],
+                'compose': results['compose'],
+            })
+            self._status['samples_done'] = self._cfg.samples
+            self._status['samples_acquired'] = self._cfg.samples
+            self._status['remaining'] = 0
+        self.stateComplete()
+        return True
+
+    def _workloadMemoized(self, workload):
+        '''Completes the workload by the stored render instead of sending it to agent'''
+        results = self._parent.resultsMemoGet(self.workloadFingerprint(workload['seed'], workload['samples']))
+        if not results:
+            return False
+
+        print('INFO: Workload "%s" was already rendered - using the stored render' % workload['task_name'])
+        with self._execution_lock:
+            self._executions_memoized[workload['task_name']] = {
+                'name': workload['task_name'],
+                'state': TaskState.COMPLETED.name,
+                'samples': workload['samples'],
+                'samples_done': workload['samples'],
+                'seed': workload['seed'],
+                'result': {'render': results['render']},
+            }
+        # Status lock is held by the workload acquire, so the speculation is not checked
+        self.updatePreview(workload['task_name'], results['render'], memoized=True)
+        self.updateRender(workload['task_name'], results['render'], memoized=True)
+        return True
+
+    def _workloadsMemoize(self):
+        '''Stores renders of the completed workloads to reuse them for the same inputs'''
+        with self._results_render_lock:
+            renders = self._results_render.copy()
+        for task_name, status in self._execution_status.items():
+            if (task_name in self._workloads_memoized
+                or status.get('state') != TaskState.COMPLETED.name
+                or not renders.get(task_name)
+                or status.get('seed') is None
+                or status.get('samples_done') != status.get('samples')):
+                continue
+            self._workloads_memoized.add(task_name)
+            self._parent.resultsMemoSet(self.workloadFingerprint(status['seed'], status['samples']), {
+                'render': renders[task_name],
+            })
+
+    def extendFrom(self, task, samples):
+        '''Continues the completed task with more samples reusing its renders'''
+        if not self.canBeChanged():
+            return print('WARN: Unable to change the task once started')
+        if not task.isCompleted():
+            return print('WARN: Unable to extend not completed task "%s"' % task.name())
+        if task.isFramesTask() or task.isRegionsTask():
+            return print('WARN: Unable to extend the frames range or regions task "%s"' % task.name())
+        source_status = task.status()
+        if not isinstance(samples, int) or samples <= source_status['samples']:
+            return print('WARN: Unable to extend task "%s" with less samples than %s' % (task.name(), source_status['samples']))
+
+        rendered = task.workloadsRendered()
+        renders = dict([ (name, render) for name, (status, render) in rendered.items() ])
+        # Render blobs of the agents are not important and could be already cleaned
+        missing = set(self._parent.blobsMissing(renders.values()))
+        statuses = dict([ (name, status) for name, (status, render) in rendered.items() if render not in missing ])
+        if not statuses:
+            # The task completed by the stored results or with cleaned renders has nothing to continue
+            return print('WARN: Unable to extend task "%s" - no workload renders left to reuse' % task.name())
+
+        # Same seed is used, so the new workloads will continue the seeds sequence
+        cfg = task.configsGet()
+        cfg['samples'] = samples
+        if not self._cfg.configsSet(cfg):
+            return print('ERROR: Unable to set configs of the extended task "%s"' % task.name())
+        with self._files_lock:
+            self._files = task.filesGet()
+
+        print('INFO: Extending task "%s" with %s rendered workloads to %s samples' % (task.name(), len(statuses), samples))
+        for name in statuses:
+            self.updatePreview(name, renders[name])
+            self.updateRender(name, renders[name])
+        self._execution_status.update(statuses)
+        with self._status_lock:
+            self._status['samples_done'] = sum([ status['samples_done'] for status in statuses.values() ])
+            self._status['samples_acquired'] = self._status['samples_done']
+            self._status['samples_per_workload'] = source_status['samples_per_workload']
+            self._status['workloads_taken'] = source_status['workloads_taken']
+
+        return True
+
+    def workloadsRendered(self):
+        '''Returns the workloads with render results {name: (status, render blob id)}'''
+        with self._results_render_lock:
+            renders = self._results_render.copy()
+        return dict([ (name, (status.copy(), renders[name])) for name, status in self._execution_status.items()
+            if status.get('samples_done') and renders.get(name)
+        ])
+
     def statusResultsProcessingSet(self, val):
         with self._status_lock:
             self._status['results_processing'] = val
@@ -140,21 +331,65 @@ class ManagerTask(TaskBase):
         self._results_watcher = None
         print('DEBUG: Stopped ManagerTask "%s" results watcher' % self.name())
 
+    def _framesResultsWatcher(self):
+        '''Composes the frames of the range one by one when the renders are available'''
+        print('DEBUG: Starting ManagerTask "%s" frames results watcher' % self.name())
+
+        while True:
+            to_compose = None
+            with self._results_frames_lock:
+                renders = self._results_frames.copy()
+            with self._status_lock:
+                composed = self._status['result']['frames'].copy()
+            if not self._stop_task:
+                for frame in sorted(renders, key=int):
+                    if frame not in composed:
+                        to_compose = (int(frame), renders[frame])
+                        break
+
+            if not to_compose:
+                # All the frames are done - the last one is the task result
+                if (not self._status['result']['compose']
+                    and set(composed) == set([ str(f) for f in self.framesGet() ])
+                    and not self._stop_task):
+                    last = composed[str(self.framesGet()[-1])]
+                    self.statusRenderSet(last['render'])
+                    self.statusComposeSet(last['compose'])
+                self.statusResultsProcessingSet(False)
+                if not self.isRunning():
+                    break # If all the requests was processed and task is not running - stop
+                time.sleep(1.0)
+                continue
+
+            self.statusResultsProcessingSet(True)
+            self._composeWorker(*to_compose)
+
+        self._results_watcher = None
+        print('DEBUG: Stopped ManagerTask "%s" frames results watcher' % self.name())
+
     def _mergeWorker(self, to_merge):
         '''Merge the multiple preview or render images to one'''
         print('DEBUG: Merge started for task "%s"' % (self.name(),))
         try:
-            if len(to_merge[1]) == 1:
+            if len(to_merge[1]) == 1 and not self.isRegionsTask():
                 # Sending directly to results just one image to merge
                 to_merge[0](to_merge[1].pop())
             else:
-                files = dict([ (blob + '.exr', blob) for blob in to_merge[1] ])
+                script = 'merge'
+                files = dict([ (blobFileName(blob) + '.exr', blob) for blob in to_merge[1] ])
                 cfg = {
                     'images': [ 'project/' + f for f in files.keys() ],
                     'result': 'result.exr',
                 }
+                if self.isRegionsTask():
+                    # The regions are not merged by samples but placed to their rows of the image
+                    script = 'stitch'
+                    starts = self._regionsStarts()
+                    files = dict([ (blobFileName(blob) + '.exr', blob) for blob in to_merge[1] if blob in starts ])
+                    cfg['images'] = [ {'path': 'project/' + f, 'start': starts[blob]} for f, blob in files.items() ]
+                    cfg['height'] = self._cfg.resolution_y
                 with self.prepareWorkspace(files) as ws_path:
-                    process = self.runBlenderScriptProcessor(ws_path, 'merge', cfg)
+                    process = self.runBlenderScriptProcessor(ws_path, script, cfg)
                     self._processOutputs(process, show_out=(to_merge[0] == self.statusRenderSet))
 
                     blob = self._parent._fc.blobStoreFile(os.path.join(ws_path, cfg['result']), True)
@@ -168,6 +403,8 @@ class ManagerTask(TaskBase):
             # Critical only on render merge
             if to_merge[0] == self.statusRenderSet:
                 self.stateError({self.name(): 'Exception occurred during merging the results: %s' % (e,)})
+        finally:
+            self._parent._fc.workspaceClean(self.name())
 
         print('DEBUG: Merge completed for task "%s"' % (self.name(),))
 
@@ -182,21 +419,34 @@ class ManagerTask(TaskBase):
 
         print('DEBUG: Merge clean completed for task "%s"' % (self.name(),))
 
-    def _composeWorker(self):
+    def _regionsStarts(self):
+        '''Returns map of the preview and render blobs to the first row of their image regions'''
+        with self._status_lock:
+            acquired = self._status['regions_acquired'].copy()
+        out = {}
+        for results, lock in ((self._results_preview, self._results_preview_lock), (self._results_render, self._results_render_lock)):
+            with lock:
+                for agent_task, blob_id in results.items():
+                    if agent_task in acquired:
+                        out[blob_id] = acquired[agent_task][0]
+        return out
+
+    def _composeWorker(self, frame = None, render = None):
         '''Running blender instance to compose and export the rendered image'''
         print('DEBUG: Starting composite process for task "%s"' % (self.name(),))
         try:
             with self._status_lock:
+                render = render or self._status['result']['render']
                 # Composition can use dependencies - so getting them all to the workspace
                 files_map = self.filesGet()
                 # And updating deps with the rendered image to replace the renderl layer node
-                render_name = 'blendnet-' + self._status['result']['render'][:6]
+                render_name = 'blendnet-' + blobFileName(render)[:6]
                 files_map.update({
-                    render_name + '.exr': self._status['result']['render'],
+                    render_name + '.exr': render,
                 })
             cfg = {
                 'use_compositing_nodes': self._cfg.use_compositing_nodes,
-                'frame': self._cfg.frame,
+                'frame': self._cfg.frame if frame is None else frame,
                 'render_file_path': 'project/' + render_name + '.exr',
                 'result_dir': render_name + '-result',
                 'project_path': self._cfg.project_path,
@@ -215,14 +465,21 @@ class ManagerTask(TaskBase):
                     if not blob:
                         print('ERROR: Unable to store blob for compose result of', self.name())
                         return
-                    self.statusComposeSet(blob['id'])
+                    if frame is None:
+                        self.statusComposeSet(blob['id'])
+                    else:
+                        self.statusFrameSet(frame, render, blob['id'])
                     break
-                if not self._status['result']['compose']:
+                if frame is None and not self._status['result']['compose']:
                     self.stateError({self.name(): 'Result file of the compose operation not found'})
+                elif frame is not None and str(frame) not in self._status['result']['frames']:
+                    self.stateError({self.name(): 'Result file of the frame %s compose operation not found' % frame})
 
         except Exception as e:
             print('ERROR: Exception occurred during composing the result for task "%s": %s: %s' % (self.name(), type(e), e))
             self.stateError({self.name(): 'Exception occurred during composing the result: %s' % (e,)})
+        finally:
+            self._parent._fc.workspaceClean(self.name())
 
         print('DEBUG: Compositing completed for task', self.name())
 
@@ -268,6 +525,10 @@ class ManagerTask(TaskBase):
 
     def isRenderComplete(self):
         '''Checks that all the tasks was completed and results were downloaded'''
+        if self.isFramesTask():
+            with self._results_frames_lock:
+                return set(self._results_frames) == set([ str(f) for f in self.framesGet() ])
+
         # The only tasks contains render results - is completed or stopped
         task_end_states = {TaskState.COMPLETED.name, TaskState.STOPPED.name}
 
@@ -281,7 +542,7 @@ class ManagerTask(TaskBase):
         # Making sure all the samples-containing tasks is in render results
         # and the completed samples is more or equal the required samples
         return (tasks_set and tasks_set == set(self._results_render.keys())
-                and tasks_samples >= self._cfg.samples)
+                and tasks_samples >= self.samplesTotal())
 
     def calculateWorkloadSamples(self, samples, agents):
         '''Calculating optimal number of samples per agent'''
@@ -292,46 +553,315 @@ class ManagerTask(TaskBase):
             out += ceil(samples%(out*agents)/(batches*agents))
         return ceil(out/2) if out > 140 else out
 
+    def _workloadTimings(self, agent):
+        '''Returns median prepare time and time per sample measured on the agent or on all the agents'''
+        with self._execution_lock:
+            executions = self._executions.copy()
+
+        agent_timings = ([], [])
+        all_timings = ([], [])
+        for task_name, status in list(self._execution_status.items()):
+            result = status.get('result', {})
+            if not (result.get('prepare_time') and result.get('render_time') and status.get('samples_done')):
+                continue
+            sample_time = result['render_time'] / status['samples_done']
+            all_timings[0].append(result['prepare_time'])
+            all_timings[1].append(sample_time)
+            if executions.get(task_name) is agent:
+                agent_timings[0].append(result['prepare_time'])
+                agent_timings[1].append(sample_time)
+
+        for timings in (agent_timings, all_timings):
+            if timings[1]:
+                return statistics.median(timings[0]), statistics.median(timings[1])
+        return None
+
+    def calculateAdaptiveWorkloadSamples(self, agent, left_to_acquire):
+        '''Calculating samples for the agent by the measured prepare and render times'''
+        from math import ceil
+        timings = self._workloadTimings(agent)
+        if not timings:
+            return None # No measurements yet
+        prepare_time, sample_time = timings
+
+        # Preparation should take just the overhead part of the workload time
+        overhead = self._cfg.workload_overhead / 100.0
+        out = left_to_acquire
+        if sample_time > 0:
+            out = ceil(prepare_time * (1.0 - overhead) / (overhead * sample_time))
+        # Near the end of the task the rest is split between agents to finish together
+        out = min(out, ceil(left_to_acquire / max(self._cfg.agents_num, 1)))
+        return max(out, 1)
+
+    def workloadsLeft(self):
+        '''Returns estimated number of the workloads left to acquire'''
+        from math import ceil
+        if self.isFramesTask():
+            with self._status_lock:
+                todo = self._status['frames_todo']
+            return len(self.framesGet() if todo is None else todo)
+        if self.isRegionsTask():
+            with self._status_lock:
+                todo = self._status['regions_todo']
+            if todo is None:
+                return max(self._cfg.agents_num, 1)
+            # The first regions are split equally between the agents
+            left_rows = sum([ end - start for start, end in todo ])
+            return ceil(left_rows * max(self._cfg.agents_num, 1) / self._cfg.resolution_y)
+        with self._status_lock:
+            left_to_acquire = self._cfg.samples - self._status['samples_acquired']
+            samples_per_workload = self._status['samples_per_workload']
+        with self._status_lock:
+            speculative = len(self._status['speculative_todo'])
+        if left_to_acquire <= 0:
+            return speculative
+        if not samples_per_workload:
+            samples_per_workload = self.calculateWorkloadSamples(self._cfg.samples, max(self._cfg.agents_num, 1))
+        return ceil(left_to_acquire / samples_per_workload) + speculative
+
     def acquireWorkload(self, agent):
         '''Returns map with parameters for agent to process'''
         with self._status_lock:
             if self._stop_task or not self.isRunning():
                 return {} # Stopping in progress - no more workloads
 
-            left_to_acquire = self._cfg.samples - self._status['samples_acquired']
+            if self.isFramesTask() or self.isRegionsTask():
+                if self.isFramesTask():
+                    workload = self._acquireFramesWorkload()
+                else:
+                    workload = self._acquireRegionsWorkload(agent)
+                if not workload:
+                    return {} # No work is available
+                with self._execution_lock:
+                    self._executions[workload['task_name']] = agent
+                return workload
+
+            while True:
+                left_to_acquire = self._cfg.samples - self._status['samples_acquired']
+
+                # "<=" just in case when more samples was calculated to prevent endless task
+                if left_to_acquire <= 0:
+                    # Only the duplicates of the straggling workloads could be left
+                    workload = self._acquireSpeculativeWorkload(agent)
+                    if not workload:
+                        return {} # No work is available
+                    break
+
+                if not self._status['samples_per_workload']:
+                    self._status['samples_per_workload'] = self.calculateWorkloadSamples(self._cfg.samples, self._cfg.agents_num)
+
+                workload = self.configsGet()
+                # Sizing the workload by the loading/rendering ratio when it's measured
+                # Memoized workloads are found by seed and samples, so they need the fixed size
+                workload_samples = self._status['samples_per_workload']
+                if self._cfg.workload_overhead and not self._parent._cfg.results_memoize:
+                    workload_samples = self.calculateAdaptiveWorkloadSamples(agent, left_to_acquire) or workload_samples
+                workload['samples'] = min(left_to_acquire, workload_samples)
+                self._status['samples_acquired'] += workload['samples']
+                # Append to seed to make agent render unique
+                workload['seed'] += self._status['workloads_taken']
+                workload['task_name'] = '%s_%d' % (self.name(), self._status['workloads_taken'])
+
+                self._status['workloads_taken'] += 1
+
+                # The same workload could be already rendered - so skipping to the next one
+                if not (self._parent._cfg.results_memoize and self._workloadMemoized(workload)):
+                    break
 
-            # "<=" just in case when more samples was calculated to prevent endless task
-            if left_to_acquire <= 0:
-                return {} # No work is available
+            # Put agent task into executions list
+            with self._execution_lock:
+                self._executions[workload['task_name']] = agent
 
-            if not self._status['samples_per_workload']:
-                self._status['samples_per_workload'] = self.calculateWorkloadSamples(self._cfg.samples, self._cfg.agents_num)
+            return workload
+
+    def _acquireSpeculativeWorkload(self, agent):
+        '''Returns duplicate of the straggling workload with a fresh seed, status lock is required'''
+        with self._execution_lock:
+            executions = self._executions.copy()
+        todo = self._status['speculative_todo']
+        for agent_task in todo.copy():
+            if executions.get(agent_task) is agent:
+                continue # Duplicate on the same agent will not help
+            todo.remove(agent_task)
+            status = self._execution_status.get(agent_task, {})
+            if status.get('state') != TaskState.RUNNING.name:
+                continue # Already ended
 
             workload = self.configsGet()
-            # TODO: Dynamically change min samples according to the
-            # time to render and loading/rendering ratio
-            workload['samples'] = min(left_to_acquire, self._status['samples_per_workload'])
-            self._status['samples_acquired'] += workload['samples']
-            # Append to seed to make agent render unique
+            workload['samples'] = status['samples']
+            # Fresh seed to get the different render pattern from the same samples
             workload['seed'] += self._status['workloads_taken']
             workload['task_name'] = '%s_%d' % (self.name(), self._status['workloads_taken'])
+            self._status['workloads_taken'] += 1
+            self._status['speculations'][agent_task] = workload['task_name']
+            print('INFO: Running workload "%s" as duplicate of the straggling "%s"' % (workload['task_name'], agent_task))
+            return workload
 
-            # Put agent task into executions list
-            with self._execution_lock:
-                self._executions[workload['task_name']] = agent
+        return {}
 
-            self._status['workloads_taken'] += 1
+    def _speculateStragglers(self, time_per_sample):
+        '''Marks the running workloads projected to finish far beyond the others to duplicate'''
+        median = statistics.median(time_per_sample.values())
+        idle = len(self._parent.agentsIdle())
+        with self._status_lock:
+            if self._cfg.samples > self._status['samples_acquired']:
+                return # The regular workloads go first
+            todo = self._status['speculative_todo']
+            pairs = self._status['speculations']
+            speculated = set(todo) | set(pairs) | set(pairs.values())
+            idle -= len(todo)
+            for agent_task, status in self._execution_status.items():
+                if idle <= 0:
+                    break
+                if (agent_task in speculated
+                    or status.get('state') != TaskState.RUNNING.name
+                    or not (status.get('remaining') and status.get('samples'))):
+                    continue
+                # The duplicate should be able to render all the workload samples before it
+                if status['remaining'] * 100 <= self._cfg.speculation_threshold * median * status['samples']:
+                    continue
+                print('INFO: Workload "%s" is straggling with %s sec remaining' % (agent_task, status['remaining']))
+                todo.append(agent_task)
+                idle -= 1
 
-            return workload
+    def _speculationEnded(self, agent_task, task_status, executions):
+        '''Keeps the first completed of the duplicated workloads, returns True if the results are discarded'''
+        to_stop = None
+        with self._status_lock:
+            if agent_task in self._status['speculative_todo']:
+                self._status['speculative_todo'].remove(agent_task)
+            pairs = self._status['speculations']
+            other = pairs.get(agent_task) or next(( orig for orig, dup in pairs.items() if dup == agent_task ), None)
+            if other is None:
+                return False
+            losers = self._status['speculation_losers']
+            discard = agent_task in losers
+            if not discard and task_status.get('state') == TaskState.COMPLETED.name:
+                if other not in losers:
+                    losers.append(other)
+                    print('INFO: Workload "%s" completed first - stopping the duplicate "%s"' % (agent_task, other))
+                    to_stop = other
+            elif not discard and task_status.get('state') == TaskState.STOPPED.name:
+                # The other one is still rendering the same samples
+                discard = self._execution_status.get(other, {}).get('state') == TaskState.RUNNING.name
+                if discard:
+                    losers.append(agent_task)
+        # Request to the agent should not block the task status
+        if to_stop in executions:
+            executions[to_stop].taskStop(to_stop)
+        if not discard:
+            return False
+
+        print('DEBUG: Discarding results of the duplicated workload "%s"' % agent_task)
+        task_status['samples_done'] = 0
+        self.updatePreview(agent_task, None)
+        self.updateRender(agent_task, None)
+        return True
+
+    def _acquireFramesWorkload(self):
+        '''Returns the next chunk of contiguous frames, status lock is required'''
+        from math import ceil
+        if self._status['frames_todo'] is None:
+            self._status['frames_todo'] = self.framesGet()
+        todo = self._status['frames_todo']
+        if not todo:
+            return {}
+
+        # Guided chunks: big ones at start and smaller near the end to balance the agents
+        chunk = ceil(len(todo) / max(self._cfg.agents_num, 1))
+        frames = todo[:1]
+        for frame in todo[1:chunk]:
+            if frame != frames[-1] + 1:
+                break
+            frames.append(frame)
+        del todo[:len(frames)]
+
+        workload = self.configsGet()
+        workload['frame'] = frames[0]
+        workload['frame_end'] = frames[-1]
+        workload['task_name'] = '%s_%d' % (self.name(), self._status['workloads_taken'])
+        self._status['frames_acquired'][workload['task_name']] = frames
+        self._status['samples_acquired'] += len(frames) * self._cfg.samples
+        self._status['workloads_taken'] += 1
+        return workload
+
+    def _acquireRegionsWorkload(self, agent):
+        '''Returns the next strip of the image rows, status lock is required'''
+        from math import ceil
+        if self._status['regions_todo'] is None:
+            self._status['regions_todo'] = [[0, self._cfg.resolution_y]]
+        todo = self._status['regions_todo']
+        if not todo:
+            return {}
+
+        # Guided strips: big ones at start and smaller near the end to balance the agents
+        left_rows = sum([ end - start for start, end in todo ])
+        rows = ceil(left_rows / max(self._cfg.agents_num, 1))
+        if self._cfg.workload_overhead:
+            # Sizing the strip by the measured time of the row samples
+            row_samples = self.calculateAdaptiveWorkloadSamples(agent, left_rows * self._cfg.samples)
+            if row_samples:
+                rows = ceil(row_samples / self._cfg.samples)
+        # Too small strips are spending most of the time on preparation
+        rows = max(rows, 16)
+
+        start, end = todo[0]
+        region_end = min(start + rows, end)
+        if region_end == end:
+            todo.pop(0)
+        else:
+            todo[0] = [region_end, end]
+
+        workload = self.configsGet()
+        workload['region_start'] = start
+        workload['region_end'] = region_end
+        workload['task_name'] = '%s_%d' % (self.name(), self._status['workloads_taken'])
+        self._status['regions_acquired'][workload['task_name']] = [start, region_end]
+        self._status['samples_acquired'] += (region_end - start) * self._cfg.samples
+        self._status['workloads_taken'] += 1
+        return workload
+
+    def returnAcquiredRegion(self, agent_task):
+        '''Returns the image region of the agent task back to the task'''
+        with self._status_lock:
+            region = self._status['regions_acquired'].pop(agent_task, None)
+            if not region:
+                return
+            print('DEBUG: Agent task %s returning region to render: %s' % (agent_task, region))
+            self._status['regions_todo'] = sorted(self._status['regions_todo'] + [region])
+            self._status['samples_acquired'] -= (region[1] - region[0]) * self._cfg.samples
+
+    def returnAcquiredFrames(self, agent_task, rendered = set()):
+        '''Returns the not rendered frames of the agent task back to the task'''
+        with self._results_frames_lock:
+            rendered = set(rendered) | set(self._results_frames)
+        with self._status_lock:
+            frames = self._status['frames_acquired'].pop(agent_task, [])
+            frames = [ f for f in frames if str(f) not in rendered ]
+            if not frames:
+                return
+            print('DEBUG: Agent task %s returning frames to render: %s' % (agent_task, frames))
+            self._status['frames_todo'] = sorted(self._status['frames_todo'] + frames)
+            self._status['samples_acquired'] -= len(frames) * self._cfg.samples
 
     def returnAcquiredWorkload(self, samples):
         '''If agent was not able to complete the task - it could return samples back'''
         with self._status_lock:
             self._status['samples_acquired'] -= samples
 
-    def updatePreview(self, agent_task, blob_id):
+    def _isSpeculationLoser(self, agent_task):
+        '''Checks the agent task is the duplicated workload with discarded results, status lock is taken'''
+        with self._status_lock:
+            return agent_task in self._status['speculation_losers']
+
+    def updatePreview(self, agent_task, blob_id, memoized = False):
         '''Run process of merging the available previews and update the task results'''
         print('DEBUG: Updating preview for task "%s" blob id "%s"' % (agent_task, blob_id))
+        if blob_id and not memoized and self._isSpeculationLoser(agent_task):
+            # Results of the discarded duplicate could be downloaded after it ended
+            with self._results_to_remove_lock:
+                self._results_to_remove.add(blob_id)
+            return
         old_blob_id = None
         with self._results_preview_lock:
             old_blob_id = self._results_preview.get(agent_task)
@@ -344,9 +874,14 @@ class ManagerTask(TaskBase):
             with self._results_to_remove_lock:
                 self._results_to_remove.add(old_blob_id)
 
-    def updateRender(self, agent_task, blob_id):
+    def updateRender(self, agent_task, blob_id, memoized = False):
         '''Run process of merging the available renders and update the task results'''
         print('DEBUG: Updating render for task "%s" blob id "%s"' % (agent_task, blob_id))
+        if blob_id and not memoized and self._isSpeculationLoser(agent_task):
+            # Results of the discarded duplicate could be downloaded after it ended
+            with self._results_to_remove_lock:
+                self._results_to_remove.add(blob_id)
+            return
         old_blob_id = None
         with self._results_render_lock:
             old_blob_id = self._results_render.get(agent_task)
@@ -359,13 +894,33 @@ class ManagerTask(TaskBase):
             with self._results_to_remove_lock:
                 self._results_to_remove.add(old_blob_id)
 
+    def updateFrameRender(self, agent_task, frame, blob_id):
+        '''Stores the downloaded render of the range frame to compose it'''
+        print('DEBUG: Updating frame %s render for task "%s" blob id "%s"' % (frame, agent_task, blob_id))
+        with self._results_frames_lock:
+            if str(frame) in self._results_frames:
+                # The frame could be rendered by the returned agent task already
+                with self._results_to_remove_lock:
+                    self._results_to_remove.add(blob_id)
+                return
+            self._results_frames[str(frame)] = blob_id
+        # Showing the last rendered frame to the user
+        self.statusPreviewSet(blob_id)
+
     def _executionWatcher(self):
         '''Looking for the task execution on the agents, collecting renders together'''
         print('DEBUG: Execution watcher of task "%s" is started' % self.name())
 
+        use_memoize = self._parent._cfg.results_memoize and not self.isFramesTask()
+        if use_memoize and self._memoizedComplete():
+            with self._execution_lock:
+                self._execution_watcher = None
+            return
+
         # Will help us to combine results
         if not self._results_watcher:
-            self._results_watcher = threading.Thread(target=self._resultsWatcher)
+            watcher = self._framesResultsWatcher if self.isFramesTask() else self._resultsWatcher
+            self._results_watcher = threading.Thread(target=watcher)
             self._results_watcher.start()
 
         task_end_states = {TaskState.STOPPED.name, TaskState.COMPLETED.name, TaskState.ERROR.name}
@@ -376,6 +931,8 @@ class ManagerTask(TaskBase):
                 self.stop()
             with self._execution_lock:
                 executions = self._executions.copy()
+                memoized, self._executions_memoized = self._executions_memoized, {}
+            self._execution_status.update(memoized)
 
             for task_name, agent in executions.items():
                 prev_status = self._execution_status.get(task_name, {})
@@ -389,6 +946,10 @@ class ManagerTask(TaskBase):
                     if not task_status:
                         continue
                     task_status['_requested_time'] = requested_time # Will help with remaining calculations
+                    if task_status.get('region_end') is not None:
+                        # Agent task of the region renders the samples for each row of it
+                        rows = task_status['region_end'] - task_status['region_start']
+                        task_status['samples_done'] = (task_status.get('samples_done') or 0) * rows
                 else:
                     # If it was not active before - just wait
                     if not prev_status:
@@ -406,8 +967,15 @@ class ManagerTask(TaskBase):
                 if update_messages_time + 10 < time.time():
                     self.executionMessagesSet(agent.taskMessages(task_name).get(task_name), task_name)
 
+                param = 'frames'
+                for frame in task_status.get('result', {}).get(param) or {}:
+                    if frame not in (prev_status.get('result', {}).get(param) or {}):
+                        print('DEBUG: task %s frame %s rendered' % (task_name, frame))
+                        agent.requestFrameDownload(task_name, int(frame), self.updateFrameRender)
                 param = 'preview'
-                if prev_status.get('result', {}).get(param) != task_status.get('result', {}).get(param):
+                if self.isFramesTask():
+                    pass # Previews of the different frames can't be merged
+                elif prev_status.get('result', {}).get(param) != task_status.get('result', {}).get(param):
                     print('DEBUG: task %s %s changed: %s' % (task_name, param, task_status.get('result', {}).get(param)))
                     agent.requestPreviewDownload(task_name, self.updatePreview)
                 param = 'render'
@@ -429,11 +997,32 @@ class ManagerTask(TaskBase):
                         print('DEBUG: Retreive details about the task %s execution' % task_name)
                         self.executionDetailsSet(agent.taskDetails(task_name).get(task_name), task_name)
                         self.executionMessagesSet(agent.taskMessages(task_name).get(task_name), task_name)
-                        agent.workEnded()
+                        agent.workEnded(task_name)
+
+                    if task_status.get('state') in task_end_states and self._speculationEnded(task_name, task_status, executions):
+                        pass # The duplicated workload results are not needed
+
+                    elif self.isFramesTask() and task_status.get('state') != TaskState.ERROR.name:
+                        # Rendered frames are counted by the agent only when stored
+                        frames = task_status.get('result', {}).get('frames') or {}
+                        task_status['samples_done'] = len(frames) * self._cfg.samples
+                        # Frames of not active agent will not be downloaded
+                        self.returnAcquiredFrames(task_name, frames if agent.isActive() else set())
+
+                    elif self.isRegionsTask() and task_status.get('state') == TaskState.STOPPED.name:
+                        print('WARN: The agent task %s was stopped' % task_name)
+                        rows = task_status.get('region_end', 0) - task_status.get('region_start', 0)
+                        if not (task_status.get('result', {}).get('render')
+                                and task_status.get('samples_done', 0) >= task_status.get('samples', 0) * rows):
+                            # Not fully sampled region will be visible in the image - so render it again
+                            task_status['samples_done'] = 0
+                            self.updatePreview(task_name, None)
+                            self.updateRender(task_name, None)
+                            self.returnAcquiredRegion(task_name)
 
-                    if task_status.get('state') == TaskState.STOPPED.name:
+                    elif task_status.get('state') == TaskState.STOPPED.name:
                         print('WARN: The agent task %s was stopped' % task_name)
-                        return_samples = task_status.get('samples', agent.work().get('samples'))
+                        return_samples = task_status.get('samples', 0)
                         # Main task output is render - so if it's exists, we can think that some work was done
                         if task_status.get('result', {}).get('render'):
                             # If agent was able to complete some work - return the rest back to task
@@ -462,25 +1051,41 @@ class ManagerTask(TaskBase):
             if update_messages_time + 10 < time.time():
                 update_messages_time = time.time()
 
+            if use_memoize and not self.isRegionsTask():
+                # Region workloads are different only by the rows, so they are not memoized
+                self._workloadsMemoize()
+
             # Updating the task left samples
             self.statusSamplesDoneSet(sum([ t.get('samples_done') for t in self._execution_status.values() ]))
 
             # Calculate the task remaining time
-            time_per_sample = []
+            time_per_sample = {}
             for task, status in self._execution_status.items():
                 if not (status.get('start_time') and status.get('samples')):
                     continue
+                samples = status['samples']
+                if status.get('frame_end') is not None:
+                    # Agent task of the frames range renders the samples for each frame
+                    samples *= status['frame_end'] - status['frame'] + 1
+                elif status.get('region_end') is not None:
+                    # Agent task of the region renders the samples for each row
+                    samples *= status['region_end'] - status['region_start']
                 if status.get('end_time'):
                     # Simple calculation based on start and end time
-                    time_per_sample.append((status['end_time'] - status['start_time']) / status['samples'])
+                    time_per_sample[task] = (status['end_time'] - status['start_time']) / samples
                 elif status.get('remaining') and status.get('samples_done'):
                     # Calculating time per sample based on task remaining time and left samples to render
                     prelim_render_time = status['_requested_time'] + status['remaining'] - status['start_time']
-                    time_per_sample.append(prelim_render_time / status['samples'])
+                    time_per_sample[task] = prelim_render_time / samples
             if time_per_sample:
-                remaining = statistics.median(time_per_sample) * (self._cfg.samples - self._status['samples_done'])
+                remaining = statistics.median(time_per_sample.values()) * (self.samplesTotal() - self._status['samples_done'])
                 self.statusRemainingSet(int(remaining))
 
+                # Duplicating the straggling workloads to not wait for the slowest agent
+                if (self._cfg.speculation_threshold and not self._stop_task
+                    and not (self.isFramesTask() or self.isRegionsTask())):
+                    self._speculateStragglers(time_per_sample)
+
             # Check if all the samples was processed and tasks completed
             if self._status['results_processing']:
                 # If the results are processing - let's do nothing
@@ -501,6 +1106,11 @@ class ManagerTask(TaskBase):
                     continue
                 if self._status['result']['compose']:
                     print('INFO: Task %s is completed' % (self.name(),))
+                    if use_memoize:
+                        self._parent.resultsMemoSet(self.fingerprint(), {
+                            'render': self._status['result']['render'],
+                            'compose': self._status['result']['compose'],
+                        })
                     self.stateComplete()
                     continue
 
@@ -523,6 +1133,10 @@ class ManagerTask(TaskBase):
         with self._status_lock:
             self._status['result']['compose'] = blob_id
 
+    def statusFrameSet(self, frame, render, compose):
+        with self._status_lock:
+            self._status['result']['frames'][str(frame)] = {'render': render, 'compose': compose}
+
     def _stop(self):
         self._stop_task = True
 
@@ -13,6 +13,7 @@ import json # Used in the tasks configuration
 from . import providers
 from . import utils
 from . import SimpleREST
+from .FileCache import hashAlgorithm
 
 class Processor(providers.Processor, SimpleREST.ProcessorBase):
     def __init__(self, engine, prefix = 'api/v1'):
@@ -34,6 +35,7 @@ class Processor(providers.Processor, SimpleREST.ProcessorBase):
 
         out = { 'success': True, 'data': {
             'engine': type(self._e).__name__,
+            'blob_hash': self._e.getBlobHash(),
             'platform': {
                 'python_info': sys.version,
                 'system': str(platform.system()),
@@ -73,6 +75,7 @@ class Processor(providers.Processor, SimpleREST.ProcessorBase):
             'load': self._e.getLoadStatus(),
             'memory': self._e.getMemoryStatus(),
             'disk': self._e.getDiskStatus(),
+            'cache': self._e.getCacheStatus(),
             'running': [ t.name() for t in self._e.tasksRunning() ],
             'terminating': self._e.isTerminating(),
         }}
@@ -123,7 +126,7 @@ class Processor(providers.Processor, SimpleREST.ProcessorBase):
             'data': {
                 'id': sha1,
                 'path': parts[1],
-                'blob': self._e.blobGet(sha1),
+                'blob': dict(self._e.blobGet(sha1) or {}),
             },
         }
 
@@ -139,9 +142,9 @@ class Processor(providers.Processor, SimpleREST.ProcessorBase):
         if not length:
             return { 'success': False, 'message': 'Unable to find "Content-Length" header' }
 
-        sha1 = req.headers['x-checksum-sha1']
+        sha1 = self._checksumHeader(req)
         if not sha1:
-            return { 'success': False, 'message': 'Unable to find "X-Checksum-Sha1" header' }
+            return { 'success': False, 'message': 'Unable to find "X-Checksum" header' }
 
         task = self._e.taskGet(parts[0])
         if not task.canBeChanged():
@@ -151,16 +154,246 @@ class Processor(providers.Processor, SimpleREST.ProcessorBase):
         if not result:
             return { 'success': False, 'message': 'Error during receiving the file' }
 
+        return self._taskFileAdd(task, parts, result)
+
+    def _checksumHeader(self, req):
+        '''Returns the blob id from the checksum header, old clients are sending only sha1'''
+        return req.headers['x-checksum'] or req.headers['x-checksum-sha1']
+
+    def _taskFileAdd(self, task, parts, result):
+        '''Adds the received blob to the task files'''
         path = parts[1].replace('\\', '/')
 
         if not task.fileAdd(path, result['id']):
             return { 'success': False, 'message': 'Error during add file to the task' }
 
-        if self._e.taskGet(parts[0]).filesPathsFix(path) == False:
+        if task.filesPathsFix(path) == False:
             return { 'success': False, 'message': 'Error during task file fixing' }
 
         return { 'success': True, 'message': 'Uploaded task file',
-            'data': result,
+            'data': dict(result),
+        }
+
+    @SimpleREST.put('task/*/chunked/**')
+    def put_task_file_chunked(self, req, parts):
+        '''Assemble task file from chunks using json manifest {"checksum": sha1, "chunks": [[sha1, size], ...]}'''
+        length = req.headers['content-length']
+        if not length:
+            return { 'success': False, 'message': 'Unable to find "Content-Length" header' }
+
+        if int(length) > 16*1024*1024: # Max 16MB
+            return { 'success': False, 'message': 'Unable read too big chunks manifest (> 16MB)' }
+
+        task = self._e.taskGet(parts[0])
+        if not task.canBeChanged():
+            return { 'success': False, 'message': 'Unable to upload files for the executing task' }
+
+        data = None
+        try:
+            data = json.loads(req.rfile.read(int(length)))
+        except Exception as e:
+            return { 'success': False, 'message': 'Error during parsing the json data: %s' % e }
+
+        result = self._e.blobStoreChunks(data.get('chunks', []), data.get('checksum', ''))
+        if not result:
+            return { 'success': False, 'message': 'Error during assembling the file from chunks' }
+
+        return self._taskFileAdd(task, parts, result)
+
+    @SimpleREST.put('task/*/files')
+    def put_task_files(self, req, parts):
+        '''Add already stored blobs to the task using json map {path: sha1}, returns not added paths'''
+        length = req.headers['content-length']
+        if not length:
+            return { 'success': False, 'message': 'Unable to find "Content-Length" header' }
+
+        if int(length) > 16*1024*1024: # Max 16MB
+            return { 'success': False, 'message': 'Unable read too big files map (> 16MB)' }
+
+        task = self._e.taskGet(parts[0])
+        if not task.canBeChanged():
+            return { 'success': False, 'message': 'Unable to upload files for the executing task' }
+
+        files_map = None
+        try:
+            files_map = json.loads(req.rfile.read(int(length)))
+        except Exception as e:
+            return { 'success': False, 'message': 'Error during parsing the json data: %s' % e }
+
+        return { 'success': True, 'message': 'Added task files',
+            'data': self._taskFilesRef(task, parts, files_map),
+        }
+
+    @SimpleREST.put('task/*/manifest')
+    def put_task_manifest(self, req, parts):
+        '''Add stored blobs to the task using json manifest {path: {id, size}}, returns missing entries'''
+        length = req.headers['content-length']
+        if not length:
+            return { 'success': False, 'message': 'Unable to find "Content-Length" header' }
+
+        if int(length) > 16*1024*1024: # Max 16MB
+            return { 'success': False, 'message': 'Unable read too big manifest (> 16MB)' }
+
+        task = self._e.taskGet(parts[0])
+        if not task.canBeChanged():
+            return { 'success': False, 'message': 'Unable to upload files for the executing task' }
+
+        manifest = None
+        try:
+            manifest = json.loads(req.rfile.read(int(length)))
+        except Exception as e:
+            return { 'success': False, 'message': 'Error during parsing the json data: %s' % e }
+
+        files_map = {}
+        for path, item in manifest.items():
+            # Older addons are sending the blob id as sha1
+            blob = self._e.blobGet(item.get('id', item.get('sha1', '')))
+            if 'id' in (blob or {}) and blob['size'] == item.get('size'):
+                files_map[path] = blob['id']
+
+        failed = set(self._taskFilesRef(task, parts, files_map))
+
+        return { 'success': True, 'message': 'Added known task files',
+            'data': { path: item for path, item in manifest.items() if path not in files_map or path in failed },
+        }
+
+    def _taskFilesRef(self, task, parts, files_map):
+        '''Adds the stored blobs {path: sha1} to the task files, returns not added paths'''
+        failed = []
+        for path, sha1 in files_map.items():
+            blob = self._e.blobGet(sha1)
+            if 'id' not in (blob or {}) or not self._taskFileAdd(task, [parts[0], path], blob).get('success'):
+                failed.append(path)
+        return failed
+
+    @SimpleREST.post('blob/missing')
+    def blob_missing(self, req):
+        '''Returns which of the provided json list of blobs are not available'''
+        length = req.headers['content-length']
+        if not length:
+            return { 'success': False, 'message': 'Unable to find "Content-Length" header' }
+
+        if int(length) > 16*1024*1024: # Max 16MB
+            return { 'success': False, 'message': 'Unable read too big blobs list (> 16MB)' }
+
+        blobs = None
+        try:
+            blobs = json.loads(req.rfile.read(int(length)))
+        except Exception as e:
+            return { 'success': False, 'message': 'Error during parsing the json data: %s' % e }
+
+        return { 'success': True, 'message': 'Got missing blobs',
+            'data': self._e.blobsMissing(blobs),
+        }
+
+    @SimpleREST.post('blob/fetch')
+    def blob_fetch(self, req):
+        '''Downloads the json map of blobs {id: size} from "peers" {id: [peer, ...]} or "storage_url", returns the fetch state'''
+        length = req.headers['content-length']
+        if not length:
+            return { 'success': False, 'message': 'Unable to find "Content-Length" header' }
+
+        if int(length) > 16*1024*1024: # Max 16MB
+            return { 'success': False, 'message': 'Unable read too big blobs list (> 16MB)' }
+
+        data = None
+        try:
+            data = json.loads(req.rfile.read(int(length)))
+        except Exception as e:
+            return { 'success': False, 'message': 'Error during parsing the json data: %s' % e }
+
+        if not data.get('storage_url') and not data.get('peers'):
+            return { 'success': False, 'message': 'Unable to fetch blobs without "storage_url" or "peers"' }
+
+        return { 'success': True, 'message': 'Fetching blobs',
+            'data': self._e.blobsFetch(data.get('storage_url'), data.get('blobs', {}), data.get('peers', {})),
+        }
+
+    @SimpleREST.get('blob/*')
+    def blob_stream(self, req, parts):
+        '''Streams the stored blob to the other nodes'''
+        blob = self._e.blobGet(parts[0])
+        if 'id' not in (blob or {}):
+            return { 'success': False, 'message': 'Unable to find blob' }
+
+        stream = self._e.blobGetStream(blob['id'])
+        if not stream:
+            return { 'success': False, 'message': 'Unable to read blob' }
+
+        req.send_response(200)
+        req.send_header('Content-Type', 'application/octet-stream')
+        req.send_header('Content-Length', blob['size'])
+        req.send_header('X-Checksum', blob['id'])
+        req.end_headers()
+
+        with stream:
+            req.sendFile(stream, blob['size'])
+
+        return {}
+
+    @SimpleREST.post('chunk/missing')
+    def chunk_missing(self, req):
+        '''Returns which of the provided json list of chunks are not available'''
+        length = req.headers['content-length']
+        if not length:
+            return { 'success': False, 'message': 'Unable to find "Content-Length" header' }
+
+        if int(length) > 16*1024*1024: # Max 16MB
+            return { 'success': False, 'message': 'Unable read too big chunks list (> 16MB)' }
+
+        chunks = None
+        try:
+            chunks = json.loads(req.rfile.read(int(length)))
+        except Exception as e:
+            return { 'success': False, 'message': 'Error during parsing the json data: %s' % e }
+
+        return { 'success': True, 'message': 'Got missing chunks',
+            'data': self._e.chunksMissing(chunks),
+        }
+
+    @SimpleREST.put('chunk/*')
+    def put_chunk(self, req, parts):
+        '''Upload the file chunk to assemble the task file later'''
+        length = req.headers['content-length']
+        if not length:
+            return { 'success': False, 'message': 'Unable to find "Content-Length" header' }
+
+        if self._checksumHeader(req) != parts[0]:
+            return { 'success': False, 'message': 'The "X-Checksum" header is not matching the chunk' }
+
+        if not self._e.chunkStoreStream(req.rfile, int(length), parts[0]):
+            return { 'success': False, 'message': 'Error during receiving the chunk' }
+
+        return { 'success': True, 'message': 'Uploaded chunk' }
+
+    @SimpleREST.get('upload/*')
+    def upload_info(self, req, parts):
+        '''Returns the received offset of the blob upload session'''
+        return { 'success': True, 'message': 'Got upload info',
+            'data': self._e.uploadOffset(parts[0]),
+        }
+
+    @SimpleREST.put('upload/*')
+    def put_upload(self, req, parts):
+        '''Upload part of the blob, checksum is verified when the last part is received'''
+        length = req.headers['content-length']
+        if not length:
+            return { 'success': False, 'message': 'Unable to find "Content-Length" header' }
+
+        offset = req.headers['x-upload-offset']
+        total = req.headers['x-upload-size']
+        if not offset or not total:
+            return { 'success': False, 'message': 'Unable to find "X-Upload-Offset" or "X-Upload-Size" headers' }
+
+        state = self._e.uploadStoreStream(req.rfile, int(length), parts[0], int(offset), int(total))
+        if not state:
+            return { 'success': False, 'message': 'Error during receiving the upload part' }
+
+        if state.get('blob'):
+            state['blob'] = dict(state['blob'])
+
+        return { 'success': True, 'message': 'Uploaded blob part',
+            'data': state,
         }
 
     @SimpleREST.put('task/*/config')
@@ -187,6 +420,34 @@ class Processor(providers.Processor, SimpleREST.ProcessorBase):
 
         return { 'success': True, 'message': 'Task configured' }
 
+    @SimpleREST.put('task/*/extend')
+    def task_extend(self, req, parts):
+        '''Create task continuing the completed one with more samples as json {task, samples} (max 128KB)'''
+        length = req.headers['content-length']
+        if not length:
+            return { 'success': False, 'message': 'Unable to find "Content-Length" header' }
+
+        if int(length) > 128*1024: # Max 128KB
+            return { 'success': False, 'message': 'Unable read too big task extend request (> 128KB)' }
+
+        data = None
+        try:
+            data = json.loads(req.rfile.read(int(length)))
+        except Exception as e:
+            return { 'success': False, 'message': 'Error during parsing the json data: %s' % e }
+
+        if not self._e.taskExists(data.get('task')):
+            return { 'success': False, 'message': 'Unable to find task to extend' }
+
+        task = self._e.taskGet(parts[0])
+        if not hasattr(task, 'extendFrom'):
+            return { 'success': False, 'message': 'Extending of the tasks is not supported' }
+
+        if not task.extendFrom(self._e.taskGet(data['task']), data.get('samples')):
+            return { 'success': False, 'message': 'Unable to extend the task' }
+
+        return { 'success': True, 'message': 'Task extended' }
+
     @SimpleREST.get('task/*/run')
     def task_run(self, req, parts):
         '''Mark task as ready to be executed'''
@@ -218,6 +479,23 @@ class Processor(providers.Processor, SimpleREST.ProcessorBase):
         if not result:
             return { 'success': False, 'message': 'No result available' }
 
+        return self._resultStream(req, result)
+
+    @SimpleREST.get('task/*/status/frame/*/*')
+    def task_frame_result_stream(self, req, parts):
+        '''Streams the result image (render or compose) of the task frame'''
+        if not self._e.taskExists(parts[0]):
+            return { 'success': False, 'message': 'Unable to find task' }
+
+        frames = self._e.taskGet(parts[0]).status()['result'].get('frames') or {}
+        result = frames.get(parts[1], {}).get(parts[2])
+        if not result:
+            return { 'success': False, 'message': 'No frame result available' }
+
+        return self._resultStream(req, result)
+
+    def _resultStream(self, req, result):
+        '''Sends the result image blob'''
         blob = self._e.blobGet(result)
         if not blob:
             return { 'success': False, 'message': 'Unable to find result blob' }
@@ -225,12 +503,13 @@ class Processor(providers.Processor, SimpleREST.ProcessorBase):
         req.send_response(200)
         req.send_header('Content-Type', 'image/x-exr')
         req.send_header('Content-Length', blob['size'])
-        req.send_header('X-Checksum-Sha1', blob['id'])
+        req.send_header('X-Checksum', blob['id'])
+        if hashAlgorithm(blob['id']) == 'sha1':
+            req.send_header('X-Checksum-Sha1', blob['id'])
         req.end_headers()
 
         with self._e.blobGetStream(blob['id']) as stream:
-            for chunk in iter(lambda: stream.read(1048576), b''):
-                req.wfile.write(chunk)
+            req.sendFile(stream, blob['size'])
 
         return {}
 
@@ -6,6 +6,7 @@ Description: Implementation of a simple REST interface
 '''
 
 import os
+import mmap # Serve files without copying them to python objects
 import http.server # Multi-threaded http server
 import ssl # To protect the communication
 import json # Used to produce responses
@@ -122,6 +123,8 @@ def generateCert(name, filename):
                   '-out "{0}.crt" -days 512 -sha256'.format(filename))
 
 class RequestHandler(http.server.BaseHTTPRequestHandler):
+    send_buffer_size = 4*1024*1024
+
     def send_response(self, code):
         if hasattr(self, '_headers_sent'):
             return
@@ -143,6 +146,32 @@ class RequestHandler(http.server.BaseHTTPRequestHandler):
         self.send_header('Content-type', 'application/json')
         self.end_headers()
 
+    def sendFile(self, f, size):
+        '''Sends the opened file content to the client with minimal copying
+
+        Plain sockets are served by the kernel with sendfile. TLS needs to
+        encrypt the data in userspace, so the file is memory-mapped and sent by
+        slices of the map.
+        '''
+        offset = f.tell()
+        if not isinstance(self.connection, ssl.SSLSocket) and hasattr(os, 'sendfile'):
+            self.wfile.flush()
+            sent = 0
+            while sent < size:
+                done = os.sendfile(self.connection.fileno(), f.fileno(), offset + sent, size - sent)
+                if not done:
+                    break
+                sent += done
+            return sent
+
+        if not size:
+            return 0
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm, memoryview(mm) as view:
+            for pos in range(offset, offset + size, self.send_buffer_size):
+                with view[pos:min(pos + self.send_buffer_size, offset + size)] as part:
+                    self.wfile.write(part)
+        return size
+
     def sendAuthHead(self):
         self.send_response(401)
         self.send_header('WWW-Authenticate', 'Basic realm="%s"' % urllib.parse.quote(self.server.getName()))
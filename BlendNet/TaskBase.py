@@ -52,6 +52,21 @@ class TaskConfig(Config):
             'type': int,
             'min': 0,
         },
+        'frame_end': {
+            'description': '''Set the last frame to render the frames range starting from `frame`''',
+            'type': int,
+            'min': 0,
+        },
+        'region_start': {
+            'description': '''First row of pixels (from the top) of the image region to render''',
+            'type': int,
+            'min': 0,
+        },
+        'region_end': {
+            'description': '''Row of pixels next to the last one of the image region to render''',
+            'type': int,
+            'min': 1,
+        },
     }
 
 class TaskState(Enum):
@@ -142,8 +157,13 @@ class TaskBase(ABC):
             'end_time': self._end_time,
             'state': self._state.name,
             'frame': self._cfg.frame,
-            'done': self._status['samples_done'] / self._cfg.samples,
+            'done': self._status['samples_done'] / self.samplesTotal(),
         }
+        if self._cfg.frame_end is not None:
+            out['frame_end'] = self._cfg.frame_end
+        if self._cfg.region_end is not None:
+            out['region_start'] = self._cfg.region_start
+            out['region_end'] = self._cfg.region_end
         if self._state_error_info:
             out['state_error_info'] = self._state_error_info
         return out
@@ -160,6 +180,16 @@ class TaskBase(ABC):
             out.update(self._status)
             return out
 
+    def framesGet(self):
+        '''Returns list of the frames rendered by the task'''
+        if self._cfg.frame_end is None:
+            return [self._cfg.frame]
+        return list(range(self._cfg.frame, self._cfg.frame_end + 1))
+
+    def samplesTotal(self):
+        '''Returns how much samples to render for all the task frames'''
+        return self._cfg.samples * len(self.framesGet())
+
     def statusRemainingSet(self, remaining):
         with self._status_lock:
             self._status['remaining'] = remaining
@@ -242,6 +272,7 @@ class TaskBase(ABC):
     def stateSet(self, state):
         '''Unify state set of the task'''
         self._state = state
+        self._parent.tasksWatcherWake()
 
     def fileAdd(self, path, file_id):
         '''Add file to the files map'''
@@ -319,6 +350,9 @@ class TaskBase(ABC):
                 self._execution_watcher.start()
         print('INFO: Task %s started execution' % self.name())
 
+    def prepare(self):
+        '''Prepares the pending task execution while the other task is running'''
+
     @abstractmethod
     def _executionWatcher(self):
         '''Process watching on the execution'''
@@ -396,14 +430,20 @@ class TaskBase(ABC):
     def check(self):
         '''Check the task integrity'''
         errors = []
-        with self._files_lock:
-            for path, sha1 in self._files.items():
-                if not utils.isPathAbsolute(path):
-                    errors.append({self.name(): 'The file path "%s" is not absolute' % (path,)})
-                if not utils.isPathStraight(path):
-                    errors.append({self.name(): 'The file path "%s" is contains parent dir usage' % (path,)})
-                if not self._parent._fc.blobGet(sha1):
-                    errors.append({self.name(): 'Unable to find required file "%s" with id "%s" in file cache' % (path, sha1)})
+        # Getting the blob could clean the cache, which is checking the task files
+        for path, sha1 in self.filesGet().items():
+            if not utils.isPathAbsolute(path):
+                errors.append({self.name(): 'The file path "%s" is not absolute' % (path,)})
+            if not utils.isPathStraight(path):
+                errors.append({self.name(): 'The file path "%s" is contains parent dir usage' % (path,)})
+            if not self._parent._fc.blobGet(sha1):
+                errors.append({self.name(): 'Unable to find required file "%s" with id "%s" in file cache' % (path, sha1)})
+        if self._cfg.frame_end is not None and (self._cfg.frame is None or self._cfg.frame_end < self._cfg.frame):
+            errors.append({self.name(): 'The frames range requires `frame` less or equal to `frame_end`'})
+        if (self._cfg.region_start is not None or self._cfg.region_end is not None) and not (
+            self._cfg.region_start is not None and self._cfg.region_end is not None
+            and self._cfg.region_start < self._cfg.region_end):
+            errors.append({self.name(): 'The image region requires `region_start` less than `region_end`'})
         for err in errors:
             self.stateError(err)
         return True
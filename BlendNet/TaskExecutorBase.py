@@ -7,7 +7,6 @@ Description: Common for all task executors (agent/manager)
 
 import os
 import signal
-import time # We need to sleep the watching thread
 import threading # Sync between threads needed
 import json # Used in the tasks save/load
 import hashlib # Calculate sha1 to find a task snapshot name
@@ -16,7 +15,14 @@ from abc import ABC
 from . import providers
 from .Config import Config
 from .TaskBase import TaskBase
-from .FileCache import FileCache
+from .Workers import Workers
+from .AgentClient import AgentClient
+from .FileCache import (
+    FileCache,
+    SharedBlobBackend,
+    HASH_ALGORITHMS,
+    blobStoragePath,
+)
 
 class TaskExecutorConfig(Config):
     _defs = {
@@ -52,6 +58,11 @@ class TaskExecutorConfig(Config):
             'max': 65535,
             'default': 8443,
         },
+        'listen_plaintext': {
+            'description': '''Serve without TLS to send the files by the kernel (only for the trusted private network)''',
+            'type': bool,
+            'default': False,
+        },
         'auth_user': {
             'description': '''Server auth user name''',
             'type': str,
@@ -62,11 +73,51 @@ class TaskExecutorConfig(Config):
             'type': str,
             'default': '',
         },
+        'cache_free_low': {
+            'description': '''Cache disk free space low watermark in percents to start background cleaning''',
+            'type': int,
+            'min': 0,
+            'max': 100,
+            'default': 10,
+        },
+        'cache_free_high': {
+            'description': '''Cache disk free space high watermark in percents to stop background cleaning''',
+            'type': int,
+            'min': 0,
+            'max': 100,
+            'default': 20,
+        },
+        'cache_reclaim_budget': {
+            'description': '''Maximum bytes to clean in one background cache cleaning pass (0 - no limit)''',
+            'type': int,
+            'min': 0,
+            'default': 4*1024*1024*1024,
+        },
+        'blob_hash': {
+            'description': '''Preferred content hash algorithm to identify the blobs (%s)''' % ', '.join(HASH_ALGORITHMS),
+            'type': str,
+            'default': HASH_ALGORITHMS[0],
+        },
+        'blobs_shared_dir': {
+            'description': '''Blobs directory on the filesystem shared by Manager and Agents ('' - not used)''',
+            'type': str,
+            'default': '',
+        },
+        'blobs_fetch_workers': {
+            'description': '''Number of parallel downloads of the blobs from provider storage''',
+            'type': int,
+            'min': 1,
+            'max': 32,
+            'default': 8,
+        },
     }
 
 class TaskExecutorBase(ABC):
     '''Class with the common task management functional'''
 
+    # Owner writes and evicts the blobs in the shared directory
+    _blobs_shared_owner = False
+
     def __init__(self, task_type, config):
         if not issubclass(task_type, TaskBase):
             raise Exception('Unable use task type %s' % task_type)
@@ -78,17 +129,34 @@ class TaskExecutorBase(ABC):
 
         self._cfg = config
 
-        self._fc = FileCache('.', 'BlendNet_cache')
+        backend = None
+        if self._cfg.blobs_shared_dir:
+            backend = SharedBlobBackend(self._cfg.blobs_shared_dir, self._blobs_shared_owner)
+        self._fc = FileCache('.', 'BlendNet_cache', self._cfg.blob_hash, backend)
+        self._fc.blobsProtectedSet(self._tasksActiveBlobs)
+        self._fc.reclaimerStart(self._cfg.cache_free_low, self._cfg.cache_free_high, self._cfg.cache_reclaim_budget)
 
         self._tasks_lock = threading.Lock()
         self._tasks = {}
 
+        # Blobs downloading from the provider storage
+        self._blobs_fetch_lock = threading.Lock()
+        self._blobs_fetch_active = set()
+        self._blobs_fetch_failed = set()
+        self._blobs_fetch_workers = Workers(
+            'Fetching blobs from storage',
+            self._cfg.blobs_fetch_workers,
+            self._blobFetchWorker,
+        )
+
         self._tasks_dir = os.path.join('tasks', '%s-%s' % (self.__class__.__name__, self._cfg.session_id))
 
         self._tasks_pending_lock = threading.Lock()
         self._tasks_pending = []
         self._tasks_running_lock = threading.Lock()
         self._tasks_running = set()
+        # Wakes up the tasks watcher to start the pending task without delay
+        self._tasks_event = threading.Event()
 
         self._tasks_watcher = threading.Thread(target=self._tasksWatcher)
         self._tasks_watcher.start()
@@ -113,11 +181,24 @@ class TaskExecutorBase(ABC):
         with self._tasks_lock:
             return self._tasks.copy()
 
+    def _tasksActiveBlobs(self):
+        '''Returns ids of the not ended tasks files to protect them from cache eviction'''
+        out = set()
+        for task in self.tasks().values():
+            if not task.isEnded():
+                out.update([ sha1 for sha1 in task.filesGet().values() if sha1 ])
+        return out
+
     def tasksRunning(self):
         '''Returns copy of the currently running tasks set'''
         with self._tasks_running_lock:
             return self._tasks_running.copy()
 
+    def tasksPending(self):
+        '''Returns copy of the pending tasks list in the execution order'''
+        with self._tasks_pending_lock:
+            return self._tasks_pending.copy()
+
     def tasksSave(self, tasks = []):
         '''Save in-memory tasks to disk'''
         if not tasks:
@@ -138,6 +219,7 @@ class TaskExecutorBase(ABC):
 
     def tasksLoad(self):
         '''Load tasks from disk'''
+        loaded = []
         with self._tasks_lock:
             if not os.path.isdir(self._tasks_dir):
                 return
@@ -153,12 +235,16 @@ class TaskExecutorBase(ABC):
                             data = json.load(f)
                             task = self._task_type(self, data['name'], data)
                             self._tasks[task.name()] = task
-                            task.check()
-                            if task.isPending():
-                                self.taskAddToPending(task)
+                            loaded.append(task)
                     except Exception as e:
                         print('ERROR: Unable to load task file "%s" from disk: %s' % (json_path, e))
 
+        # Checking could clean the cache, which is getting the tasks files
+        for task in loaded:
+            task.check()
+            if task.isPending():
+                self.taskAddToPending(task)
+
     def taskExists(self, name):
         '''Will check the existance of task'''
         with self._tasks_lock:
@@ -198,6 +284,7 @@ class TaskExecutorBase(ABC):
             task.statePending()
             self._tasks_pending.append(task)
         print('DEBUG: Moved task to pending: "%s"' % task.name())
+        self.tasksWatcherWake()
 
         return True
 
@@ -236,15 +323,23 @@ class TaskExecutorBase(ABC):
                         print('DEBUG: Removing from running list ended task "%s"' % task.name())
                         self._tasks_running.remove(task)
 
-            if self._tasks_pending:
+            with self._tasks_pending_lock:
+                task = self._tasks_pending[0] if self._tasks_pending else None
+            if task:
                 if not self.tasksRunning(): # Empty running tasks
                     self._taskPendingToRunning()
-                # TODO: if the current executing task is going to complete - need
-                # to get the new one from pending to not spend time on preparing
+                else:
+                    # Preparing the next task to start it right after the current one
+                    task.prepare()
 
-            time.sleep(1.0)
+            self._tasks_event.wait(1.0)
+            self._tasks_event.clear()
         print('DEBUG: Stopped tasks watcher')
 
+    def tasksWatcherWake(self):
+        '''Triggers the tasks watcher to check the tasks state'''
+        self._tasks_event.set()
+
     def getLoadStatus(self):
         '''Return current load average 1, 5, 15 mins'''
         load = (None, None, None)
@@ -273,6 +368,14 @@ class TaskExecutorBase(ABC):
             'available': self._fc.getAvailableSpace()/1024/1024,
         }
 
+    def getBlobHash(self):
+        '''Returns the content hash algorithm preferred by the cache'''
+        return self._fc.getHashAlgorithm()
+
+    def getCacheStatus(self):
+        '''Return blobs cache status'''
+        return self._fc.getStatus()
+
     def blobStoreStream(self, stream, size, sha1):
         return self._fc.blobStoreStream(stream, size, sha1)
 
@@ -281,3 +384,81 @@ class TaskExecutorBase(ABC):
 
     def blobGetStream(self, sha1):
         return self._fc.blobGetStream(sha1)
+
+    def blobsMissing(self, sha1s):
+        return self._fc.blobsMissing(sha1s)
+
+    def blobChunksGet(self, sha1):
+        return self._fc.blobChunksGet(sha1)
+
+    def blobsFetch(self, storage_url, blobs, peers = {}):
+        '''Starts download of the missing blobs {id: size} in background
+
+        The blob is downloaded from one of the peers {id: [peer, ...]} or from
+        the storage. Returns the state with `missing` list of still downloading
+        blobs and `failed` list of blobs which were not received since the last
+        call.
+        '''
+        state = {'missing': [], 'failed': []}
+        to_fetch = set()
+        with self._blobs_fetch_lock:
+            for sha1 in self._fc.blobsMissing(blobs.keys()):
+                if sha1 in self._blobs_fetch_failed:
+                    self._blobs_fetch_failed.discard(sha1)
+                    state['failed'].append(sha1)
+                    continue
+                state['missing'].append(sha1)
+                if sha1 not in self._blobs_fetch_active:
+                    self._blobs_fetch_active.add(sha1)
+                    # Only the address is taken from the peer, credentials are our own
+                    sources = [ {'address': p.get('address'), 'port': p.get('port')} for p in peers.get(sha1, []) ]
+                    to_fetch.add((storage_url, sha1, blobs[sha1], json.dumps(sources)))
+
+        if to_fetch:
+            self._blobs_fetch_workers.addSet(to_fetch)
+
+        return state
+
+    def _blobFetchWorker(self, storage_url, sha1, size, peers):
+        '''Downloads the blob from the peers or storage into the cache'''
+        blob = None
+        try:
+            for peer in json.loads(peers):
+                # Agents of the pool are using the same credentials
+                client = AgentClient(peer.get('address'), {
+                    'listen_port': peer.get('port'),
+                    'listen_plaintext': self._cfg.listen_plaintext,
+                    'auth_user': self._cfg.auth_user,
+                    'auth_password': self._cfg.auth_password,
+                    'storage_url': self._cfg.storage_url,
+                })
+                blob = self._fc.blobStoreDownload(lambda path: client.blobDownload(sha1, path), size, sha1)
+                if blob:
+                    break
+                print('WARN: Unable to fetch blob "%s" from peer "%s"' % (sha1, peer.get('address')))
+
+            if not blob and storage_url:
+                blob = self._fc.blobStoreDownload(
+                    lambda path: providers.downloadFileFromStorage(storage_url, blobStoragePath(sha1), path),
+                    size, sha1,
+                )
+        finally:
+            with self._blobs_fetch_lock:
+                self._blobs_fetch_active.discard(sha1)
+                if not blob:
+                    self._blobs_fetch_failed.add(sha1)
+
+    def blobStoreChunks(self, manifest, sha1):
+        return self._fc.blobStoreChunks(manifest, sha1)
+
+    def chunksMissing(self, chunk_ids):
+        return self._fc.chunksMissing(chunk_ids)
+
+    def chunkStoreStream(self, stream, size, chunk_id):
+        return self._fc.chunkStoreStream(stream, size, chunk_id)
+
+    def uploadOffset(self, sha1):
+        return self._fc.uploadOffset(sha1)
+
+    def uploadStoreStream(self, stream, size, sha1, offset, total):
+        return self._fc.uploadStoreStream(stream, size, sha1, offset, total)
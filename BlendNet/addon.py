@@ -8,7 +8,6 @@ import sys
 import bpy
 import time
 import threading
-import hashlib
 import ssl
 import site
 import random
@@ -19,6 +18,10 @@ from datetime import datetime
 from . import providers
 from . import utils
 from . import ManagerClient
+from .FileCache import (
+    hashAlgorithm,
+    calculateChecksum,
+)
 from .Workers import Workers
 from .list_blender_versions import getBlenderVersions
 
@@ -390,6 +393,8 @@ def updateManagerTasks():
         if task_name.startswith(getTaskProjectPrefix()) and task.get('state') == 'COMPLETED':
             # Download only latest tasks frames, we don't need old ones here
             key = str(task.get('frame'))
+            if task.get('frame_end') is not None:
+                key += '-' + str(task.get('frame_end'))
             if key not in to_download:
                 to_download[key] = item
             if to_download[key].create_time < item.create_time:
@@ -406,7 +411,10 @@ def updateManagerTasks():
     for item in to_download.values():
         if item.received:
             continue
-        result = managerDownloadTaskResult(item.name, 'compose')
+        if tasks[item.name].get('frame_end') is not None:
+            result = managerDownloadTaskFramesResult(item.name, 'compose')
+        else:
+            result = managerDownloadTaskResult(item.name, 'compose')
         if result == False:
             print('INFO: Downloading the final render for %s...' % (item.name,))
             item.received = 'Downloading...'
@@ -521,17 +529,55 @@ def toggleManager():
     _runBackgroundWork(worker, getConfig())
 
 manager_task_upload_workers = None
+manager_task_upload_manifest = None # Thread to add the known files to the task
+manager_task_upload_checksums = {} # Files checksums cache {(path, algorithm): (size, mtime, id)}
 
-def _managerTaskUploadFilesWorker(task, rel_path, file_path):
+def _managerTaskUploadFilesWorker(task, rel_path, file_path, checksum = None):
     '''Gets item and uploads using client'''
     while True:
-        ret = ManagerClient(getManagerIP(), getConfig()).taskFilePut(task, file_path, rel_path)
+        ret = ManagerClient(getManagerIP(), getConfig()).taskFilePut(task, file_path, rel_path, checksum)
         if ret:
             break
         print('WARN: Uploading of "%s" to task "%s" failed, repeating...' % (rel_path, task))
+        # The file could be changed after the checksum calculation
+        checksum = None
         time.sleep(1.0)
     print('DEBUG: Uploading of "%s" to task "%s" completed' % (rel_path, task))
 
+def _managerTaskFileChecksum(path, algorithm):
+    '''Returns checksum of the file, the same files are not hashed again for the next tasks'''
+    stat = os.stat(path)
+    cached = manager_task_upload_checksums.get((path, algorithm))
+    if cached and cached[:2] == (stat.st_size, stat.st_mtime):
+        return cached[2]
+
+    with open(path, 'rb') as f:
+        checksum = calculateChecksum(f, algorithm)
+    manager_task_upload_checksums[(path, algorithm)] = (stat.st_size, stat.st_mtime, checksum)
+    return checksum
+
+def _managerTaskUploadManifest(task, files_map):
+    '''Adds files already stored on the Manager to the task and uploads the rest'''
+    manifest = {}
+    try:
+        algorithm = ManagerClient(getManagerIP(), getConfig()).blobHash()
+        manifest = dict( (rel, {
+            'id': _managerTaskFileChecksum(path, algorithm),
+            'size': os.path.getsize(path),
+        }) for rel, path in files_map.items() )
+        missing = ManagerClient(getManagerIP(), getConfig()).taskManifestPut(task, manifest)
+        if isinstance(missing, dict):
+            print('DEBUG: Task "%s" files known by Manager: %d, to upload: %d' % (
+                task, len(files_map) - len(missing), len(missing)
+            ))
+            files_map = dict( (rel, path) for rel, path in files_map.items() if rel in missing )
+    except Exception as e:
+        print('WARN: Unable to send manifest of task "%s", uploading all the files: %s' % (task, e))
+
+    # The calculated checksums are reused to not read the files again
+    manager_task_upload_workers.addSet(set( (task, rel, path, manifest.get(rel, {}).get('id'))
+        for rel, path in files_map.items() ))
+
 def managerTaskUploadFiles(task, files_map):
     '''Multithreading task files upload'''
 
@@ -547,22 +593,31 @@ def managerTaskUploadFiles(task, files_map):
             _managerTaskUploadFilesWorker,
         )
 
-    manager_task_upload_workers.addSet(set( (task, rel, path) for rel, path in files_map.items() ))
+    # Checksums calculation could take a while - so not blocking the UI
+    global manager_task_upload_manifest
+    manager_task_upload_manifest = threading.Thread(target=_managerTaskUploadManifest, args=(task, files_map))
+    manager_task_upload_manifest.daemon = True
+    manager_task_upload_manifest.start()
 
 def managerTaskUploadFilesStatus():
     '''Returns string to show user about the status of uploading'''
     global manager_task_upload_workers
+    if manager_task_upload_manifest and manager_task_upload_manifest.is_alive():
+        return 'checking files...'
     if manager_task_upload_workers and manager_task_upload_workers.tasksLeft() > 0:
         return '%d left to upload...' % manager_task_upload_workers.tasksLeft()
     return None
 
 manager_task_download_workers = None
 
-def _managerDownloadTaskResultsWorker(task, result, file_path):
+def _managerDownloadTaskResultsWorker(task, result, file_path, frame = None):
     '''Gets item and downloads using client'''
     ret = None
     for repeat in range(0, 3):
-        ret = managerTaskResultDownload(task, result, file_path)
+        if frame is None:
+            ret = managerTaskResultDownload(task, result, file_path)
+        else:
+            ret = managerTaskFrameResultDownload(task, frame, result, file_path)
         if ret:
             break
         print('WARN: Downloading of "%s" from task "%s" into "%s" failed, repeating (%s)...' % (
@@ -602,14 +657,12 @@ def managerDownloadTaskResult(task_name, result_to_download, result_dir = None):
     checksum = None
     # Check the local file first - maybe it's the thing we need
     if os.path.isfile(out_path):
-        # Calculate sha1 to make sure it's the same file
-        sha1_calc = hashlib.sha1()
-        with open(out_path, 'rb') as f:
-            for chunk in iter(lambda: f.read(1048576), b''):
-                sha1_calc.update(chunk)
-        checksum = sha1_calc.hexdigest()
-        # If file and checksum are here - we need to get the actual task status to compare
+        # If file is here - we need to get the actual task status to compare
         result = managerTaskStatus(task_name).get('result', {}).get(result_to_download)
+        if result:
+            # Calculate checksum with the result algorithm to make sure it's the same file
+            with open(out_path, 'rb') as f:
+                checksum = calculateChecksum(f, hashAlgorithm(result))
 
     # If file is not working for us - than download
     if checksum != result:
@@ -626,9 +679,46 @@ def managerDownloadTaskResult(task_name, result_to_download, result_dir = None):
         return False
     return out_path
 
+def managerDownloadTaskFramesResult(task_name, result_to_download):
+    '''Check the frames range results existance and download the ones not matching the existing files'''
+    frames = managerTaskStatus(task_name).get('result', {}).get('frames') or {}
+    out_path = None
+    to_download = []
+    for frame in sorted(frames, key=int):
+        result = frames[frame].get(result_to_download)
+        out_path = bpy.path.abspath(bpy.context.scene.render.frame_path(frame=int(frame)))
+        if os.path.isfile(out_path):
+            # Calculate checksum with the result algorithm to make sure it's the same file
+            with open(out_path, 'rb') as f:
+                if calculateChecksum(f, hashAlgorithm(result)) == result:
+                    continue
+        to_download.append((task_name, result_to_download, out_path, int(frame)))
+
+    if to_download:
+        global manager_task_download_workers
+        if manager_task_download_workers is None:
+            manager_task_download_workers = Workers(
+                'Downloading files from Manager',
+                8,
+                _managerDownloadTaskResultsWorker,
+            )
+
+        for data in to_download:
+            manager_task_download_workers.add(*data)
+        manager_task_download_workers.start()
+        return False
+    return out_path
+
+def taskSplitByFrames(frames_num):
+    '''Chooses to split animation by frames when it's enough of them to load all the agents'''
+    return frames_num >= getConfig()['agents_max']
+
 def managerTaskConfig(task, conf):
     return ManagerClient(getManagerIP(), getConfig()).taskConfigPut(task, conf)
 
+def managerTaskExtend(task, source_task, samples):
+    return ManagerClient(getManagerIP(), getConfig()).taskExtend(task, source_task, samples)
+
 def managerTaskRun(task):
     return ManagerClient(getManagerIP(), getConfig()).taskRun(task)
 
@@ -650,6 +740,9 @@ def managerTaskRemove(task):
 def managerTaskResultDownload(task, result, file_path):
     return ManagerClient(getManagerIP(), getConfig()).taskResultDownload(task, result, file_path)
 
+def managerTaskFrameResultDownload(task, frame, result, file_path):
+    return ManagerClient(getManagerIP(), getConfig()).taskFrameResultDownload(task, frame, result, file_path)
+
 def managerAgentCreate(agent_name, conf):
     return ManagerClient(getManagerIP(), getConfig()).agentCreate(agent_name, conf)
 
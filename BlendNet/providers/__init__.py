@@ -174,6 +174,10 @@ def deleteInstance(inst_id):
 def downloadDataFromStorage(storage_url, path = None):
     return _execProviderFunc('downloadDataFromStorage', None, storage_url, path)
 
+def downloadFileFromStorage(storage_url, path, out_path):
+    '''Downloads file from the network storage to the local path'''
+    return _execProviderFunc('downloadFileFromStorage', None, storage_url, path, out_path)
+
 def createFirewall(target_tag, port):
     return _execProviderFunc('createFirewall', None, target_tag, port)
 
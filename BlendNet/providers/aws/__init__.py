@@ -715,6 +715,24 @@ def downloadDataFromStorage(storage_url, path = None):
     with open(tmp_file.name, 'rb') as fh:
         return fh.read()
 
+def downloadFileFromStorage(storage_url, path, out_path):
+    '''Download file from the bucket'''
+
+    if path:
+        if platform.system() == 'Windows':
+            path = pathlib.PurePath(path).as_posix()
+        storage_url += '/' + path
+
+    print('INFO: Downloading file from "%s" ...' % (storage_url,))
+
+    try:
+        _executeAwsTool('s3', 'cp', storage_url, out_path)
+    except AwsToolException as e:
+        print('WARN: Downloading failed', e)
+        return None
+
+    return True
+
 def getResources(session_id):
     '''Get the allocated resources with a specific session_id'''
     out = {'agents':{}}
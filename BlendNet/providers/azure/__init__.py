@@ -757,6 +757,26 @@ def downloadDataFromStorage(storage_url, path = None):
     with open(temp_file.name, 'rb') as fh:
         return fh.read()
 
+def downloadFileFromStorage(storage_url, path, out_path):
+    '''Download file from the storage'''
+
+    if path:
+        if platform.system() == 'Windows':
+            path = pathlib.PurePath(path).as_posix()
+        storage_url += '/' + path
+
+    print('INFO: Azure: Downloading file from "%s" ...' % (storage_url,))
+
+    try:
+        _executeAzTool('storage', 'copy',
+                       '--source', storage_url,
+                       '--destination-local-path', out_path)
+    except AzToolException:
+        print('WARN: Azure: Download operation failed')
+        return None
+
+    return True
+
 def getResources(session_id):
     '''Get the allocated resources with a specific session_id'''
     out = {'agents':{}}
@@ -820,6 +820,35 @@ def downloadDataFromStorage(storage_url, path = None):
 
     return data_fd.getvalue()
 
+def downloadFileFromStorage(storage_url, path, out_path):
+    '''Download file from the bucket'''
+    from googleapiclient.http import MediaIoBaseDownload
+
+    storage = _getStorage()
+
+    if path:
+        if platform.system() == 'Windows':
+            path = pathlib.PurePath(path).as_posix()
+        storage_url += '/' + path
+
+    print('INFO: Downloading file from "%s"...' % (storage_url,))
+    req = storage.objects().get_media(
+        bucket=urllib.parse.urlparse(storage_url).hostname,
+        object=urllib.parse.urlparse(storage_url).path.lstrip('/')
+    )
+
+    try:
+        with open(out_path, 'wb') as f:
+            downloader = MediaIoBaseDownload(f, req, chunksize=8*1024*1024)
+            done = False
+            while done is False:
+                _, done = downloader.next_chunk()
+    except Exception as e:
+        print('WARN: Downloading failed: %s' % e)
+        return None
+
+    return True
+
 def getResources(session_id):
     '''Get the allocated resources with a specific session_id'''
     compute, configs = _getCompute(), _getConfigs()
@@ -44,9 +44,14 @@ class Manager(InstanceProvider):
         }
         cfg = {
             'listen_port': conf.get('port', None),
+            'listen_plaintext': conf.get('listen_plaintext', self._cfg.agent_listen_plaintext),
             'auth_user': conf.get('auth_user', self._cfg.agent_auth_user),
             'auth_password': conf.get('auth_password', self._cfg.agent_auth_password),
             'upload_workers': conf.get('upload_workers', self._cfg.agent_upload_workers),
+            'upload_chunked': conf.get('upload_chunked', self._cfg.agent_upload_chunked),
+            'blobs_storage_url': conf.get('blobs_storage_url', self._cfg.agent_blobs_storage_url),
+            'blobs_peers': conf.get('blobs_peers', self._cfg.agent_blobs_peers),
+            'pipeline': conf.get('pipeline', self._cfg.agent_pipeline),
         }
         with self._agents_pool_lock:
             self._cfg.agents_max += 1
@@ -9,6 +9,10 @@ __all__ = [
     'Agent',
 ]
 
+import os
+import shutil
+import urllib.parse
+
 from ...ManagerClient import ManagerClient
 
 # Contains the custom local provider resources
@@ -73,6 +77,40 @@ def downloadDataFromStorage(storage_url, path):
         print('WARN: Unable to load the "ca.crt" certificate')
         pass
 
+def _localStoragePath(storage_url, path):
+    '''Returns local path of the "file://" storage (local or shared between the nodes dir)'''
+    if not storage_url or urllib.parse.urlparse(storage_url).scheme != 'file':
+        return None
+    out = urllib.parse.unquote(urllib.parse.urlparse(storage_url).path)
+    if path:
+        out = os.path.join(out, *path.split('/'))
+    return out
+
+def uploadFileToStorage(path, storage_url, dest_path = None):
+    '''Copy file to the local storage dir'''
+    out_path = _localStoragePath(storage_url, dest_path or os.path.basename(path))
+    if not out_path:
+        return None
+
+    print('INFO: Copying file to "%s" ...' % (out_path,))
+    os.makedirs(os.path.dirname(out_path), 0o700, True)
+    # Other nodes should not see the partially copied file
+    shutil.copyfile(path, out_path + '.tmp')
+    os.replace(out_path + '.tmp', out_path)
+
+    return True
+
+def downloadFileFromStorage(storage_url, path, out_path):
+    '''Copy file from the local storage dir'''
+    in_path = _localStoragePath(storage_url, path)
+    if not in_path or not os.path.isfile(in_path):
+        return None
+
+    print('INFO: Copying file from "%s" ...' % (in_path,))
+    shutil.copyfile(in_path, out_path)
+
+    return True
+
 def createInstanceAgent(cfg):
     '''The agent is created already - so returning just the name'''
     LOCAL_RESOURCES['agents'][cfg['instance_name']]['started'] = True
@@ -32,6 +32,7 @@ with open(sys.argv[-1], 'r') as f:
 
 import random # To generate seed for rendering
 import threading # To run timer and flush render periodically
+import queue # To pass the render commands to the main thread
 
 import bpy
 
@@ -54,28 +55,56 @@ if hasattr(scene.cycles, 'use_square_samples'):
     # Disabling square samples - script is getting the real number of samples to render
     scene.cycles.use_square_samples = False
 
-# Set sampling
-eprint('INFO: Set sampling')
-if hasattr(scene.cycles, 'progressive'):
-    # For blender < 3.0.0
-    if scene.cycles.progressive == 'PATH':
-        scene.cycles.samples = task['samples']
-    elif scene.cycles.progressive == 'BRANCHED_PATH':
-        scene.cycles.aa_samples = task['samples']
+def setSampling(samples, seed):
+    '''Set the number of samples to render and the seed'''
+    if hasattr(scene.cycles, 'progressive'):
+        # For blender < 3.0.0
+        if scene.cycles.progressive == 'PATH':
+            scene.cycles.samples = samples
+        elif scene.cycles.progressive == 'BRANCHED_PATH':
+            scene.cycles.aa_samples = samples
+        else:
+            eprint('ERROR: Unable to determine the sampling integrator')
+            sys.exit(1)
     else:
-        eprint('ERROR: Unable to determine the sampling integrator')
-        sys.exit(1)
-else:
-    scene.cycles.use_adaptive_sampling = False
-    scene.cycles.samples = task['samples']
+        scene.cycles.use_adaptive_sampling = False
+        scene.cycles.samples = samples
 
-# Set task seed or use random one (because we need an unique render pattern)
-scene.cycles.seed = task.get('seed', random.randrange(0, 2147483647))
+    # Set task seed or use random one (because we need an unique render pattern)
+    scene.cycles.seed = seed if seed is not None else random.randrange(0, 2147483647)
+
+eprint('INFO: Set sampling')
+setSampling(task['samples'], task.get('seed'))
 
 # Set frame if provided
 if 'frame' in task:
     scene.frame_current = task['frame']
 
+if 'frame_end' in task:
+    # Keep the synchronized scene data in memory to render the next frames faster
+    eprint('INFO: Use persistent data to render frames %d-%d' % (task['frame'], task['frame_end']))
+    scene.render.use_persistent_data = True
+elif task.get('worker'):
+    # Keep the synchronized scene data in memory to render the next workloads faster
+    eprint('INFO: Use persistent data to render the next workloads')
+    scene.render.use_persistent_data = True
+
+def setRegion(start, end):
+    '''Set the rows of the image to render, the Manager will stitch the regions together'''
+    height = scene.render.resolution_y * scene.render.resolution_percentage // 100
+    eprint('INFO: Set region rows %d-%d of %d' % (start, end, height))
+    scene.render.use_border = True
+    scene.render.use_crop_to_border = True
+    scene.render.border_min_x = 0.0
+    scene.render.border_max_x = 1.0
+    # Border is from the bottom and converted to pixels with rounding or truncating,
+    # so shifting it a quarter of pixel to get the same rows in both cases
+    scene.render.border_min_y = (height - end + 0.25) / height
+    scene.render.border_max_y = min((height - start + 0.25) / height, 1.0)
+
+if task.get('region_end') is not None:
+    setRegion(task['region_start'], task['region_end'])
+
 if bpy.context.view_layer.cycles.use_denoising:
     eprint('WARN: Disable denoising but enabling store denoise passes')
     # We have to disable denoising, but ...
@@ -132,7 +161,7 @@ class Commands:
         # exr, so switched to `write_still` in executing the render command
         try:
             if checkRenderExr('_render.exr'):
-                os.rename('_render.exr', 'render.exr')
+                os.replace('_render.exr', 'render.exr')
         except FileNotFoundError as e:
             # During cancel of the task `write_still` will not save the render result
             eprint('ERROR: Unable to find render file:', e)
@@ -144,11 +173,24 @@ class Commands:
             scene.render.image_settings.exr_codec = 'ZIP'
             bpy.data.images['Render Result'].save_render('_render.exr')
             if checkRenderExr('_render.exr'):
-                os.rename('_render.exr', 'render.exr')
+                os.replace('_render.exr', 'render.exr')
                 eprint('WARN: Recovered the render file:', os.stat('render.exr').st_size)
             else:
                 eprint('ERROR: Failed to recover render file (the type is not EXR ML)')
 
+def saveFrame(frame):
+    '''Stores the render of the frame in the frames range'''
+    try:
+        if checkRenderExr('_render.exr'):
+            os.replace('_render.exr', 'render-%d.exr' % frame)
+            eprint('INFO: Frame %d render saved' % frame)
+            return True
+    except FileNotFoundError as e:
+        # During cancel of the task `write_still` will not save the render result
+        eprint('ERROR: Unable to find render file:', e)
+    eprint('ERROR: Unable to save render of frame %d' % frame)
+    return False
+
 def executeCommand(name):
     func = getattr(Commands, name, None)
     if callable(func):
@@ -157,13 +199,20 @@ def executeCommand(name):
     else:
         eprint('ERROR: Unable to execute "%s" command' % name)
 
+# Render commands of the worker processed by the main thread
+render_queue = queue.Queue()
+
 def stdinProcess():
     '''Is used to get commands from the parent process'''
-    for line in iter(sys.stdin.readline, b''):
+    for line in iter(sys.stdin.readline, ''):
         try:
             command = line.strip()
             if command == 'end':
                 break
+            if command.startswith('render '):
+                # The next workload for the worker: {"samples": N, "seed": S, "region_start": R, ...}
+                render_queue.put(json.loads(command.split(' ', 1)[1]))
+                continue
             # Blender v3 contains a nasty bug with OpenEXR format which don't allow to save
             # intermediate results of render image: https://developer.blender.org/T94314
             if command == 'savePreview' and bpy.app.version_file[0] == 3:
@@ -172,6 +221,8 @@ def stdinProcess():
             executeCommand(command)
         except Exception as e:
             eprint('ERROR: Exception during processing stdin: %s' % e)
+    # No more workloads for the worker
+    render_queue.put(None)
 
 input_thread = threading.Thread(target=stdinProcess)
 input_thread.start()
@@ -184,13 +235,43 @@ scene.render.image_settings.color_depth = '32'
 scene.render.image_settings.exr_codec = 'ZIP'
 scene.render.filepath = os.path.abspath('_render.exr')
 
-bpy.ops.render.render(write_still=True)
+if 'frame_end' in task:
+    # Rendering the frames in the same session to not load and sync the scene again
+    for frame in range(task['frame'], task['frame_end'] + 1):
+        scene.frame_set(frame)
+        bpy.ops.render.render(write_still=True)
+        if not saveFrame(frame):
+            break # Render was cancelled
 
-eprint('INFO: Render process completed')
+    eprint('INFO: Render process completed')
+else:
+    bpy.ops.render.render(write_still=True)
+
+    eprint('INFO: Render process completed')
 
-# Render complete - saving the result image
-executeCommand('saveRender')
+    # Render complete - saving the result image
+    executeCommand('saveRender')
 # Save the final preview to update the user
 executeCommand('savePreview')
 
 eprint('INFO: Save render completed')
+
+while task.get('worker'):
+    # Keeping the project loaded to render the next workloads of the same task
+    eprint('INFO: Render worker is waiting')
+    print('BlendNet: Render worker is waiting')
+    workload = render_queue.get()
+    if workload is None:
+        break
+
+    eprint('INFO: Render worker got workload: %s' % (workload,))
+    setSampling(workload['samples'], workload.get('seed'))
+    if workload.get('region_end') is not None:
+        setRegion(workload['region_start'], workload['region_end'])
+    bpy.ops.render.render(write_still=True)
+
+    eprint('INFO: Render process completed')
+    executeCommand('saveRender')
+    executeCommand('savePreview')
+
+    eprint('INFO: Save render completed')
@@ -0,0 +1,51 @@
+#!/usr/bin/python3
+# -*- coding: UTF-8 -*-
+'''BlendNet Script Stitch
+
+Description: Special script used by the Manager to stitch the image regions
+'''
+
+import signal # The other better ways are not working for subprocess...
+signal.signal(signal.SIGTERM, lambda s, f: print('WARN: Dodged TERM subprocess'))
+
+import os, sys, json
+sys.path.append(os.path.dirname(__file__))
+
+import disable_buffering
+
+# Read current task specification from json file
+task = None
+with open(sys.argv[-1], 'r') as f:
+    task = json.load(f)
+
+print('DEBUG: Stitching regions:', task.get('images'))
+
+try:
+    import OpenImageIO as oiio
+except ImportError as e:
+    print('ERROR: Unable to stitch the regions - OpenImageIO is not available in blender:', e, file=sys.stderr)
+    sys.exit(1)
+
+regions = [ (oiio.ImageBuf(image['path']), image['start']) for image in task.get('images', []) ]
+if not regions:
+    print('ERROR: No regions to stitch', file=sys.stderr)
+    sys.exit(1)
+
+# The result has the same layers and passes as the regions, but the full height
+spec = oiio.ImageSpec(regions[0][0].spec())
+spec.x = spec.y = spec.full_x = spec.full_y = 0
+spec.height = spec.full_height = task['height']
+result = oiio.ImageBuf(spec)
+oiio.ImageBufAlgo.zero(result)
+
+for buf, start in regions:
+    if not oiio.ImageBufAlgo.paste(result, 0, start, 0, 0, buf):
+        print('ERROR: Unable to paste the region:', oiio.geterror(), file=sys.stderr)
+        sys.exit(1)
+
+result.specmod().attribute('compression', 'zip')
+if not result.write(task.get('result', 'result.exr')):
+    print('ERROR: Unable to write the stitched image:', result.geterror(), file=sys.stderr)
+    sys.exit(1)
+
+print('INFO: Stitching completed')
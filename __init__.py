@@ -355,6 +355,13 @@ class BlendNetSceneSettings(bpy.types.PropertyGroup):
         default = 0,
     )
 
+    split_by_regions: BoolProperty(
+        name = 'Split by image regions',
+        description = 'Render the still image strips on the agents instead of the full image samples, '
+            'useful for the big images with low samples. Requires OpenImageIO in the Manager\'s blender',
+        default = False,
+    )
+
     @classmethod
     def register(cls):
         bpy.types.Scene.blendnet = PointerProperty(
@@ -543,6 +550,7 @@ class BlendNetRunTaskOperation(bpy.types.Operator):
     _frame: 0 # current/start frame depends on animation
     _frame_to: 0 # end frame for animation
     _frame_orig: 0 # to restore the current frame after animation processing
+    _frames_range: False # animation is rendered by one task split by frames
     _task_name: None # store task name to retry later
 
     @classmethod
@@ -588,8 +596,11 @@ class BlendNetRunTaskOperation(bpy.types.Operator):
             self._frame = context.scene.frame_start
             self._frame_to = context.scene.frame_end
             self._frame_orig = context.scene.frame_current
+            # Short animations are better to split by samples to use all the agents
+            self._frames_range = BlendNet.addon.taskSplitByFrames(self._frame_to - self._frame + 1)
         else:
             self._frame = context.scene.frame_current
+            self._frames_range = False
 
         self._task_name = None
 
@@ -636,6 +647,14 @@ class BlendNetRunTaskOperation(bpy.types.Operator):
 
             # Prepare list of files need to be uploaded
             deps, bads = blend_file.getDependencies(bpy.path.abspath('//'), os.path.abspath(''))
+            if self._frames_range:
+                # Dependencies could be changed by frame (like image sequences)
+                for frame in range(self._frame + 1, self._frame_to + 1):
+                    scene.frame_current = frame
+                    frame_deps, frame_bads = blend_file.getDependencies(bpy.path.abspath('//'), os.path.abspath(''))
+                    deps |= frame_deps
+                    bads |= frame_bads
+                scene.frame_current = self._frame
             if bads:
                 self.report({'ERROR'}, 'Found some bad dependencies - please fix them before run: %s' % (bads,))
                 return {'CANCELLED'}
@@ -689,6 +708,7 @@ class BlendNetRunTaskOperation(bpy.types.Operator):
 
         cfg = {
             'samples': samples,
+            'seed': scene.cycles.seed, # The same inputs should have the same fingerprint
             'frame': scene.frame_current,
             'project': fname,
             'use_compositing_nodes': scene.render.use_compositing,
@@ -696,6 +716,11 @@ class BlendNetRunTaskOperation(bpy.types.Operator):
             'project_path': bpy.path.abspath('//'), # To resolve the project parent paths like `//../..`
             'cwd_path': os.path.abspath(''), # Current working directory to resolve relative paths like `../dir/file.txt`
         }
+        if self._frames_range:
+            cfg['frame_end'] = self._frame_to
+        elif scene.blendnet.split_by_regions:
+            cfg['split_mode'] = 'regions'
+            cfg['resolution_y'] = scene.render.resolution_y * scene.render.resolution_percentage // 100
 
         if not BlendNet.addon.managerTaskConfig(self._task_name, cfg):
             self.report({'WARNING'}, 'Unable to config the task "%s", let\'s retry...' % (self._task_name,))
@@ -713,7 +738,7 @@ class BlendNetRunTaskOperation(bpy.types.Operator):
         self._task_name = None
 
         if self.is_animation:
-            if self._frame < self._frame_to:
+            if self._frame < self._frame_to and not self._frames_range:
                 # Not all the frames are processed
                 self._frame += 1
                 return {'PASS_THROUGH'}
@@ -1033,6 +1058,46 @@ class BlendNetTaskRunOperation(bpy.types.Operator):
 
         return {'FINISHED'}
 
+class BlendNetTaskExtendOperation(bpy.types.Operator):
+    bl_idname = 'blendnet.taskextend'
+    bl_label = 'Add samples'
+    bl_description = 'Create and run the task continuing the completed one with more samples'
+    bl_options = {'REGISTER', 'INTERNAL'}
+
+    task_name: StringProperty()
+    samples: IntProperty(
+        name = 'Samples',
+        description = 'Total number of samples of the extended task',
+        min = 1,
+        default = 1,
+    )
+
+    @classmethod
+    def poll(cls, context):
+        bn = context.window_manager.blendnet
+        if len(bn.manager_tasks) <= bn.manager_tasks_idx:
+            return False
+        return bn.manager_tasks[bn.manager_tasks_idx].state == 'COMPLETED'
+
+    def invoke(self, context, event):
+        wm = context.window_manager
+        self.task_name = wm.blendnet.manager_tasks[wm.blendnet.manager_tasks_idx].name
+        # Doubling the samples by default
+        self.samples = (BlendNet.addon.managerTaskStatus(self.task_name).get('samples') or 0) * 2 or 1
+        return wm.invoke_props_dialog(self)
+
+    def execute(self, context):
+        task_name = '%s-%s' % (self.task_name, BlendNet.addon.genRandomString(3))
+        if not BlendNet.addon.managerTaskExtend(task_name, self.task_name, self.samples):
+            self.report({'ERROR'}, 'Unable to extend the task "%s", check the Manager log' % (self.task_name,))
+            return {'CANCELLED'}
+        if not BlendNet.addon.managerTaskRun(task_name):
+            self.report({'WARNING'}, 'Unable to start the extended task "%s"' % (task_name,))
+            return {'CANCELLED'}
+
+        self.report({'INFO'}, 'Task "%s" extends "%s" to %s samples' % (task_name, self.task_name, self.samples))
+        return {'FINISHED'}
+
 class BlendNetTaskDownloadOperation(bpy.types.Operator):
     bl_idname = 'blendnet.taskdownload'
     bl_label = 'Download task result'
@@ -1313,6 +1378,7 @@ class BlendNetTaskMenu(bpy.types.Menu):
         layout.operator('blendnet.taskdownload', text='Download render', icon='DOWNARROW_HLT').result = 'render'
         layout.operator('blendnet.taskdownload', text='Download compose', icon='DOWNARROW_HLT').result = 'compose'
         layout.operator('blendnet.taskrun', icon='PLAY')
+        layout.operator('blendnet.taskextend', icon='ADD')
         layout.operator('blendnet.taskremove', icon='TRASH')
         layout.operator('blendnet.taskstop', icon='PAUSE')
         layout.label(text='All tasks actions:')
@@ -1352,6 +1418,10 @@ class BlendNetRenderPanel(bpy.types.Panel):
         row.use_property_split = True
         row.use_property_decorate = False # No prop animation
         row.prop(bn, 'scene_memory_req', text='Render RAM (GB)')
+        row = box.row()
+        row.use_property_split = True
+        row.use_property_decorate = False # No prop animation
+        row.prop(bn, 'split_by_regions', text='Split by regions')
 
         if not BlendNet.addon.checkProviderIsSelected():
             box.label(text='ERROR: Provider init failed, check addon settings', icon='ERROR')
@@ -1742,6 +1812,7 @@ def register():
     bpy.utils.register_class(BlendNetTaskDetailsOperation)
     bpy.utils.register_class(BlendNetTaskDownloadOperation)
     bpy.utils.register_class(BlendNetTaskRunOperation)
+    bpy.utils.register_class(BlendNetTaskExtendOperation)
     bpy.utils.register_class(BlendNetTaskStopOperation)
     bpy.utils.register_class(BlendNetTasksStopStartedOperation)
     bpy.utils.register_class(BlendNetTaskRemoveOperation)
@@ -1775,6 +1846,7 @@ def unregister():
     bpy.utils.unregister_class(BlendNetTaskRemoveOperation)
     bpy.utils.unregister_class(BlendNetTasksStopStartedOperation)
     bpy.utils.unregister_class(BlendNetTaskStopOperation)
+    bpy.utils.unregister_class(BlendNetTaskExtendOperation)
     bpy.utils.unregister_class(BlendNetTaskRunOperation)
     bpy.utils.unregister_class(BlendNetTaskDownloadOperation)
     bpy.utils.unregister_class(BlendNetTaskDetailsOperation)
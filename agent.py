@@ -38,7 +38,8 @@ class Processor(Server.Processor):
 
 SimpleREST.generateCert(conf.get('instance_name', 'blendnet-agent'), 'server')
 httpd = SimpleREST.HTTPServer((conf.get('listen_host', ''), conf.get('listen_port', 9443)), __doc__.split('\n')[0], [Processor(conf)])
-httpd.setTLS(conf.get('server_tls_key', None), conf.get('server_tls_cert', None))
+if not conf.get('listen_plaintext'):
+    httpd.setTLS(conf.get('server_tls_key', None), conf.get('server_tls_cert', None))
 httpd.setBasicAuth('%s:%s' % (conf.get('auth_user', None), conf.get('auth_password', None)))
 
 print('BlendNet Agent v' + getVersion())